@@ -3,7 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import json, sqlite3, time
+import json
 import tqs
 import pytest
 import tornado.gen, tornado.ioloop
@@ -15,15 +15,13 @@ import tornado.gen, tornado.ioloop
 
 @pytest.fixture
 def app(tmpdir):
-    # TODO Would be nice to factor this out so that we can just call something in tqs instead
-    db = sqlite3.connect(str(tmpdir.join("test.db")))
-    db.row_factory = sqlite3.Row
-    with open("tqs.sql", "r") as f:
-        sql = f.read()
-        db.executescript(sql)
-    tornado.ioloop.PeriodicCallback(tqs.ExpireLeasesCallback(db), 1000).start() # TODO Is this ok to do here?
-    tornado.ioloop.PeriodicCallback(tqs.ExpireMessagesCallback(db), 1000).start() # TODO Is this ok to do here?
-    return tqs.TinyQueueServiceApplication(db, None)
+    db = tqs.Database(str(tmpdir.join("test.db")))
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None)
+    tornado.ioloop.PeriodicCallback(app.lease_reaper, 1000).start() # TODO Is this ok to do here?
+    tornado.ioloop.PeriodicCallback(tqs.ExpireMessagesCallback(app), 1000).start() # TODO Is this ok to do here?
+    yield app
+    db.close()
 
 
 #
@@ -0,0 +1,40 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import pytest
+
+import tqs_bench
+from test_api import app
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assert tqs_bench.percentile(values, 50) == 500
+    assert tqs_bench.percentile(values, 99) == 990
+    assert tqs_bench.percentile(values, 99.9) == 999
+    assert tqs_bench.percentile([7], 99.9) == 7
+    assert tqs_bench.percentile([], 50) is None
+
+
+def test_compare():
+    baseline = {"throughput": {"produced": 100.0, "consumed": 100.0, "acked": 0.0},
+                "endpoints": {"POST /queues/{name}": {"p99": 10.0}, "GET /queues/{name} (empty)": {"p99": 1000.0}}}
+    report = {"throughput": {"produced": 95.0, "consumed": 80.0, "acked": 0.0},
+              "endpoints": {"POST /queues/{name}": {"p99": 12.0}, "GET /queues/{name} (empty)": {"p99": 5000.0}}}
+    assert tqs_bench.compare(report, baseline, 10) == ["consumed throughput 80.0/s, was 100.0/s", "POST /queues/{name} p99 12.000ms, was 10.000ms"]
+    assert tqs_bench.compare(report, baseline, 25) == []
+
+
+@pytest.mark.parametrize("ack", ["single", "batch", "receive"])
+async def test_benchmark(http_server_client, ack):
+    args = tqs_bench.parse_arguments(["--duration=0.5", "--warmup=0", "--queues=2", "--producers=2", "--consumers=2", "--ackers=1",
+                                      "--wait-time=1", "--ack=" + ack])
+    report = await tqs_bench.Benchmark(http_server_client.get_url(""), args).run()
+    assert report["throughput"]["produced"] > 0
+    assert report["throughput"]["consumed"] > 0
+    assert report["throughput"]["acked"] > 0
+    summary = report["endpoints"]["POST /queues/{name}"]
+    assert summary["count"] > 0 and summary["errors"] == 0
+    assert summary["p50"] <= summary["p95"] <= summary["p99"] <= summary["p999"] <= summary["max"]
@@ -0,0 +1,185 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+#
+# Micro-benchmarks of the storage operations behind the handlers, at
+# different queue depths. They only run with TQS_BENCHMARK=1:
+#
+#   TQS_BENCHMARK=1 TQS_BENCHMARK_SAVE=1 pytest test_benchmarks.py   # record a baseline
+#   TQS_BENCHMARK=1 pytest test_benchmarks.py                        # compare against it
+#
+# An operation fails when its best time is more than
+# TQS_BENCHMARK_TOLERANCE percent (default 50) slower than the baseline.
+# The best of a number of rounds is the least affected by noise.
+# Other settings are TQS_BENCHMARK_DEPTHS (default 10000,1000000,10000000),
+# TQS_BENCHMARK_DIR for the populated databases and the baseline (default
+# .benchmarks) and TQS_BENCHMARK_DROP_INDEXES, a comma separated list of
+# indexes to drop before measuring, to find out if an index pays for itself.
+#
+# Populated databases are kept per depth and schema, as filling one with
+# millions of messages takes minutes. Every operation runs in a savepoint
+# that is rolled back, so the queue depth does not change.
+#
+
+
+import hashlib, json, os, statistics, time, types
+import pytest
+
+import tqs
+
+
+pytestmark = pytest.mark.skipif(not os.getenv("TQS_BENCHMARK"), reason="set TQS_BENCHMARK=1 to run the storage benchmarks")
+
+DEPTHS = [int(depth) for depth in os.getenv("TQS_BENCHMARK_DEPTHS", "10000,1000000,10000000").split(",")]
+DIRECTORY = os.getenv("TQS_BENCHMARK_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmarks"))
+TOLERANCE = float(os.getenv("TQS_BENCHMARK_TOLERANCE", "50"))
+DROP_INDEXES = [name for name in os.getenv("TQS_BENCHMARK_DROP_INDEXES", "").split(",") if name]
+ROUNDS = 50
+WARMUP_ROUNDS = 5
+BATCH_SIZE = 10
+
+# One queue with depth messages: 5% leased, 5% delayed and the rest visible, over five priorities
+POPULATE_SQL = """
+with recursive n(i) as (select 0 union all select i + 1 from n where i + 1 < :depth)
+insert into messages (create_date, visible_date, expire_date, queue_id, body, type, priority, lease_date, lease_count, lease_timeout, lease_expire_date)
+select :now - :depth + i, case when i % 20 = 1 then :now + 600 else :now - :depth + i end, :now + 345600, :queue_id, hex(randomblob(50)), 'text/plain', (i % 5) * 20,
+       case when i % 20 = 0 then :now end, i % 20 = 0, case when i % 20 = 0 then 3600 end, case when i % 20 = 0 then :now + 3600 end
+from n
+"""
+
+def schema_version():
+    with open(os.path.join(os.path.dirname(os.path.abspath(tqs.__file__)), "tqs.sql"), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:8]
+
+def populate(path, depth):
+    db = tqs.connect_database(path)
+    db.execute("begin immediate")
+    tqs.create_schema(db)
+    now = time.time()
+    queue_id = tqs.create_queue(db, "bench", now - depth)
+    db.execute(POPULATE_SQL, {"depth": depth, "now": now, "queue_id": queue_id})
+    db.execute("update queues set insert_count = ? where id = ?", [depth, queue_id])
+    db.execute("commit")
+    db.execute("analyze")
+    db.close()
+
+@pytest.fixture(scope="module", params=DEPTHS, ids=lambda depth: "depth=%d" % depth)
+def storage(request):
+    depth = request.param
+    os.makedirs(DIRECTORY, exist_ok=True)
+    path = os.path.join(DIRECTORY, "storage-%d-%s.sqlite3" % (depth, schema_version()))
+    if not os.path.exists(path):
+        populate(path + ".tmp", depth)
+        os.rename(path + ".tmp", path)
+    db = tqs.connect_database(path)
+    # Everything, including dropping indexes, happens in a transaction that is never committed
+    db.execute("begin immediate")
+    for name in DROP_INDEXES:
+        db.execute("drop index " + name)
+    queue = tqs.find_queue(db, "bench")
+    yield types.SimpleNamespace(db=db, depth=depth, queue_id=queue["id"], queue=queue)
+    db.execute("rollback")
+    db.close()
+
+@pytest.fixture(scope="session")
+def baseline():
+    path = os.path.join(DIRECTORY, "baseline.json")
+    try:
+        with open(path) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+    results = {}
+    yield previous, results
+    if os.getenv("TQS_BENCHMARK_SAVE"):
+        previous.update(results)
+        os.makedirs(DIRECTORY, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(previous, f, indent=2, sort_keys=True)
+
+# Runs setup and operation in a savepoint that is rolled back, only the
+# operation is timed. Operations that take microseconds are repeated
+# number times per round. Fails when the best time is slower than the
+# baseline.
+def measure(storage, baseline, name, operation, setup=None, number=1):
+    db = storage.db
+    timings = []
+    for n in range(WARMUP_ROUNDS + ROUNDS):
+        db.execute("savepoint benchmark")
+        try:
+            arguments = setup() if setup else ()
+            start = time.perf_counter()
+            for i in range(number):
+                operation(*arguments)
+            if n >= WARMUP_ROUNDS:
+                timings.append((time.perf_counter() - start) / number)
+        finally:
+            db.execute("rollback to benchmark")
+            db.execute("release benchmark")
+    best = min(timings)
+    previous, results = baseline
+    key = "%s depth=%d" % (name, storage.depth)
+    results[key] = best
+    print("%s: best %.3fms, median %.3fms" % (key, best * 1000, statistics.median(timings) * 1000))
+    if key in previous and not os.getenv("TQS_BENCHMARK_SAVE"):
+        assert best <= previous[key] * (1 + TOLERANCE / 100.0), "%s is %.0f%% slower than the baseline" % (key, (best / previous[key] - 1) * 100)
+
+def messages(n):
+    return [{"body": "x" * 100, "priority": (i % 5) * 20} for i in range(n)]
+
+
+def test_enqueue_batch(storage, baseline):
+    measure(storage, baseline, "enqueue batch", lambda: tqs.insert_messages(storage.db, storage.queue_id, messages(BATCH_SIZE), time.time()))
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_receive_batch(storage, baseline, monkeypatch, returning):
+    if returning and not tqs.SQLITE_RETURNING:
+        pytest.skip("SQLite %s does not support RETURNING" % tqs.sqlite3.sqlite_version)
+    monkeypatch.setattr(tqs, "SQLITE_RETURNING", returning)
+    measure(storage, baseline, "receive batch returning=%s" % returning,
+            lambda: tqs.receive_messages(storage.db, storage.queue_id, BATCH_SIZE, tqs.DEFAULT_VISIBILITY_TIMEOUT, False))
+
+
+def test_receive_delete_batch(storage, baseline):
+    measure(storage, baseline, "receive and delete batch", lambda: tqs.receive_messages(storage.db, storage.queue_id, BATCH_SIZE, tqs.DEFAULT_VISIBILITY_TIMEOUT, True))
+
+
+def test_ack(storage, baseline):
+    def setup():
+        return [[message["lease_uuid"] for message in tqs.receive_messages(storage.db, storage.queue_id, BATCH_SIZE, tqs.DEFAULT_VISIBILITY_TIMEOUT, False)]]
+    def ack(lease_uuids):
+        for lease_uuid in lease_uuids:
+            assert tqs.delete_lease(storage.db, storage.queue_id, lease_uuid)
+    measure(storage, baseline, "ack", ack, setup)
+
+
+def test_ack_batch(storage, baseline):
+    def setup():
+        return [[{"lease_uuid": message["lease_uuid"]} for message in tqs.receive_messages(storage.db, storage.queue_id, BATCH_SIZE, tqs.DEFAULT_VISIBILITY_TIMEOUT, False)]]
+    measure(storage, baseline, "ack batch", lambda leases: tqs.update_leases(storage.db, storage.queue_id, leases, time.time()), setup)
+
+
+def test_load_queue_counters(storage, baseline):
+    measure(storage, baseline, "load_queue_counters", lambda: tqs.load_queue_counters(storage.db))
+
+
+def test_queue_statistics(storage, baseline):
+    app = types.SimpleNamespace(counters=tqs.load_queue_counters(storage.db), reclaimer=tqs.ReclaimQueuesCallback(None))
+    measure(storage, baseline, "queue_statistics", lambda: tqs.queue_statistics(app, storage.queue), number=1000)
+
+
+def test_expire_leases(storage, baseline):
+    def setup():
+        storage.db.execute("update messages set lease_expire_date = 0 where id in (select id from messages where lease_expire_date is not null limit 100)")
+        return ()
+    measure(storage, baseline, "expire_leases", lambda: tqs.expire_leases(storage.db, time.time()), setup)
+
+
+def test_expire_messages(storage, baseline):
+    def setup():
+        storage.db.execute("update messages set expire_date = 0 where id in (select id from messages where lease_date is null limit ?)", [tqs.EXPIRE_MESSAGES_BATCH_SIZE])
+        return ()
+    measure(storage, baseline, "expire_messages", lambda: tqs.expire_messages(storage.db, time.time(), tqs.EXPIRE_MESSAGES_BATCH_SIZE), setup)
@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json, time
+import pytest
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.websocket import websocket_connect
+
+import tqs
+
+
+@pytest.fixture
+def workers(io_loop, tmpdir):
+    sockets = [bind_unused_port() for _ in range(2)]
+    ports = [port for sock, port in sockets]
+    workers = []
+    for worker_id, (sock, port) in enumerate(sockets):
+        db = tqs.Database(tqs.shard_database_path(str(tmpdir.join("test.db")), worker_id))
+        db.run_sync(tqs.create_schema)
+        app = tqs.TinyQueueServiceApplication(db, None, tqs.Cluster(worker_id, ports, "s3cr3t"))
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        workers.append((app, server, "http://127.0.0.1:%d" % port))
+    yield workers
+    for app, server, url in workers:
+        server.stop()
+        app.db.close()
+
+
+def queue_names(cluster):
+    # A couple of queue names for every shard
+    names = {}
+    for n in range(100):
+        names.setdefault(cluster.shard("test%d" % n), []).append("test%d" % n)
+    return names
+
+
+def test_shard_database_path():
+    assert tqs.shard_database_path("/data/tqs.sqlite3", 3) == "/data/tqs-3.sqlite3"
+
+
+async def test_forwarding(workers):
+    client = AsyncHTTPClient()
+    names = queue_names(workers[0][0].cluster)
+    # Create a queue for each worker, through the first worker
+    for shard in (0, 1):
+        response = await client.fetch(workers[0][2] + "/queues", raise_error=False, method="POST", body=json.dumps({"name": names[shard][0]}))
+        assert response.code == 200
+    # Each queue only exists in the database of the worker that owns it
+    for shard in (0, 1):
+        app = workers[shard][0]
+        assert await app.db.read(tqs.find_queue, names[shard][0]) is not None
+        assert await app.db.read(tqs.find_queue, names[1 - shard][0]) is None
+    # Post to a queue through the worker that does not own it, receive it through the one that does
+    name = names[1][0]
+    response = await client.fetch(workers[0][2] + "/queues/" + name, raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    response = await client.fetch(workers[1][2] + "/queues/" + name, raise_error=False)
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [m["body"] for m in j["messages"]] == ["hello"]
+    # Delete the lease through the other worker
+    response = await client.fetch(workers[0][2] + "/queues/%s/leases/%s" % (name, j["messages"][0]["lease_uuid"]), raise_error=False, method="DELETE")
+    assert response.code == 200
+    # Errors are forwarded too
+    response = await client.fetch(workers[0][2] + "/queues/" + names[1][1], raise_error=False)
+    assert response.code == 404
+    response = await client.fetch(workers[0][2] + "/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+    assert response.code == 409
+    # A client cannot bypass the partitioning
+    response = await client.fetch(workers[0][2] + "/queues", raise_error=False, method="POST", headers={tqs.FORWARDED_HEADER: "cheese"},
+                                  body=json.dumps({"name": names[1][1]}))
+    assert response.code == 200
+    assert await workers[0][0].db.read(tqs.find_queue, names[1][1]) is None
+
+
+async def test_gather(workers):
+    client = AsyncHTTPClient()
+    names = queue_names(workers[0][0].cluster)
+    created = [names[0][0], names[1][0], names[0][1], names[1][1]]
+    for name in created:
+        response = await client.fetch(workers[1][2] + "/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+        assert response.code == 200
+        time.sleep(0.01)
+    for app, server, url in workers:
+        # All queues, in the order in which they were created
+        response = await client.fetch(url + "/queues", raise_error=False)
+        assert response.code == 200
+        j = json.loads(response.body.decode())
+        assert [queue["name"] for queue in j["queues"]] == created
+        # Statistics for all queues
+        response = await client.fetch(url + "/statistics", raise_error=False)
+        assert response.code == 200
+        assert sorted(json.loads(response.body.decode())) == sorted(created)
+        response = await client.fetch(url + "/statistics?format=telegraf", raise_error=False)
+        assert response.code == 200
+        assert sorted(d["service"] for d in json.loads(response.body.decode())) == sorted(created)
+
+
+async def test_ingest_forwarding(workers):
+    client = AsyncHTTPClient()
+    name = queue_names(workers[0][0].cluster)[1][0]
+    response = await client.fetch(workers[1][2] + "/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+    assert response.code == 200
+    body = "".join(json.dumps({"body": str(n)}) + "\n" for n in range(3000)).encode()
+    async def produce_body(write):
+        for n in range(0, len(body), 1000):
+            await write(body[n:n+1000])
+    response = await client.fetch(workers[0][2] + "/queues/%s/ingest" % name, raise_error=False, method="POST", body_producer=produce_body)
+    assert response.code == 200
+    assert json.loads(response.body.decode()) == {"accepted": 3000, "rejected": 0, "errors": []}
+    response = await client.fetch(workers[1][2] + "/queues/%s/statistics" % name, raise_error=False)
+    assert json.loads(response.body.decode())["visible"] == 3000
+
+
+async def test_consumer_forwarding(workers):
+    client = AsyncHTTPClient()
+    name = queue_names(workers[0][0].cluster)[1][0]
+    response = await client.fetch(workers[1][2] + "/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+    assert response.code == 200
+    response = await client.fetch(workers[1][2] + "/queues/" + name, raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    # Consume through the worker that does not own the queue
+    conn = await websocket_connect(workers[0][2].replace("http:", "ws:", 1) + "/queues/%s/consume?credit=1" % name)
+    messages = json.loads(await conn.read_message())["messages"]
+    assert [m["body"] for m in messages] == ["hello"]
+    conn.write_message(json.dumps({"leases": [{"lease_uuid": messages[0]["lease_uuid"]}]}))
+    assert json.loads(await conn.read_message()) == {"leases": [{"lease_uuid": messages[0]["lease_uuid"], "status": 200}]}
+    conn.close()
+    response = await client.fetch(workers[1][2] + "/queues/%s/statistics" % name, raise_error=False)
+    assert json.loads(response.body.decode())["leased"] == 0
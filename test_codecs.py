@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import pytest
+
+import tqs
+from test_api import app
+
+
+def ndjson(items):
+    return "".join(json.dumps(item) + "\n" for item in items)
+
+def parse_ndjson(body):
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+async def test_ndjson(http_server_client):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Post messages as NDJSON, the response follows Accept
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=ndjson([{"body": "a"}, {"body": "b", "priority": 10}]),
+                                              headers={"Content-Type": "application/x-ndjson"})
+    assert response.code == 200
+    assert response.headers["Content-Type"].startswith("application/json")
+    assert [m["id"] for m in json.loads(response.body.decode())["messages"]] == [1, 2]
+    # Receive them as NDJSON, with numeric dates
+    response = await http_server_client.fetch("/queues/test?message_count=10", raise_error=False, headers={"Accept": "application/x-ndjson"})
+    assert response.code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    messages = parse_ndjson(response.body)
+    assert [m["body"] for m in messages] == ["b", "a"]
+    assert type(messages[0]["create_date"]) == float and type(messages[0]["lease_date"]) == float
+    assert messages[0]["expire_date"] - messages[0]["create_date"] == pytest.approx(tqs.DEFAULT_MESSAGE_RETENTION)
+    # Delete the leases in a batch
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST",
+                                              body=ndjson([{"lease_uuid": m["lease_uuid"]} for m in messages]),
+                                              headers={"Content-Type": "application/x-ndjson", "Accept": "application/x-ndjson"})
+    assert response.code == 200
+    assert [lease["status"] for lease in parse_ndjson(response.body)] == [200, 200]
+    # Invalid lines
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body='{"body": "a"}\nnope\n',
+                                              headers={"Content-Type": "application/x-ndjson"})
+    assert response.code == 400
+
+
+async def test_msgpack(http_server_client):
+    msgpack = pytest.importorskip("msgpack")
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    headers = {"Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=msgpack.packb({"messages": [{"body": "a", "type": "application/json"}]}), headers=headers)
+    assert response.code == 200
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert msgpack.unpackb(response.body) == {"messages": [{"id": 1}]}
+    response = await http_server_client.fetch("/queues/test", raise_error=False, headers=headers)
+    assert response.code == 200
+    messages = msgpack.unpackb(response.body)["messages"]
+    assert messages[0]["body"] == "a" and messages[0]["type"] == "application/json"
+    assert type(messages[0]["create_date"]) == float
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST",
+                                              body=msgpack.packb({"leases": [{"lease_uuid": messages[0]["lease_uuid"]}]}), headers=headers)
+    assert response.code == 200
+    assert msgpack.unpackb(response.body) == {"leases": [{"lease_uuid": messages[0]["lease_uuid"], "status": 200}]}
+    # Not a list of messages
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=msgpack.packb([{"body": "a"}]), headers=headers)
+    assert response.code == 400
+
+
+async def test_not_acceptable(http_server_client):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "a"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, headers={"Accept": "text/html"})
+    assert response.code == 406
+    # The message was not received
+    response = await http_server_client.fetch("/queues/test", raise_error=False, headers={"Accept": "text/html, */*;q=0.1"})
+    assert response.code == 200
+    assert len(json.loads(response.body.decode())["messages"]) == 1
+
+
+def test_accept_codec():
+    assert tqs.accept_codec(None) is tqs.DEFAULT_CODEC
+    assert tqs.accept_codec("application/x-ndjson") is tqs.CODECS["application/x-ndjson"]
+    assert tqs.accept_codec("application/json;q=0.5, application/x-ndjson") is tqs.CODECS["application/x-ndjson"]
+    assert tqs.accept_codec("application/x-ndjson;q=0, application/*") is tqs.DEFAULT_CODEC
+    assert tqs.accept_codec("image/png") is None
@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import datetime, json
+import pytest
+import tornado.gen, tornado.queues
+
+from tornado.httpclient import HTTPClientError
+from tornado.websocket import websocket_connect
+
+import tqs
+from test_api import app
+
+
+async def post_messages(http_server_client, bodies, name="test"):
+    response = await http_server_client.fetch("/queues/" + name, raise_error=False, method="POST", body=json.dumps({"messages": [{"body": body} for body in bodies]}))
+    assert response.code == 200
+
+async def get_statistics(http_server_client, name="test"):
+    response = await http_server_client.fetch("/queues/%s/statistics" % name, raise_error=False)
+    assert response.code == 200
+    return json.loads(response.body.decode())
+
+# Frames are put on conn.frames, a timed out read_message would lose the next one
+async def consume(http_server_client, query=""):
+    frames = tornado.queues.Queue()
+    conn = await websocket_connect(http_server_client.get_url("/queues/test/consume" + query).replace("http:", "ws:", 1), on_message_callback=frames.put_nowait)
+    conn.frames = frames
+    return conn
+
+# The next frame, or None when nothing arrives in time
+async def read(conn, timeout=0.25):
+    try:
+        message = await conn.frames.get(timeout=datetime.timedelta(seconds=timeout))
+    except tornado.gen.TimeoutError:
+        return None
+    return json.loads(message)
+
+async def read_messages(conn, n):
+    messages = []
+    while len(messages) < n:
+        frame = await read(conn, 5)
+        messages.extend(frame["messages"])
+    return messages
+
+
+async def test_consume(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    await post_messages(http_server_client, ["a", "b", "c", "d"])
+    conn = await consume(http_server_client, "?credit=2&visibility_timeout=60")
+    # Only as many messages as there is credit
+    messages = await read_messages(conn, 2)
+    assert [m["body"] for m in messages] == ["a", "b"]
+    assert messages[0]["lease_timeout"] == 60
+    assert await read(conn) is None
+    assert (await get_statistics(http_server_client))["leased"] == 2
+    # An ack makes room for the next message
+    conn.write_message(json.dumps({"leases": [{"lease_uuid": messages[0]["lease_uuid"]}, {"lease_uuid": "00000000-0000-4000-8000-000000000000"}]}))
+    assert await read(conn, 5) == {"leases": [{"lease_uuid": messages[0]["lease_uuid"], "status": 200},
+                                              {"lease_uuid": "00000000-0000-4000-8000-000000000000", "status": 404}]}
+    assert [m["body"] for m in await read_messages(conn, 1)] == ["c"]
+    # More credit
+    conn.write_message(json.dumps({"credit": 4}))
+    assert [m["body"] for m in await read_messages(conn, 1)] == ["d"]
+    # New messages are pushed right away
+    await post_messages(http_server_client, ["e"])
+    assert [m["body"] for m in await read_messages(conn, 1)] == ["e"]
+    statistics = await get_statistics(http_server_client)
+    assert (statistics["leased"], statistics["visible"]) == (4, 0)
+    # Invalid requests are answered with an error
+    conn.write_message(json.dumps({"credit": 0}))
+    assert "error" in await read(conn, 5)
+    # Closing releases the leases in flight
+    conn.close()
+    for n in range(50):
+        statistics = await get_statistics(http_server_client)
+        if statistics["visible"] == 4:
+            break
+        await tornado.gen.sleep(0.01)
+    assert (statistics["leased"], statistics["visible"]) == (0, 4)
+
+
+async def test_consume_expired_leases(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    await post_messages(http_server_client, ["a"])
+    conn = await consume(http_server_client, "?credit=1&visibility_timeout=5")
+    messages = await read_messages(conn, 1)
+    # An extended lease stays in flight, an expired lease makes room again
+    conn.write_message(json.dumps({"leases": [{"lease_uuid": messages[0]["lease_uuid"], "action": "extend", "visibility_timeout": 5}]}))
+    assert (await read(conn, 5))["leases"][0]["status"] == 200
+    await post_messages(http_server_client, ["b"])
+    assert await read(conn, 4) is None
+    assert [m["body"] for m in await read_messages(conn, 1)] == ["b"]
+    conn.close()
+
+
+async def test_consume_race(http_server_client, app, monkeypatch):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # A message is posted after the consumer found the queue empty, but before it waits
+    receive = tqs.ConsumerHandler.receive
+    posted = []
+    async def receive_then_post(self, *args):
+        rows = await receive(self, *args)
+        if not rows and not posted:
+            posted.append(True)
+            await post_messages(http_server_client, ["a"])
+        return rows
+    monkeypatch.setattr(tqs.ConsumerHandler, "receive", receive_then_post)
+    conn = await consume(http_server_client)
+    assert [m["body"] for m in (await read(conn, 1))["messages"]] == ["a"]
+    conn.close()
+
+
+async def test_consume_queue_deleted(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    conn = await consume(http_server_client)
+    await tornado.gen.sleep(0.1)
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="DELETE")
+    assert response.code == 200
+    # The closed socket shows up as a None frame
+    assert await conn.frames.get(timeout=datetime.timedelta(seconds=5)) is None
+    assert conn.close_code == tqs.CONSUMER_QUEUE_NOT_FOUND
+
+
+async def test_consume_invalid(http_server_client, app):
+    with pytest.raises(HTTPClientError) as e:
+        await consume(http_server_client)
+    assert e.value.code == 404
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    for query in ("?credit=0", "?credit=abc", "?visibility_timeout=1"):
+        with pytest.raises(HTTPClientError) as e:
+            await consume(http_server_client, query)
+        assert e.value.code == 400
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os, threading, time
+import pytest
+import tornado.gen
+
+import tqs
+
+
+def current_thread_name(db):
+    return threading.current_thread().name
+
+
+@pytest.fixture
+def db(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), readers=2)
+    db.run_sync(tqs.create_schema)
+    yield db
+    db.close()
+
+
+async def test_write_runs_on_writer_thread(db):
+    name = await db.write(current_thread_name)
+    assert name.startswith("tqs-writer")
+    assert name != threading.current_thread().name
+
+
+async def test_read_runs_on_reader_thread(db):
+    name = await db.read(current_thread_name)
+    assert name.startswith("tqs-reader")
+
+
+async def test_read_sees_committed_writes(db):
+    queue_id = await db.write(tqs.create_queue, "test", time.time())
+    queue = await db.read(tqs.find_queue, "test")
+    assert queue["id"] == queue_id
+    assert await db.write(tqs.delete_queue, "test")
+    assert await db.read(tqs.find_queue, "test") is None
+
+
+async def test_write_errors_are_raised(db):
+    await db.write(tqs.create_queue, "test", time.time())
+    with pytest.raises(tqs.sqlite3.IntegrityError):
+        await db.write(tqs.create_queue, "test", time.time())
+
+
+async def test_memory_database_has_no_readers():
+    db = tqs.Database(":memory:", readers=2)
+    db.run_sync(tqs.create_schema)
+    name = await db.read(current_thread_name)
+    assert name.startswith("tqs-writer")
+    db.close()
+
+
+def fail(db):
+    db.execute("insert into queues (create_date, name) values (?, ?)", [time.time(), "fail"])
+    raise ValueError("fail")
+
+
+@pytest.mark.parametrize("journal_mode", ["delete", "wal"])
+async def test_group_commit(tmpdir, journal_mode):
+    db = tqs.Database(str(tmpdir.join("test.db")), journal_mode=journal_mode, synchronous="full", group_commit=0.1)
+    db.run_sync(tqs.create_schema)
+    commits = db.commits
+    # Writes that arrive within the window share a commit
+    queue_ids = await tornado.gen.multi([db.write(tqs.create_queue, "test%d" % n, time.time()) for n in range(10)])
+    assert len(set(queue_ids)) == 10
+    assert db.commits == commits + 1
+    # A failing write does not take the other writes in its batch down with it
+    futures = [db.write(tqs.create_queue, "ok1", time.time()), db.write(fail), db.write(tqs.create_queue, "ok2", time.time())]
+    with pytest.raises(ValueError):
+        await futures[1]
+    await futures[0]
+    await futures[2]
+    assert await db.read(tqs.find_queue, "ok1") is not None
+    assert await db.read(tqs.find_queue, "ok2") is not None
+    assert await db.read(tqs.find_queue, "fail") is None
+    db.close()
+
+
+def test_connect_database_validates_settings():
+    with pytest.raises(ValueError):
+        tqs.connect_database(":memory:", journal_mode="cheese")
+    with pytest.raises(ValueError):
+        tqs.connect_database(":memory:", synchronous="cheese")
+
+
+def pragma(db, name):
+    return db.execute("PRAGMA " + name).fetchone()[0]
+
+
+# Reads a database file while ignoring its log
+def count_checkpointed(path, table):
+    db = tqs.sqlite3.connect("file:%s?immutable=1" % path, uri=True)
+    try:
+        return db.execute("select count(*) from " + table).fetchone()[0]
+    finally:
+        db.close()
+
+
+async def test_checkpointer(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), journal_mode="wal", queue_directory=str(tmpdir.join("queues")),
+                      mmap_size=1024 * 1024, checkpoint_interval=0.05)
+    try:
+        db.run_sync(tqs.create_schema)
+        # The writer leaves checkpoints to the checkpointer, unless its log gets too big
+        assert await db.write(pragma, "wal_autocheckpoint") == tqs.CHECKPOINT_WAL_PAGES
+        assert await db.write(pragma, "mmap_size") == 1024 * 1024
+        queue_id = await db.write(tqs.create_queue, "test", time.time())
+        await db.write(tqs.insert_messages, queue_id, [{"body": "x" * 1000} for i in range(100)], time.time(), queue_id=queue_id)
+        assert os.path.getsize(db.queue_path(queue_id) + "-wal") > 0
+        checkpoints = db.checkpoints
+        while db.checkpoints < checkpoints + 2:
+            await tornado.gen.sleep(0.05)
+        # What is in the logs of both files was copied back
+        assert count_checkpointed(db.path, "queues") == 1
+        assert count_checkpointed(db.queue_path(queue_id), "messages") == 100
+    finally:
+        db.close()
+
+
+async def test_checkpointer_busy_writer(tmpdir, monkeypatch):
+    monkeypatch.setattr(tqs, "CHECKPOINT_WAL_PAGES", 100)
+    db = tqs.Database(str(tmpdir.join("test.db")), journal_mode="wal", checkpoint_interval=0.05)
+    try:
+        db.run_sync(tqs.create_schema)
+        queue_id = await db.write(tqs.create_queue, "test", time.time())
+        # Passive checkpoints alone never catch up with a writer that keeps committing
+        wal_size = 0
+        end = time.time() + 2
+        while time.time() < end:
+            await tornado.gen.multi([db.write(tqs.insert_messages, queue_id, [{"body": "x" * 200} for i in range(50)], time.time()) for n in range(10)])
+            wal_size = max(wal_size, os.path.getsize(db.path + "-wal"))
+        assert db.checkpoints > 0
+        assert wal_size < 1024 * 1024
+    finally:
+        db.close()
+
+
+def test_checkpointer_needs_wal(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), checkpoint_interval=0.05)
+    assert db.checkpointer is None
+    assert db.run_sync(pragma, "wal_autocheckpoint") == 1000
+    db.close()
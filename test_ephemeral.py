@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json, time
+import pytest
+import tornado.gen, tornado.ioloop
+
+import tqs
+
+
+#
+# The same application, with small ephemeral queues
+#
+
+@pytest.fixture
+def app(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), ephemeral_queue_size=256 * 1024)
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None)
+    tornado.ioloop.PeriodicCallback(app.lease_reaper, 1000).start()
+    tornado.ioloop.PeriodicCallback(tqs.ExpireMessagesCallback(app), 1000).start()
+    yield app
+    db.close()
+
+
+async def create_queue(http_server_client, name, durable):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": name, "durable": durable}))
+    assert response.code == 200
+
+
+async def test_ephemeral_queue(http_server_client, app):
+    await create_queue(http_server_client, "durable", True)
+    await create_queue(http_server_client, "ephemeral", False)
+    response = await http_server_client.fetch("/queues", raise_error=False)
+    assert [(q["name"], q["durable"]) for q in json.loads(response.body.decode())["queues"]] == [("durable", True), ("ephemeral", False)]
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}, {"body": "2", "priority": 10}]}))
+    assert response.code == 200
+    # The messages are not in the database
+    assert await app.db.write(count_messages) == 0
+    response = await http_server_client.fetch("/queues/ephemeral?message_count=2", raise_error=False)
+    assert response.code == 200
+    messages = json.loads(response.body.decode())["messages"]
+    assert [m["body"] for m in messages] == ["2", "1"]
+    response = await http_server_client.fetch("/queues/ephemeral/leases", raise_error=False, method="POST",
+                                              body=json.dumps({"leases": [{"lease_uuid": messages[0]["lease_uuid"]}, {"lease_uuid": messages[1]["lease_uuid"], "action": "release"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/ephemeral/statistics", raise_error=False)
+    j = json.loads(response.body.decode())
+    assert (j["total"], j["visible"], j["insert_count"], j["delete_count"]) == (1, 1, 2, 1)
+    # Leases expire like those of durable queues
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False)
+    assert len(json.loads(response.body.decode())["messages"]) == 1
+    queue = await app.queues.get("ephemeral")
+    await app.db.write(run_sql, "update messages set lease_expire_date = 0", queue_id=queue["id"])
+    await app.lease_reaper()
+    assert app.counters[queue["id"]].leased == 0
+
+
+async def test_ephemeral_queue_restart(http_server_client, app, tmpdir):
+    await create_queue(http_server_client, "ephemeral", False)
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}]}))
+    assert response.code == 200
+    # A second application on the same database sees the messages
+    assert tqs.TinyQueueServiceApplication(app.db, None).counters[(await app.queues.get("ephemeral"))["id"]].total == 1
+    # After a restart the queue is still there, but empty
+    db = tqs.Database(str(tmpdir.join("test.db")))
+    try:
+        restarted = tqs.TinyQueueServiceApplication(db, None)
+        queue = db.run_sync(tqs.find_queue, "ephemeral")
+        assert queue["durable"] == 0
+        assert restarted.counters[queue["id"]].total == 0
+        assert db.run_sync(count_messages, queue_id=queue["id"]) == 0
+    finally:
+        db.close()
+
+
+async def test_ephemeral_queue_full(http_server_client, app):
+    await create_queue(http_server_client, "ephemeral", False)
+    body = json.dumps({"messages": [{"body": "x" * 4000} for i in range(10)]})
+    for i in range(100):
+        response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=body)
+        if response.code != 200:
+            break
+    assert response.code == 507
+    # Durable queues are not affected
+    await create_queue(http_server_client, "durable", True)
+    response = await http_server_client.fetch("/queues/durable", raise_error=False, method="POST", body=body)
+    assert response.code == 200
+    # Room is made by receiving messages
+    response = await http_server_client.fetch("/queues/ephemeral?message_count=10&delete=true", raise_error=False)
+    assert len(json.loads(response.body.decode())["messages"]) == 10
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=body)
+    assert response.code == 200
+
+
+async def test_ephemeral_queue_purge_and_delete(http_server_client, app):
+    await create_queue(http_server_client, "ephemeral", False)
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}]}))
+    assert response.code == 200
+    queue = await app.queues.get("ephemeral")
+    response = await http_server_client.fetch("/queues/ephemeral/purge", raise_error=False, method="POST", body="")
+    assert response.code == 202
+    while app.reclaimer.queues:
+        await app.reclaimer()
+        await tornado.gen.sleep(0.01)
+    assert queue["id"] not in app.db.memory
+    # The new queue is not durable either
+    new_queue = await app.queues.get("ephemeral")
+    assert new_queue["durable"] == 0 and new_queue["id"] in app.db.memory
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False)
+    assert json.loads(response.body.decode())["messages"] == []
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="DELETE")
+    assert response.code == 200
+    assert new_queue["id"] not in app.db.memory
+
+
+async def test_ephemeral_queue_stale_leases(http_server_client, app, tmpdir):
+    await create_queue(http_server_client, "ephemeral", False)
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False)
+    old_lease = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    # A purged queue starts its message ids over, but not its leases
+    response = await http_server_client.fetch("/queues/ephemeral/purge", raise_error=False, method="POST", body="")
+    assert response.code == 202
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "2"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/ephemeral", raise_error=False)
+    lease = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    assert lease != old_lease
+    response = await http_server_client.fetch("/queues/ephemeral/leases/" + old_lease, raise_error=False, method="DELETE")
+    assert response.code == 404
+    # So does a queue after a restart
+    db = tqs.Database(str(tmpdir.join("test.db")))
+    try:
+        tqs.TinyQueueServiceApplication(db, None)
+        queue_id = db.run_sync(tqs.find_queue, "ephemeral")["id"]
+        db.run_sync(tqs.insert_messages, queue_id, [{"body": "3"}], time.time(), queue_id=queue_id)
+        messages = db.run_sync(tqs.receive_messages, queue_id, 1, tqs.DEFAULT_VISIBILITY_TIMEOUT, False, queue_id=queue_id)
+        assert messages[0]["lease_uuid"] != lease
+        assert not db.run_sync(tqs.delete_lease, queue_id, lease, queue_id=queue_id)
+    finally:
+        db.close()
+
+
+async def test_ephemeral_queue_invalid(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test", "durable": "no"}))
+    assert response.code == 400
+
+
+def count_messages(db):
+    return db.execute("select count(*) from messages").fetchone()[0]
+
+
+def run_sql(db, sql):
+    db.execute(sql)
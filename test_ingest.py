@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import pytest
+import tornado.gen
+
+import tqs
+from test_api import app
+
+
+async def create_queue(http_server_client, name="test"):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+    assert response.code == 200
+
+async def get_statistics(http_server_client, name="test"):
+    response = await http_server_client.fetch("/queues/%s/statistics" % name, raise_error=False)
+    assert response.code == 200
+    return json.loads(response.body.decode())
+
+
+async def test_ingest(http_server_client, app):
+    await create_queue(http_server_client)
+    lines = [json.dumps({"body": str(n), "priority": n % 100}) for n in range(2500)]
+    lines[10] = "{nope"
+    lines[20] = json.dumps({"body": "x", "priority": 1000})
+    lines[30] = ""
+    response = await http_server_client.fetch("/queues/test/ingest", raise_error=False, method="POST", body="\n".join(lines))
+    assert response.code == 200
+    assert json.loads(response.body.decode()) == {"accepted": 2497, "rejected": 2,
+                                                  "errors": [{"line": 11, "error": "Invalid JSON"}, {"line": 21, "error": "Invalid message"}]}
+    statistics = await get_statistics(http_server_client)
+    assert statistics["visible"] == 2497
+    response = await http_server_client.fetch("/queues/test?message_count=2", raise_error=False)
+    assert [m["body"] for m in json.loads(response.body.decode())["messages"]] == ["0", "100"]
+
+
+async def test_ingest_stream(http_server_client, app, monkeypatch):
+    monkeypatch.setattr(tqs, "INGEST_BATCH_SIZE", 10)
+    monkeypatch.setattr(tqs, "MAX_INGEST_LINE_LEN", 100)
+    await create_queue(http_server_client)
+    body = "".join(json.dumps({"body": str(n)}) + "\n" for n in range(95))
+    body += json.dumps({"body": "x" * 200}) + "\n" + json.dumps({"body": "last"})
+    # Small chunks split lines, batches are committed while the stream goes on
+    queue_id = (await app.db.read(tqs.find_queue, "test"))["id"]
+    inserted = []
+    async def produce_body(write):
+        for n in range(0, len(body), 7):
+            await write(body[n:n+7].encode())
+            if n % 700 == 0:
+                await tornado.gen.sleep(0.01)
+                inserted.append(app.counters[queue_id].insert_count)
+    response = await http_server_client.fetch("/queues/test/ingest", raise_error=False, method="POST", body_producer=produce_body)
+    assert response.code == 200
+    assert 0 < inserted[len(inserted) // 2] < 96
+    assert json.loads(response.body.decode()) == {"accepted": 96, "rejected": 1, "errors": [{"line": 96, "error": "Line too long"}]}
+    statistics = await get_statistics(http_server_client)
+    assert statistics["visible"] == 96
+
+
+async def test_ingest_not_found(http_server_client, app):
+    response = await http_server_client.fetch("/queues/test/ingest", raise_error=False, method="POST", body=json.dumps({"body": "a"}))
+    assert response.code == 404
@@ -1,9 +1,10 @@
 
 
-import json
+import json, time
 import pytest
+import tornado.gen
 
-
+import tqs
 from test_api import app
 
 
@@ -37,3 +38,165 @@ async def test_delete_lease_404(http_server_client):
     # Delete a lease - queue does not exist
     response = await http_server_client.fetch("/queues/doesnotexist/leases/4b0ea786-838a-4b40-a928-6e146758789b", raise_error=False, method="DELETE")
     assert response.code == 404
+
+
+@pytest.mark.parametrize("returning", [True, False])
+async def test_lease_batch(http_server_client, monkeypatch, returning):
+    if returning and not tqs.SQLITE_RETURNING:
+        pytest.skip("sqlite does not support returning")
+    monkeypatch.setattr(tqs, "SQLITE_RETURNING", returning)
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Put some messages in it
+    messages = [{"body": str(n), "priority": 50 - (n % 3)} for n in range(12)]
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert response.code == 200
+    # Lease a batch, they should come back in priority order with unique leases
+    response = await http_server_client.fetch("/queues/test?message_count=8", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [m["body"] for m in j["messages"]] == ["2", "5", "8", "11", "1", "4", "7", "10"]
+    lease_uuids = [m["lease_uuid"] for m in j["messages"]]
+    assert all(tqs.validate_lease_name(lease_uuid) for lease_uuid in lease_uuids)
+    assert len(set(lease_uuids)) == len(lease_uuids)
+    # Delete the leases
+    for lease_uuid in lease_uuids:
+        response = await http_server_client.fetch("/queues/test/leases/%s" % lease_uuid, raise_error=False, method="DELETE")
+        assert response.code == 200
+    # Receive and delete the rest
+    response = await http_server_client.fetch("/queues/test?message_count=8&delete=1", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [m["body"] for m in j["messages"]] == ["0", "3", "6", "9"]
+    assert all("lease_uuid" not in m for m in j["messages"])
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 0
+
+
+async def test_lease_expiry(http_server_client):
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Put a message in it
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    # Lease it for a second
+    response = await http_server_client.fetch("/queues/test?visibilty_timeout=1", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 1
+    # The message should come back as soon as the lease expires
+    start = time.time()
+    response = await http_server_client.fetch("/queues/test?wait_time=10", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 1
+    assert j["messages"][0]["body"] == "hello"
+    assert time.time() - start < 1.9
+
+
+def test_create_schema_adds_lease_expire_date(tmpdir):
+    # A database created with the schema from before lease_expire_date existed
+    db = tqs.connect_database(str(tmpdir.join("test.db")))
+    db.executescript("""
+        CREATE TABLE queues (id INTEGER PRIMARY KEY AUTOINCREMENT, create_date REAL NOT NULL, name TEXT NOT NULL UNIQUE,
+                             insert_count integer default 0, delete_count integer default 0, expire_count integer default 0);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, create_date REAL NOT NULL, visible_date REAL NOT NULL,
+                               expire_date REAL NOT NULL, body TEXT not null, type TEXT not null, priority int NOT NULL,
+                               lease_date REAL, lease_uuid TEXT UNIQUE, lease_timeout INTEGER,
+                               queue_id INTEGER REFERENCES queues (id) ON DELETE CASCADE);
+        INSERT INTO queues (create_date, name) VALUES (0, 'test');
+        INSERT INTO messages (create_date, visible_date, expire_date, body, type, priority, lease_date, lease_uuid, lease_timeout, queue_id)
+                      VALUES (0, 0, 100, 'hello', 'text/plain', 50, 10, 'f7e35c26-c2aa-49a0-93b6-bf5a6ad6a16c', 30, 1);
+    """)
+    tqs.create_schema(db)
+    assert db.execute("select lease_expire_date from messages").fetchone()[0] == 40
+    counts, next_expire_date = tqs.expire_leases(db, 50)
+    assert counts == {1: 1}
+    assert next_expire_date is None
+
+
+@pytest.mark.parametrize("returning", [True, False])
+async def test_update_leases(http_server_client, monkeypatch, returning):
+    if returning and not tqs.SQLITE_RETURNING:
+        pytest.skip("sqlite does not support returning")
+    monkeypatch.setattr(tqs, "SQLITE_RETURNING", returning)
+    # Create a queue with some messages
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    messages = [{"body": str(n)} for n in range(5)]
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert response.code == 200
+    # Lease them all
+    response = await http_server_client.fetch("/queues/test?message_count=5&visibilty_timeout=2", raise_error=False, method="GET")
+    assert response.code == 200
+    lease_uuids = [m["lease_uuid"] for m in json.loads(response.body.decode())["messages"]]
+    # Delete two, extend one, release two of which one with a delay, and one that does not exist
+    leases = [{"lease_uuid": lease_uuids[0]},
+              {"lease_uuid": lease_uuids[1], "action": "delete"},
+              {"lease_uuid": lease_uuids[2], "action": "extend", "visibility_timeout": 60},
+              {"lease_uuid": lease_uuids[3], "action": "release"},
+              {"lease_uuid": lease_uuids[4], "action": "release", "delay": 60},
+              {"lease_uuid": "4b0ea786-838a-4b40-a928-6e146758789b", "action": "delete"}]
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST", body=json.dumps({"leases": leases}))
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [lease["lease_uuid"] for lease in j["leases"]] == [lease["lease_uuid"] for lease in leases]
+    assert [lease["status"] for lease in j["leases"]] == [200, 200, 200, 200, 200, 404]
+    response = await http_server_client.fetch("/queues/test/statistics", raise_error=False, method="GET")
+    j = json.loads(response.body.decode())
+    assert (j["visible"], j["delayed"], j["leased"], j["total"], j["delete_count"]) == (1, 1, 1, 3, 2)
+    # Only the released message is visible, even after the original leases expired
+    await tornado.gen.sleep(2.5)
+    response = await http_server_client.fetch("/queues/test?message_count=5", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [m["body"] for m in j["messages"]] == ["3"]
+
+
+@pytest.mark.parametrize("returning", [True, False])
+async def test_stale_leases(http_server_client, monkeypatch, returning):
+    if returning and not tqs.SQLITE_RETURNING:
+        pytest.skip("sqlite does not support returning")
+    monkeypatch.setattr(tqs, "SQLITE_RETURNING", returning)
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False)
+    first = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    # A released lease is no longer valid
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST", body=json.dumps({"leases": [{"lease_uuid": first, "action": "release"}]}))
+    assert json.loads(response.body.decode())["leases"] == [{"lease_uuid": first, "status": 200}]
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST", body=json.dumps({"leases": [{"lease_uuid": first, "action": "extend"}]}))
+    assert json.loads(response.body.decode())["leases"] == [{"lease_uuid": first, "status": 404}]
+    # And neither is it once the message is leased again
+    response = await http_server_client.fetch("/queues/test", raise_error=False)
+    second = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    assert second != first
+    response = await http_server_client.fetch("/queues/test/leases/%s" % first, raise_error=False, method="DELETE")
+    assert response.code == 404
+    response = await http_server_client.fetch("/queues/test/leases/cheese", raise_error=False, method="DELETE")
+    assert response.code == 404
+    response = await http_server_client.fetch("/queues/test/leases/%s" % second, raise_error=False, method="DELETE")
+    assert response.code == 200
+
+
+async def test_update_leases_400(http_server_client):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    lease_uuid = "4b0ea786-838a-4b40-a928-6e146758789b"
+    for body in ("", "null", "[]", "{}", '{"leases": null}', '{"leases": [1]}', '{"leases": [{}]}',
+                 json.dumps({"leases": [{"lease_uuid": "cheese"}]}),
+                 json.dumps({"leases": [{"lease_uuid": lease_uuid, "action": "cheese"}]}),
+                 json.dumps({"leases": [{"lease_uuid": lease_uuid, "action": "extend", "visibility_timeout": 0}]}),
+                 json.dumps({"leases": [{"lease_uuid": lease_uuid, "action": "release", "delay": -1}]}),
+                 json.dumps({"leases": [{"lease_uuid": lease_uuid}, {"lease_uuid": lease_uuid}]}),
+                 json.dumps({"leases": [{"lease_uuid": lease_uuid}] * (tqs.MAX_MESSAGE_COUNT + 1)})):
+        response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST", body=body)
+        assert response.code == 400
+    response = await http_server_client.fetch("/queues/doesnotexist/leases", raise_error=False, method="POST", body=json.dumps({"leases": []}))
+    assert response.code == 404
@@ -19,6 +19,22 @@ async def test_post_message(http_server_client):
     response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": []}))
     assert response.code == 200
 
+async def test_post_message_ids(http_server_client):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Post a batch, the ids should come back in the order of the messages
+    messages = [{"body": str(n)} for n in range(tqs.MAX_MESSAGE_COUNT)]
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert response.code == 200
+    ids = [m["id"] for m in json.loads(response.body.decode())["messages"]]
+    assert len(ids) == len(messages)
+    # Receive them all, they should come back in the same order with the same ids
+    response = await http_server_client.fetch("/queues/test?message_count=%d" % tqs.MAX_MESSAGE_COUNT, raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert [m["id"] for m in j["messages"]] == ids
+    assert [m["body"] for m in j["messages"]] == [m["body"] for m in messages]
+
 async def test_post_message_400(http_server_client):
     response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
     assert response.code == 200
@@ -222,3 +238,104 @@ async def test_message_body_encoding(http_server_client, app):
         j = json.loads(response.body.decode())
         assert len(j["messages"]) == 1
         assert j["messages"][0]["body"] == body
+
+
+async def test_wait_time(http_server_client):
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Start a long poll on the empty queue
+    start = time.time()
+    request = http_server_client.fetch("/queues/test?wait_time=10", raise_error=False, method="GET")
+    await tornado.gen.sleep(0.5)
+    # Put a message in it, this should wake up the long poll
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    response = await request
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 1
+    assert j["messages"][0]["body"] == "hello"
+    assert time.time() - start < 2
+
+
+async def test_wait_time_race(http_server_client):
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Put a message in it right after starting a long poll, while the long poll looks for messages
+    for i in range(20):
+        start = time.time()
+        request = http_server_client.fetch("/queues/test?wait_time=2&delete=true", raise_error=False, method="GET")
+        await tornado.gen.sleep(i * 0.0002)
+        response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+        assert response.code == 200
+        response = await request
+        assert response.code == 200
+        assert len(json.loads(response.body.decode())["messages"]) == 1
+        assert time.time() - start < 1
+
+
+async def test_wait_time_timeout(http_server_client):
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Long poll on the empty queue, should return empty handed after wait_time
+    start = time.time()
+    response = await http_server_client.fetch("/queues/test?wait_time=1", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 0
+    assert time.time() - start >= 1
+
+
+async def test_wait_time_delay(http_server_client):
+    # Create a queue
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Put a delayed message in it
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello", "delay": 1}]}))
+    assert response.code == 200
+    # Long poll, should be woken up when the delay has passed
+    start = time.time()
+    response = await http_server_client.fetch("/queues/test?wait_time=10", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 1
+    assert time.time() - start < 2
+
+
+def insert_expired_messages(db, queue_id, count):
+    now = time.time()
+    db.executemany("insert into messages (create_date, visible_date, expire_date, queue_id, body, type, priority) values (?, ?, ?, ?, ?, ?, ?)",
+                   [(now - 120, now - 120, now - 60 + n, queue_id, str(n), "text/plain", 50) for n in range(count)])
+
+
+@pytest.mark.parametrize("returning", [True, False])
+async def test_expire_messages_in_batches(http_server_client, app, monkeypatch, returning):
+    if returning and not tqs.SQLITE_RETURNING:
+        pytest.skip("sqlite does not support returning")
+    monkeypatch.setattr(tqs, "SQLITE_RETURNING", returning)
+    monkeypatch.setattr(tqs, "EXPIRE_MESSAGES_PAUSE", 0.1)
+    # Create a queue with a backlog of expired messages
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    queue = await app.queues.get("test")
+    await app.db.write(insert_expired_messages, queue["id"], 25)
+    app.counters[queue["id"]].total += 25
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    # A run without time budget expires one batch, and continues shortly after
+    callback = tqs.ExpireMessagesCallback(app, batch_size=10, time_budget=0)
+    await callback()
+    response = await http_server_client.fetch("/queues/test/statistics", raise_error=False, method="GET")
+    j = json.loads(response.body.decode())
+    assert (j["total"], j["expire_count"]) == (16, 10)
+    await tornado.gen.sleep(0.5)
+    response = await http_server_client.fetch("/queues/test/statistics", raise_error=False, method="GET")
+    j = json.loads(response.body.decode())
+    assert (j["total"], j["expire_count"]) == (1, 25)
+    # The message that did not expire is still there
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    j = json.loads(response.body.decode())
+    assert [m["body"] for m in j["messages"]] == ["hello"]
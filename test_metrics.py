@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import pytest
+import tornado.gen
+
+import tqs
+from test_api import app
+
+
+async def get_metrics(http_server_client):
+    response = await http_server_client.fetch("/metrics", raise_error=False)
+    assert response.code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in response.body.decode().splitlines():
+        if not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+
+async def test_metrics(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "a"}, {"body": "b"}, {"body": "c"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test?message_count=2", raise_error=False)
+    assert response.code == 200
+    lease_uuid = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    response = await http_server_client.fetch("/queues/test/leases/" + lease_uuid, raise_error=False, method="DELETE")
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/doesnotexist", raise_error=False)
+    assert response.code == 404
+    samples = await get_metrics(http_server_client)
+    assert samples['tqs_queue_messages{queue="test",state="visible"}'] == 1
+    assert samples['tqs_queue_messages{queue="test",state="leased"}'] == 1
+    assert samples['tqs_queue_messages_inserted_total{queue="test"}'] == 3
+    assert samples['tqs_queue_messages_received_total{queue="test"}'] == 2
+    assert samples['tqs_queue_messages_deleted_total{queue="test"}'] == 1
+    assert samples['tqs_queue_waiters{queue="test"}'] == 0
+    assert samples['tqs_http_request_duration_seconds_count{handler="QueueHandler",method="GET",code="200"}'] == 1
+    assert samples['tqs_http_request_duration_seconds_count{handler="QueueHandler",method="GET",code="404"}'] == 1
+    assert samples['tqs_http_request_duration_seconds_bucket{handler="QueueHandler",method="POST",code="200",le="+Inf"}'] == 1
+    assert samples["tqs_database_operations_total"] >= 4
+    assert samples["tqs_database_transaction_seconds_count"] >= 1
+
+
+async def test_metrics_waiters(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    # Park two long polls
+    polls = [http_server_client.fetch("/queues/test?wait_time=5", raise_error=False) for n in range(2)]
+    await tornado.gen.sleep(0.25)
+    samples = await get_metrics(http_server_client)
+    assert samples['tqs_queue_waiters{queue="test"}'] == 2
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "a"}, {"body": "b"}]}))
+    assert response.code == 200
+    for poll in polls:
+        response = await poll
+        assert len(json.loads(response.body.decode())["messages"]) == 1
+    samples = await get_metrics(http_server_client)
+    assert samples['tqs_queue_waiters{queue="test"}'] == 0
+
+
+def test_histogram():
+    histogram = tqs.Histogram([0.1, 1.0])
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(value)
+    buckets, total, count = histogram.snapshot()
+    assert buckets == [(0.1, 2), (1.0, 3), (tqs.math.inf, 4)]
+    assert (total, count) == (5.65, 4)
@@ -3,8 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import json
+import json, threading
 import pytest
+import tornado.gen
+
+import tqs
 from test_api import app
 
 
@@ -68,3 +71,157 @@ async def test_delete_queue(http_server_client):
 async def test_delete_queue_404(http_server_client):
     response = await http_server_client.fetch("/queues/doesnotexist", raise_error=False, method="DELETE")
     assert response.code == 404
+
+
+async def test_delete_queue_recreate(http_server_client):
+    # Create a queue and put a message in it
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "hello"}]}))
+    assert response.code == 200
+    # Delete it, it should be gone for all queue endpoints
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="DELETE")
+    assert response.code == 200
+    for path in ("/queues/test", "/queues/test/statistics"):
+        response = await http_server_client.fetch(path, raise_error=False, method="GET")
+        assert response.code == 404
+    # Create it again, it should be empty
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert response.code == 200
+    j = json.loads(response.body.decode())
+    assert len(j["messages"]) == 0
+
+
+async def post_messages(http_server_client, queue_name, count):
+    for n in range(0, count, 100):
+        messages = [{"body": str(m)} for m in range(n, min(count, n + 100))]
+        response = await http_server_client.fetch("/queues/" + queue_name, raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+        assert response.code == 200
+
+
+async def get_statistics(http_server_client, queue_name):
+    response = await http_server_client.fetch("/queues/%s/statistics" % queue_name, raise_error=False, method="GET")
+    return response.code, json.loads(response.body.decode()) if response.code == 200 else None
+
+
+async def test_purge_queue(http_server_client, app):
+    app.reclaimer.batch_size = 100
+    app.reclaimer.time_budget = 0
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    await post_messages(http_server_client, "test", 250)
+    response = await http_server_client.fetch("/queues/test/purge", raise_error=False, method="POST", body="")
+    assert response.code == 202
+    # The messages are gone right away, the counts carry on
+    code, j = await get_statistics(http_server_client, "test")
+    assert (j["total"], j["insert_count"]) == (0, 250)
+    assert 0 < j["purging"] <= 250
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert json.loads(response.body.decode())["messages"] == []
+    # The queue can still be used
+    await post_messages(http_server_client, "test", 1)
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert [m["body"] for m in json.loads(response.body.decode())["messages"]] == ["0"]
+    # Reclaim the purged messages
+    while app.reclaimer.queues:
+        await app.reclaimer()
+        await tornado.gen.sleep(0.01)
+    code, j = await get_statistics(http_server_client, "test")
+    assert (j["total"], j["insert_count"], j["purging"]) == (1, 251, 0)
+    assert await app.db.write(count_messages) == 1
+    response = await http_server_client.fetch("/queues/doesnotexist/purge", raise_error=False, method="POST", body="")
+    assert response.code == 404
+
+
+async def test_delete_queue_async(http_server_client, app):
+    app.reclaimer.batch_size = 100
+    app.reclaimer.time_budget = 0
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    await post_messages(http_server_client, "test", 250)
+    response = await http_server_client.fetch("/queues/test?async=true", raise_error=False, method="DELETE")
+    assert response.code == 202
+    # The queue is gone right away, but its statistics show the progress
+    response = await http_server_client.fetch("/queues", raise_error=False, method="GET")
+    assert json.loads(response.body.decode())["queues"] == []
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert response.code == 404
+    code, j = await get_statistics(http_server_client, "test")
+    assert code == 200 and j["dropped"] and 0 < j["purging"] <= 250
+    # Retired queues are picked up again on startup
+    assert tqs.TinyQueueServiceApplication(app.db, None).reclaimer.remaining("test") == j["purging"]
+    while app.reclaimer.queues:
+        await app.reclaimer()
+        await tornado.gen.sleep(0.01)
+    code, j = await get_statistics(http_server_client, "test")
+    assert code == 404
+    assert await app.db.write(count_messages) == 0
+    response = await http_server_client.fetch("/queues/test?async=true", raise_error=False, method="DELETE")
+    assert response.code == 404
+
+
+@pytest.mark.parametrize("method, path, body", [("POST", "/queues/test", json.dumps({"messages": [{"body": "new"}]})),
+                                                ("POST", "/queues/test/ingest", json.dumps({"body": "new"})),
+                                                ("GET", "/queues/test", None)])
+async def test_purge_queue_race(http_server_client, app, method, path, body):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    await post_messages(http_server_client, "test", 1)
+    queue_id = (await app.queues.get("test"))["id"]
+    # The request looks up the queue before the purge, and reaches the writer after it
+    event = threading.Event()
+    blocked = app.db.submit(wait_for, event)
+    purge = http_server_client.fetch("/queues/test/purge", raise_error=False, method="POST", body="")
+    while app.db.operations.qsize() < 1:
+        await tornado.gen.sleep(0.001)
+    request = http_server_client.fetch(path, raise_error=False, method=method, body=body)
+    while app.db.operations.qsize() < 2:
+        await tornado.gen.sleep(0.001)
+    event.set()
+    blocked.result()
+    assert (await purge).code == 202
+    response = await request
+    assert response.code == 200
+    # Nothing went into or came out of the purged queue, the request ran on the new one
+    assert queue_id not in app.counters
+    while app.reclaimer.queues:
+        await app.reclaimer()
+        await tornado.gen.sleep(0.01)
+    code, j = await get_statistics(http_server_client, "test")
+    if method == "GET":
+        assert json.loads(response.body.decode())["messages"] == []
+        assert (j["total"], j["insert_count"]) == (0, 1)
+    else:
+        assert (j["total"], j["insert_count"]) == (1, 2)
+        assert await app.db.write(count_messages) == 1
+
+
+async def test_delete_queue_async_race(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    queue_id = (await app.queues.get("test"))["id"]
+    event = threading.Event()
+    blocked = app.db.submit(wait_for, event)
+    delete = http_server_client.fetch("/queues/test?async=true", raise_error=False, method="DELETE")
+    while app.db.operations.qsize() < 1:
+        await tornado.gen.sleep(0.001)
+    request = http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "new"}]}))
+    while app.db.operations.qsize() < 2:
+        await tornado.gen.sleep(0.001)
+    event.set()
+    blocked.result()
+    assert (await delete).code == 202
+    # A queue that is deleted is not found
+    assert (await request).code == 404
+    assert queue_id not in app.counters
+    assert await app.db.write(count_messages) == 0
+
+
+def wait_for(db, event):
+    event.wait()
+
+
+def count_messages(db):
+    return db.execute("select count(*) from messages").fetchone()[0]
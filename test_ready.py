@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import pytest
+import tornado.gen, tornado.ioloop
+
+import tqs
+
+
+#
+# The same application, with the ready messages index
+#
+
+@pytest.fixture
+def app(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")))
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None, ready_index=True)
+    tornado.ioloop.PeriodicCallback(app.lease_reaper, 1000).start()
+    tornado.ioloop.PeriodicCallback(tqs.ExpireMessagesCallback(app), 1000).start()
+    yield app
+    db.close()
+
+
+async def create_queue(http_server_client, app, messages):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert response.code == 200
+    return (await app.queues.get("test"))["id"]
+
+
+async def receive(http_server_client, message_count=1):
+    response = await http_server_client.fetch("/queues/test?message_count=%d" % message_count, raise_error=False)
+    assert response.code == 200
+    return json.loads(response.body.decode())["messages"]
+
+
+async def test_ready_priority(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1", "priority": 50}, {"body": "2", "priority": 10}, {"body": "3"}, {"body": "4", "priority": 10}])
+    assert len(app.ready[queue_id]) == 4
+    messages = await receive(http_server_client, 3)
+    assert [m["body"] for m in messages] == ["2", "4", "1"]
+    assert len(app.ready[queue_id]) == 1
+    # Released messages go back in the index, in their original place
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST",
+                                              body=json.dumps({"leases": [{"lease_uuid": messages[0]["lease_uuid"], "action": "release"}]}))
+    assert response.code == 200
+    assert [m["body"] for m in await receive(http_server_client, 2)] == ["2", "3"]
+
+
+async def test_ready_delay(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1", "delay": 1}, {"body": "2"}])
+    assert [m["body"] for m in await receive(http_server_client, 2)] == ["2"]
+    assert len(app.ready[queue_id].delayed) == 1
+    await tornado.gen.sleep(1.1)
+    assert [m["body"] for m in await receive(http_server_client, 2)] == ["1"]
+    assert len(app.ready[queue_id]) == 0
+
+
+async def test_ready_lease_expiry(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1"}, {"body": "2"}])
+    assert len(await receive(http_server_client, 2)) == 2
+    assert len(app.ready[queue_id]) == 0
+    await app.db.write(run_sql, "update messages set lease_expire_date = 0 where body = '1'")
+    await app.lease_reaper()
+    assert len(app.ready[queue_id]) == 1
+    assert [m["body"] for m in await receive(http_server_client)] == ["1"]
+
+
+async def test_ready_stale_ids(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1"}, {"body": "2"}, {"body": "3"}])
+    # Messages that expired or were deleted behind the index's back are skipped
+    await app.db.write(run_sql, "update messages set expire_date = 0 where body = '1'")
+    await app.db.write(run_sql, "delete from messages where body = '2'")
+    assert [m["body"] for m in await receive(http_server_client, 2)] == ["3"]
+    assert len(app.ready[queue_id]) == 0
+    assert await receive(http_server_client) == []
+
+
+async def test_ready_load(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1", "priority": 20}, {"body": "2", "priority": 10}, {"body": "3", "delay": 600}])
+    assert len(await receive(http_server_client)) == 1
+    # The index is loaded at startup, without the leased messages
+    ready = tqs.TinyQueueServiceApplication(app.db, None, ready_index=True).ready
+    assert [m[2] for m in ready[queue_id].visible] == [app.ready[queue_id].visible[0][2]]
+    assert len(ready[queue_id].delayed) == 1
+    assert tqs.TinyQueueServiceApplication(app.db, None).ready is None
+
+
+async def test_ready_purge(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "1"}, {"body": "2"}])
+    response = await http_server_client.fetch("/queues/test/purge", raise_error=False, method="POST", body="")
+    assert response.code == 202
+    assert queue_id not in app.ready
+    assert await receive(http_server_client) == []
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "3"}]}))
+    assert response.code == 200
+    assert [m["body"] for m in await receive(http_server_client)] == ["3"]
+
+
+async def test_ready_expired_ids(http_server_client, app):
+    queue_id = await create_queue(http_server_client, app, [{"body": "old"} for n in range(2000)])
+    # The index drops expired messages without asking the writer
+    await app.db.write(run_sql, "update messages set expire_date = 0")
+    ready = app.ready[queue_id]
+    ready.visible = [message[:3] + (0,) for message in ready.visible]
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "new"} for n in range(5000)]}))
+    assert response.code == 200
+    operations = app.db.operation_count
+    assert [m["body"] for m in await receive(http_server_client)] == ["new"]
+    assert app.db.operation_count - operations == 1
+    assert len(ready) == 4999
+    # Deleted messages cost one operation for a window of ids
+    await app.db.write(run_sql, "delete from messages where id in (select id from messages where body = 'new' and lease_date is null order by id limit 5)")
+    operations = app.db.operation_count
+    assert len(await receive(http_server_client, 2)) == 2
+    assert app.db.operation_count - operations == 1
+    assert len(ready) == 4999 - 7
+
+
+def run_sql(db, sql):
+    db.execute(sql)
@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import time
+import pytest
+
+import tqs
+
+
+# The schema as it was before migrations, with its redundant indexes
+LEGACY_SCHEMA = """
+CREATE TABLE queues (id INTEGER PRIMARY KEY AUTOINCREMENT, create_date REAL NOT NULL, name TEXT NOT NULL UNIQUE,
+                     insert_count integer default 0, delete_count integer default 0, expire_count integer default 0, drop_date REAL);
+CREATE UNIQUE INDEX queues_id ON queues (id);
+CREATE UNIQUE INDEX queues_name ON queues (name);
+CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, create_date REAL NOT NULL, visible_date REAL NOT NULL,
+                       expire_date REAL NOT NULL, body TEXT not null, type TEXT not null, priority int NOT NULL,
+                       lease_date REAL, lease_uuid TEXT UNIQUE, lease_timeout INTEGER, lease_expire_date REAL,
+                       queue_id INTEGER REFERENCES queues (id) ON DELETE CASCADE);
+CREATE UNIQUE INDEX messages_id ON messages (id);
+CREATE INDEX messages_queue_id ON messages (queue_id);
+CREATE INDEX messages_create_date ON messages (create_date);
+CREATE INDEX messages_lease_date ON messages (lease_date);
+CREATE UNIQUE INDEX messages_lease_uuid ON messages (lease_uuid);
+CREATE INDEX messages_queue_id_lease_date_create_date ON messages (queue_id, lease_date, create_date);
+CREATE INDEX messages_queue_id_lease_date_priority_create_date ON messages (queue_id, lease_date, priority, create_date);
+CREATE INDEX messages_queue_id_lease_uuid ON messages (queue_id, lease_uuid);
+CREATE INDEX messages_lease_expire_date ON messages (lease_expire_date) WHERE lease_expire_date IS NOT NULL;
+CREATE INDEX messages_expire_date ON messages (expire_date);
+INSERT INTO queues (id, create_date, name) VALUES (1, 0, 'test');
+INSERT INTO messages (create_date, visible_date, expire_date, body, type, priority, queue_id) VALUES (0, 0, 1e12, 'hello', 'text/plain', 50, 1);
+"""
+
+
+def schema(db):
+    tables = {}
+    for row in db.execute("select type, name, tbl_name from sqlite_master where name not like 'sqlite_%' order by name"):
+        if row["type"] == "table":
+            tables[row["name"]] = [tuple(column) for column in db.execute("PRAGMA table_info(%s)" % row["name"])]
+        else:
+            tables[row["name"]] = (row["tbl_name"], [column["name"] for column in db.execute("PRAGMA index_info(%s)" % row["name"])],
+                                   db.execute("select sql like '%where%' from sqlite_master where name = ?", [row["name"]]).fetchone()[0])
+    return tables
+
+
+def test_new_database():
+    db = tqs.connect_database(":memory:")
+    tqs.create_schema(db)
+    assert tqs.schema_version(db) == tqs.SCHEMA_VERSION
+    indexes = [row[0] for row in db.execute("select name from sqlite_master where type = 'index' and name not like 'sqlite_%' order by name")]
+    assert indexes == ["messages_expire_date", "messages_lease_expire_date", "messages_queue_id", "messages_ready"]
+    # Running it again does nothing
+    before = schema(db)
+    tqs.create_schema(db)
+    assert schema(db) == before
+
+
+def test_migrate_legacy_database(tmpdir):
+    db = tqs.connect_database(str(tmpdir.join("test.db")))
+    db.executescript(LEGACY_SCHEMA)
+    assert tqs.schema_version(db) == 0
+    tqs.create_schema(db)
+    assert tqs.schema_version(db) == tqs.SCHEMA_VERSION
+    # A migrated database ends up with the schema of a new one, and keeps its messages
+    new = tqs.connect_database(":memory:")
+    tqs.create_schema(new)
+    assert schema(db) == schema(new)
+    assert [m["body"] for m in tqs.receive_messages(db, 1, 10, tqs.DEFAULT_VISIBILITY_TIMEOUT, False)] == ["hello"]
+
+
+def test_migrate_leases(tmpdir):
+    db = tqs.connect_database(str(tmpdir.join("test.db")))
+    db.executescript(LEGACY_SCHEMA)
+    db.execute("update messages set lease_date = 0, lease_uuid = 'f7e35c26-c2aa-49a0-93b6-bf5a6ad6a16c', lease_timeout = 30, lease_expire_date = 30")
+    db.execute("insert into messages (create_date, visible_date, expire_date, body, type, priority, queue_id) values (0, 0, 1e12, 'deleted', 'text/plain', 50, 1)")
+    db.execute("delete from messages where body = 'deleted'")
+    tqs.create_schema(db)
+    # The message is still leased, but its uuid is not found
+    assert tqs.update_leases(db, 1, [{"lease_uuid": "f7e35c26-c2aa-49a0-93b6-bf5a6ad6a16c"}], time.time()) == {("delete", None): []}
+    counts, next_expire_date = tqs.expire_leases(db, 50)
+    assert counts == {1: 1}
+    # Ids of deleted messages are not used again
+    assert tqs.insert_messages(db, 1, [{"body": "new"}], time.time()) == [3]
+
+
+def test_migrate_from_version(tmpdir):
+    db = tqs.connect_database(str(tmpdir.join("test.db")))
+    db.executescript(LEGACY_SCHEMA)
+    tqs.add_missing_columns(db)
+    db.execute("PRAGMA user_version = 1")
+    tqs.create_schema(db)
+    assert tqs.schema_version(db) == tqs.SCHEMA_VERSION
+    assert "messages_queue_id_lease_uuid" not in schema(db)
+
+
+@pytest.mark.parametrize("sql", [tqs.READY_MESSAGES_SQL, "delete from messages" + tqs.leases_where(1, 0, [tqs.format_lease(1, 0, 1 << 24 | 1), tqs.format_lease(1, 0, 2 << 24 | 1)])[0],
+                                 "update messages set lease_date = null where lease_expire_date < ?", tqs.EXPIRED_MESSAGES_SQL])
+def test_queries_use_indexes(sql):
+    db = tqs.connect_database(":memory:")
+    tqs.create_schema(db)
+    plan = [row[3] for row in db.execute("explain query plan " + sql, [0] * sql.count("?"))]
+    assert all(step.startswith("SEARCH") for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+async def test_migrate_queue_file(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), queue_directory=str(tmpdir.join("queues")))
+    try:
+        db.run_sync(tqs.create_schema)
+        queue_id = await db.write(tqs.create_queue, "test", time.time())
+        # A queue file from before migrations is upgraded when it is opened
+        conn = tqs.connect_database(db.queue_path(queue_id))
+        conn.executescript(LEGACY_SCHEMA.replace("VALUES (1, 0, 'test')", "VALUES (%d, 0, 'test')" % queue_id).replace(", 1);", ", %d);" % queue_id))
+        conn.close()
+        messages = await db.write(tqs.receive_messages, queue_id, 10, tqs.DEFAULT_VISIBILITY_TIMEOUT, False, queue_id=queue_id)
+        assert [m["body"] for m in messages] == ["hello"]
+        assert await db.write(tqs.schema_version, queue_id=queue_id) == tqs.SCHEMA_VERSION
+    finally:
+        db.close()
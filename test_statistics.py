@@ -3,9 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import json
+import json, time
 import pytest
+import tornado.gen
 
+import tqs
 from test_api import app
 
 
@@ -40,3 +42,50 @@ async def test_queue_statistics(http_server_client):
         for f in ("visible", "leased", "delayed"):
             assert f in j
             assert type(j[f]) == int
+
+
+async def test_queue_statistics_counts(http_server_client, app):
+    r = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert r.code == 200
+    # Post two visible messages and a delayed one
+    messages = [{"body": "a"}, {"body": "b"}, {"body": "c", "delay": 60}]
+    r = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert r.code == 200
+    # Lease one of them
+    r = await http_server_client.fetch("/queues/test", raise_error=False, method="GET")
+    assert r.code == 200
+    lease_uuid = json.loads(r.body.decode())["messages"][0]["lease_uuid"]
+    r = await http_server_client.fetch("/queues/test/statistics", raise_error=False, method="GET")
+    assert r.code == 200
+    j = json.loads(r.body.decode())
+    assert (j["visible"], j["delayed"], j["leased"], j["total"]) == (1, 1, 1, 3)
+    assert (j["insert_count"], j["delete_count"], j["expire_count"]) == (3, 0, 0)
+    # Delete the lease
+    r = await http_server_client.fetch("/queues/test/leases/%s" % lease_uuid, raise_error=False, method="DELETE")
+    assert r.code == 200
+    r = await http_server_client.fetch("/queues/test/statistics", raise_error=False, method="GET")
+    assert r.code == 200
+    j = json.loads(r.body.decode())
+    assert (j["visible"], j["delayed"], j["leased"], j["total"]) == (1, 1, 0, 2)
+    assert (j["insert_count"], j["delete_count"], j["expire_count"]) == (3, 1, 0)
+    # The counters are loaded from the database on startup
+    counters = app.db.run_sync(tqs.load_queue_counters)
+    for queue_id, queue_counters in app.counters.items():
+        assert counters[queue_id].statistics(time.time()) == queue_counters.statistics(time.time())
+
+
+async def test_queue_statistics_delays(http_server_client, app):
+    r = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert r.code == 200
+    # A batch of messages with the same delay takes one entry
+    messages = [{"body": str(n), "delay": 1} for n in range(10)] + [{"body": "a", "delay": 600}]
+    r = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": messages}))
+    assert r.code == 200
+    counters = app.counters[(await app.queues.get("test"))["id"]]
+    assert (len(counters.delays), counters.delayed) == (2, 11)
+    # Delays that are over are dropped without asking for statistics
+    await tornado.gen.sleep(1.1)
+    for n in range(10):
+        r = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "b", "delay": 600}]}))
+        assert r.code == 200
+    assert (len(counters.delays), counters.delayed) == (11, 11)
@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json, os, time
+import pytest
+import tornado.gen, tornado.ioloop
+
+import tqs
+
+
+#
+# The same application, with a database file for every queue
+#
+
+@pytest.fixture
+def app(tmpdir):
+    db = tqs.Database(str(tmpdir.join("test.db")), queue_directory=str(tmpdir.join("queues")), queue_connections=2)
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None)
+    tornado.ioloop.PeriodicCallback(app.lease_reaper, 1000).start()
+    tornado.ioloop.PeriodicCallback(tqs.ExpireMessagesCallback(app), 1000).start()
+    yield app
+    db.close()
+
+
+async def test_queue_files(http_server_client, app, tmpdir):
+    names = ["test%d" % n for n in range(4)]
+    for name in names:
+        response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": name}))
+        assert response.code == 200
+        response = await http_server_client.fetch("/queues/" + name, raise_error=False, method="POST", body=json.dumps({"messages": [{"body": name}, {"body": name}]}))
+        assert response.code == 200
+    # Every queue has a file, but only a few of them are kept open
+    queue_ids = [(await app.queues.get(name))["id"] for name in names]
+    for queue_id in queue_ids:
+        assert os.path.exists(app.db.queue_path(queue_id))
+    assert len(app.db.storage) == 2
+    # Messages and leases end up in the file of their queue
+    for name in names:
+        response = await http_server_client.fetch("/queues/" + name, raise_error=False)
+        assert response.code == 200
+        j = json.loads(response.body.decode())
+        assert [m["body"] for m in j["messages"]] == [name]
+        response = await http_server_client.fetch("/queues/%s/leases/%s" % (name, j["messages"][0]["lease_uuid"]), raise_error=False, method="DELETE")
+        assert response.code == 200
+    assert await app.db.write(count_messages) == 0
+    assert await app.db.write(count_messages, queue_id=queue_ids[0]) == 1
+    response = await http_server_client.fetch("/queues/test0/statistics", raise_error=False)
+    j = json.loads(response.body.decode())
+    assert (j["total"], j["insert_count"], j["delete_count"]) == (1, 2, 1)
+    # Deleting a queue removes its file
+    response = await http_server_client.fetch("/queues/test0", raise_error=False, method="DELETE")
+    assert response.code == 200
+    assert not os.path.exists(app.db.queue_path(queue_ids[0]))
+    response = await http_server_client.fetch("/queues/test1", raise_error=False, method="DELETE")
+    assert response.code == 200
+    assert not os.path.exists(app.db.queue_path(queue_ids[1]))
+    with pytest.raises(tqs.sqlite3.IntegrityError):
+        await app.db.write(count_messages, queue_id=queue_ids[0])
+    # Counters are loaded from the queue files
+    counters = tqs.TinyQueueServiceApplication(app.db, None).counters
+    assert sorted(counters) == queue_ids[2:]
+    assert counters[queue_ids[2]].statistics(time.time())["insert_count"] == 2
+
+
+async def test_queue_files_expiry(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}, {"body": "2"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test?message_count=2", raise_error=False)
+    assert response.code == 200
+    queue = await app.queues.get("test")
+    # Leases expire per queue file
+    await app.db.write(run_sql, "update messages set lease_expire_date = 0 where body = '1'", queue_id=queue["id"])
+    await app.lease_reaper()
+    assert app.counters[queue["id"]].leased == 1
+    # And so do messages
+    await app.db.write(run_sql, "update messages set expire_date = 0 where body = '1'", queue_id=queue["id"])
+    await tqs.ExpireMessagesCallback(app)()
+    assert app.counters[queue["id"]].total == 1
+    assert app.counters[queue["id"]].expire_count == 1
+    assert await app.db.write(count_messages, queue_id=queue["id"]) == 1
+
+
+async def test_queue_files_purge(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}, {"body": "2"}]}))
+    assert response.code == 200
+    queue = await app.queues.get("test")
+    response = await http_server_client.fetch("/queues/test/purge", raise_error=False, method="POST", body="")
+    assert response.code == 202
+    while app.reclaimer.queues:
+        await app.reclaimer()
+        await tornado.gen.sleep(0.01)
+    # The purged queue file is removed, the new one continues the counts
+    assert not os.path.exists(app.db.queue_path(queue["id"]))
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "3"}]}))
+    assert response.code == 200
+    new_queue = await app.queues.get("test")
+    counters = tqs.TinyQueueServiceApplication(app.db, None).counters
+    assert counters[new_queue["id"]].statistics(time.time())["insert_count"] == 3
+    assert await app.db.write(count_messages, queue_id=new_queue["id"]) == 1
+
+
+@pytest.mark.parametrize("method, path", [("POST", "/queues/test/purge"), ("DELETE", "/queues/test")])
+async def test_queue_files_stale_leases(http_server_client, app, method, path):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "1"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False)
+    old_lease = json.loads(response.body.decode())["messages"][0]["lease_uuid"]
+    response = await http_server_client.fetch(path, raise_error=False, method=method, body="" if method == "POST" else None)
+    assert response.code in (200, 202)
+    if method == "DELETE":
+        response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+        assert response.code == 200
+    # The new queue file starts its message ids over, but not its leases
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "2"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False)
+    messages = json.loads(response.body.decode())["messages"]
+    assert [m["body"] for m in messages] == ["2"]
+    assert messages[0]["lease_uuid"] != old_lease
+    response = await http_server_client.fetch("/queues/test/leases/" + old_lease, raise_error=False, method="DELETE")
+    assert response.code == 404
+    response = await http_server_client.fetch("/queues/test/leases", raise_error=False, method="POST", body=json.dumps({"leases": [{"lease_uuid": old_lease}]}))
+    assert json.loads(response.body.decode())["leases"] == [{"lease_uuid": old_lease, "status": 404}]
+    response = await http_server_client.fetch("/queues/test/statistics", raise_error=False)
+    assert json.loads(response.body.decode())["leased"] == 1
+
+
+def count_messages(db):
+    return db.execute("select count(*) from messages").fetchone()[0]
+
+
+def run_sql(db, sql):
+    db.execute(sql)
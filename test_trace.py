@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json, logging
+import pytest
+
+import tqs
+
+
+@pytest.fixture
+def app(tmpdir, request):
+    tracing = getattr(request, "param", True)
+    db = tqs.Database(str(tmpdir.join("test.db")), readers=2, tracer=tqs.Tracer(None) if tracing else None)
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None)
+    yield app
+    db.close()
+
+
+def find_statement(statements, prefix, operation):
+    return next(s for s in statements if s["sql"].startswith(prefix) and s["operation"] == operation)
+
+
+async def test_trace_sql(http_server_client, app):
+    response = await http_server_client.fetch("/queues", raise_error=False, method="POST", body=json.dumps({"name": "test"}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test", raise_error=False, method="POST", body=json.dumps({"messages": [{"body": "a"}, {"body": "b"}, {"body": "c"}]}))
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues/test?message_count=2", raise_error=False)
+    assert response.code == 200
+    response = await http_server_client.fetch("/queues", raise_error=False)
+    assert response.code == 200
+    response = await http_server_client.fetch("/admin/sql?limit=100&sort=count", raise_error=False)
+    assert response.code == 200
+    statements = json.loads(response.body.decode())["statements"]
+    counts = [s["count"] for s in statements]
+    assert counts == sorted(counts, reverse=True)
+    insert = find_statement(statements, "insert into messages", "insert_messages")
+    assert insert["handler"] == "QueueHandler"
+    assert (insert["count"], insert["rows"], insert["errors"]) == (1, 3, 0)
+    assert insert["max_time"] <= insert["time"] and insert["mean_time"] == insert["time"]
+    receive = max((s for s in statements if s["operation"] == "receive_messages"), key=lambda s: s["rows"])
+    assert receive["handler"] == "QueueHandler" and receive["rows"] == 2
+    # Transactions are not part of an operation
+    commit = find_statement(statements, "commit", None)
+    assert commit["handler"] is None and commit["count"] >= 3
+    # Read on a reader thread
+    queues = find_statement(statements, "select", "list_queues")
+    assert queues["handler"] == "QueuesHandler" and queues["rows"] == 1
+    # Reset
+    response = await http_server_client.fetch("/admin/sql", raise_error=False, method="DELETE")
+    assert response.code == 200
+    response = await http_server_client.fetch("/admin/sql", raise_error=False)
+    assert json.loads(response.body.decode())["statements"] == []
+
+
+async def test_trace_sql_invalid(http_server_client, app):
+    for query in ("limit=0", "limit=abc", "sort=name"):
+        response = await http_server_client.fetch("/admin/sql?" + query, raise_error=False)
+        assert response.code == 400
+
+
+@pytest.mark.parametrize("app", [False], indirect=True)
+async def test_trace_sql_disabled(http_server_client, app):
+    response = await http_server_client.fetch("/admin/sql", raise_error=False)
+    assert response.code == 404
+
+
+def test_slow_query_log(caplog):
+    db = tqs.connect_database(":memory:", tracer=tqs.Tracer(0))
+    tqs.create_schema(db)
+    with caplog.at_level(logging.WARNING):
+        db.execute("select * from messages where queue_id = ? and priority in (?, ?, ?)", [1, 10, 20, 30]).fetchall()
+    record = caplog.records[-1]
+    assert record.getMessage().startswith("Slow query")
+    assert "where queue_id = ? and priority in (?, ...)" in record.getMessage()
+    assert "USING INDEX" in record.getMessage()
+
+
+def test_normalize_statement():
+    assert tqs.normalize_statement("select id\n  from messages where id in (?,?, ?)") == "select id from messages where id in (?, ...)"
@@ -3,15 +3,29 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import datetime, json, logging, os, re, sys, sqlite3, time, uuid
+import asyncio, bisect, collections, concurrent.futures, datetime, heapq, itertools, json, logging, math, os, queue, re, sys, sqlite3, threading, time, uuid, zlib
 
-from tornado.gen import coroutine, sleep
-from tornado.web import Application, RequestHandler, URLSpec
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.concurrent import Future
+from tornado.gen import coroutine, multi, TimeoutError
+from tornado.locks import Condition, Event
+from tornado.queues import Queue
+from tornado.web import Application, RequestHandler, URLSpec, stream_request_body
+from tornado.websocket import WebSocketHandler, WebSocketClosedError, websocket_connect
 from tornado import httpserver
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode
 from tornado.options import parse_command_line, options, define
 from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 MIN_QUEUE_NAME_LEN = 1
@@ -22,7 +36,9 @@ def validate_queue_name(v):
     return type(v) == str and len(v) >= MIN_QUEUE_NAME_LEN and len(v) <= MAX_QUEUE_NAME_LEN and QUEUE_NAME_RE.match(v) is not None
 
 
-LEASE_NAME_RE = re.compile(r"^[a-f0-9]{8}(?:-[a-f0-9]{4}){3}-[a-f0-9]{12}$")
+# Leases are hex integers, see format_lease. The uuids that leases used
+# to be are still valid, they are just never found.
+LEASE_NAME_RE = re.compile(r"^(?:[a-f0-9]{1,40}|[a-f0-9]{8}(?:-[a-f0-9]{4}){3}-[a-f0-9]{12})$")
 
 def validate_lease_name(v):
     return type(v) == str and LEASE_NAME_RE.match(v) is not None
@@ -80,12 +96,41 @@ def validate_message_priority(v):
     return type(v) == int and v >= MIN_MESSAGE_PRIORITY and v <= MAX_MESSAGE_PRIORITY
 
 
+# A message as it is posted, with its optional fields
+def validate_message(v):
+    return (type(v) == dict and "body" in v and validate_message_body(v["body"])
+            and ("type" not in v or validate_message_type(v["type"]))
+            and ("delay" not in v or validate_message_delay(v["delay"]))
+            and ("retention" not in v or validate_message_retention(v["retention"]))
+            and ("priority" not in v or validate_message_priority(v["priority"])))
+
+
+DEFAULT_DURABLE = True
+
+def validate_durable(v):
+    return type(v) == bool
+
+
 DEFAULT_DELETE = False
 
 def validate_delete(v):
     return v in ("1", "true", "yes")
 
 
+DEFAULT_LEASE_ACTION = "delete"
+VALID_LEASE_ACTIONS = ["delete", "extend", "release"]
+
+def validate_lease_action(v):
+    return type(v) == str and v in VALID_LEASE_ACTIONS
+
+# A lease update as it is posted, with its optional fields
+def validate_lease(v):
+    return (type(v) == dict and "lease_uuid" in v and validate_lease_name(v["lease_uuid"])
+            and ("action" not in v or validate_lease_action(v["action"]))
+            and ("visibility_timeout" not in v or validate_visibility_timeout(v["visibility_timeout"]))
+            and ("delay" not in v or validate_message_delay(v["delay"])))
+
+
 DEFAULT_WAIT_TIME = 0
 MIN_WAIT_TIME = 0
 MAX_WAIT_TIME = 60
@@ -94,6 +139,993 @@ def validate_wait_time(v):
     return type(v) == int and v >= MIN_WAIT_TIME and v <= MAX_WAIT_TIME
 
 
+#
+# Histogram counts observations, like request durations, in buckets for
+# the /metrics endpoint. Observations can come from the writer thread.
+#
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    # Returns the cumulative counts per upper bound, the sum and the count
+    def snapshot(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = list(itertools.accumulate(counts))
+        return list(zip(self.buckets + [math.inf], cumulative)), total, cumulative[-1]
+
+DATABASE_DURATION_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+
+#
+# Tracer records every SQL statement that runs on a traced connection:
+# how often it ran, how long it took, how many rows it touched and which
+# handler or callback submitted the operation that ran it. Statements are
+# aggregated by their text, with the placeholder lists of IN clauses
+# collapsed. Statements that take longer than the slow query time are
+# logged with their query plan.
+#
+# The time of a statement is the time of its first step, which is where
+# SQLite sorts, groups and writes. Rows that are fetched afterwards are
+# added to its row count. Tracing is off unless --trace-sql is given, a
+# traced connection is quite a bit slower.
+#
+
+DEFAULT_SLOW_QUERY_TIME = 100
+DEFAULT_TRACE_LIMIT = 20
+VALID_TRACE_SORTS = ["time", "max_time", "count", "rows"]
+
+TRACE_PLACEHOLDERS_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+TRACE_WHITESPACE_RE = re.compile(r"\s+")
+# Statements that have a query plan
+TRACE_EXPLAIN_STATEMENTS = ["select", "insert", "update", "delete", "replace", "with"]
+
+def normalize_statement(sql):
+    return TRACE_PLACEHOLDERS_RE.sub("?, ...", TRACE_WHITESPACE_RE.sub(" ", sql).strip())
+
+class Tracer:
+
+    def __init__(self, slow_query_time=DEFAULT_SLOW_QUERY_TIME / 1000.0):
+        self.slow_query_time = slow_query_time
+        self.statements = {}
+        self.lock = threading.Lock()
+        # The handler and operation that the current thread is running
+        self.local = threading.local()
+
+    # The handler or callback that is submitting an operation, found on the stack
+    def caller(self):
+        frame = sys._getframe(1)
+        while frame is not None:
+            caller = frame.f_locals.get("self")
+            if caller is not None and not isinstance(caller, (Database, Tracer)):
+                return type(caller).__name__
+            frame = frame.f_back
+        return None
+
+    def start(self, handler, fn):
+        self.local.origin = (handler, getattr(fn, "__name__", None))
+
+    def stop(self):
+        self.local.origin = (None, None)
+
+    def record(self, conn, sql, parameters, duration, rows, error):
+        handler, operation = getattr(self.local, "origin", (None, None))
+        key = (normalize_statement(sql), handler, operation)
+        with self.lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                statement = self.statements[key] = {"sql": key[0], "handler": handler, "operation": operation,
+                                                    "count": 0, "errors": 0, "time": 0.0, "max_time": 0.0, "rows": 0}
+            statement["count"] += 1
+            statement["errors"] += error
+            statement["time"] += duration
+            statement["max_time"] = max(statement["max_time"], duration)
+            statement["rows"] += max(rows, 0)
+        if self.slow_query_time is not None and duration >= self.slow_query_time:
+            logging.warning("Slow query (%.1fms, %d rows%s): %s%s", duration * 1000, max(rows, 0),
+                            ", %s.%s" % (handler, operation) if operation else "", key[0],
+                            "".join("\n  " + line for line in self.explain(conn, sql, parameters)))
+        return key
+
+    def fetched(self, key, rows):
+        with self.lock:
+            self.statements[key]["rows"] += rows
+
+    def explain(self, conn, sql, parameters):
+        if sql.split(None, 1)[0].lower() not in TRACE_EXPLAIN_STATEMENTS:
+            return []
+        try:
+            # A plain cursor, so that the plan itself is not traced
+            return [row[-1] for row in sqlite3.Cursor(conn).execute("explain query plan " + sql, parameters)]
+        except sqlite3.Error as e:
+            return ["(no query plan: %s)" % e]
+
+    # The statements that took the most time, or the ones that ran most often, ...
+    def top(self, limit=DEFAULT_TRACE_LIMIT, sort="time"):
+        with self.lock:
+            statements = [dict(statement) for statement in self.statements.values()]
+        for statement in statements:
+            statement["mean_time"] = statement["time"] / statement["count"]
+        return sorted(statements, key=lambda statement: statement[sort], reverse=True)[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+
+class TracingCursor(sqlite3.Cursor):
+
+    trace = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = super().execute(sql, parameters)
+            error = False
+            return result
+        finally:
+            self.trace = self.connection.tracer.record(self.connection, sql, parameters, time.perf_counter() - start, self.rowcount, error)
+
+    def executemany(self, sql, seq_of_parameters):
+        # The first parameters are kept to explain the statement
+        seq_of_parameters = iter(seq_of_parameters)
+        first = next(seq_of_parameters, ())
+        start = time.perf_counter()
+        error = True
+        try:
+            result = super().executemany(sql, itertools.chain([first], seq_of_parameters) if first != () else [])
+            error = False
+            return result
+        finally:
+            self.trace = self.connection.tracer.record(self.connection, sql, first, time.perf_counter() - start, self.rowcount, error)
+
+    def fetched(self, rows):
+        if self.trace is not None and rows:
+            self.connection.tracer.fetched(self.trace, rows)
+
+    def fetchone(self):
+        row = super().fetchone()
+        self.fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.fetched(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self.fetched(1)
+        return row
+
+class TracingConnection(sqlite3.Connection):
+
+    tracer = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+#
+# Database runs all SQLite work on a dedicated writer thread so that slow
+# statements and fsyncs never block the IOLoop. There is only one writer,
+# so database operations are still executed serially. Optional reader
+# threads, each with their own connection, serve read-only operations.
+#
+# Operations are plain functions that take a connection as their first
+# argument. Each operation runs in its own savepoint, and operations that
+# are queued up together share one transaction and one commit. With a
+# group commit window the writer waits a little for more operations to
+# arrive before it commits. Results are only handed back after the
+# commit, so a response is never sent for a write that is not durable.
+#
+# With a queue directory every queue keeps its messages in a database
+# file of its own, with the same schema and a copy of its queue record.
+# The main database is then just the catalog of queues. Operations that
+# are submitted for a queue run on the connection of its file, a bounded
+# number of those connections is kept open, least recently used first.
+# An operation never spans files, so committing the files of a batch one
+# after another keeps every operation atomic. Deleting a queue removes
+# its file once the deletion is committed.
+#
+# Queues that are not durable keep their messages in an in-memory
+# database of their own, whatever the storage of the other queues. They
+# are opened when the queue is created or the server starts, and their
+# messages are lost on restart. Each one can grow to at most
+# ephemeral_queue_size bytes, inserting more fails with SQLITE_FULL.
+# Their operations are committed one by one, as SQLite may roll back a
+# whole transaction when it is full.
+#
+# In WAL mode every commit is appended to the write-ahead log, and pages
+# are copied back to their place in the database by a checkpoint, which
+# SQLite runs in the committing connection whenever the log has grown by
+# 1000 pages. With a checkpoint interval a checkpointer thread does that
+# on connections of its own, so that the writer mostly appends to the log
+# and the random writes to the B-trees happen next to it. Checkpoints of
+# the checkpointer are passive, they never wait for the writer or for
+# readers, but they cannot catch up with a writer that keeps committing:
+# the log only starts over once a checkpoint copied all of it back. So
+# the writer still checkpoints when its log passes CHECKPOINT_WAL_PAGES,
+# and the log is truncated back to that size when it starts over. With
+# an mmap size, pages are read through memory-mapped files instead of
+# copied into the page cache.
+#
+
+# Log size at which the writer checkpoints even with a checkpointer
+CHECKPOINT_WAL_PAGES = 10000
+
+VALID_JOURNAL_MODES = ["delete", "truncate", "persist", "memory", "wal", "off"]
+VALID_SYNCHRONOUS = ["off", "normal", "full", "extra"]
+
+# Upper bound on the number of operations that share a commit
+GROUP_COMMIT_MAX_OPERATIONS = 256
+
+DEFAULT_QUEUE_CONNECTIONS = 64
+
+DEFAULT_EPHEMERAL_QUEUE_SIZE = 64 * 1024 * 1024
+
+DEFAULT_MMAP_SIZE = 0
+DEFAULT_CHECKPOINT_INTERVAL = 0
+
+def connect_database(path, journal_mode=None, synchronous=None, tracer=None, mmap_size=DEFAULT_MMAP_SIZE):
+    db = sqlite3.connect(path, isolation_level=None, factory=TracingConnection if tracer else sqlite3.Connection)
+    if tracer:
+        db.tracer = tracer
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA foreign_keys = ON")
+    if journal_mode:
+        if journal_mode not in VALID_JOURNAL_MODES:
+            raise ValueError("Invalid journal mode: %s" % journal_mode)
+        db.execute("PRAGMA journal_mode = " + journal_mode)
+    if synchronous:
+        if synchronous not in VALID_SYNCHRONOUS:
+            raise ValueError("Invalid synchronous level: %s" % synchronous)
+        db.execute("PRAGMA synchronous = " + synchronous)
+    if mmap_size:
+        db.execute("PRAGMA mmap_size = %d" % mmap_size)
+    return db
+
+#
+# Schema migrations. tqs.sql creates the current schema in a new
+# database. Existing databases are upgraded by the migrations after the
+# version in their PRAGMA user_version, in order, in the transaction that
+# create_schema runs in. Databases from before migrations existed are at
+# version 0. Queue files are upgraded when they are opened.
+#
+
+# Columns that were added before migrations existed
+def add_missing_columns(db):
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(messages)")]
+    if "lease_expire_date" not in columns:
+        db.execute("alter table messages add column lease_expire_date REAL")
+        db.execute("update messages set lease_expire_date = lease_date + lease_timeout where lease_date is not null")
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(queues)")]
+    if "drop_date" not in columns:
+        db.execute("alter table queues add column drop_date REAL")
+    if "durable" not in columns:
+        db.execute("alter table queues add column durable integer not null default 1")
+
+# Indexes that duplicate a primary key or unique constraint, or that no
+# query uses, are dropped. Ready messages are found with a partial index
+# that leaves out the leased ones.
+def drop_redundant_indexes(db):
+    for name in ("queues_id", "queues_name", "messages_id", "messages_create_date", "messages_lease_date", "messages_lease_uuid",
+                 "messages_queue_id_lease_date_create_date", "messages_queue_id_lease_date_priority_create_date", "messages_queue_id_lease_uuid"):
+        db.execute("drop index if exists " + name)
+    db.execute("create index if not exists messages_queue_id on messages (queue_id)")
+    db.execute("create index if not exists messages_ready on messages (queue_id, priority, create_date) where lease_date is null")
+    db.execute("create index if not exists messages_lease_expire_date on messages (lease_expire_date) where lease_expire_date is not null")
+    db.execute("create index if not exists messages_expire_date on messages (expire_date)")
+
+# Leases are no longer uuids in a unique column, but the message id and a
+# lease count packed together. SQLite cannot drop a unique column, so the
+# table is rebuilt without lease_uuid, keeping the AUTOINCREMENT sequence
+# so that ids are not used again. Messages that are leased keep their
+# lease, their uuid is no longer found.
+def replace_lease_uuids(db):
+    sequence = db.execute("select seq from sqlite_sequence where name = 'messages'").fetchone()
+    db.execute("""create table messages_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    create_date REAL NOT NULL,
+                    visible_date REAL NOT NULL,
+                    expire_date REAL NOT NULL,
+                    body TEXT not null,
+                    type TEXT not null,
+                    priority int NOT NULL,
+                    lease_date REAL,
+                    lease_count INTEGER NOT NULL DEFAULT 0,
+                    lease_timeout INTEGER,
+                    lease_expire_date REAL,
+                    queue_id INTEGER REFERENCES queues (id) ON DELETE CASCADE)""")
+    db.execute("insert into messages_new (id, create_date, visible_date, expire_date, body, type, priority, lease_date, lease_count, lease_timeout, lease_expire_date, queue_id)"
+               " select id, create_date, visible_date, expire_date, body, type, priority, lease_date, lease_date is not null, lease_timeout, lease_expire_date, queue_id from messages")
+    db.execute("drop table messages")
+    db.execute("alter table messages_new rename to messages")
+    if sequence is not None:
+        db.execute("update sqlite_sequence set seq = max(seq, ?) where name = 'messages'", [sequence[0]])
+    db.execute("create index messages_queue_id on messages (queue_id)")
+    db.execute("create index messages_ready on messages (queue_id, priority, create_date) where lease_date is null")
+    db.execute("create index messages_lease_expire_date on messages (lease_expire_date) where lease_expire_date is not null")
+    db.execute("create index messages_expire_date on messages (expire_date)")
+
+# Lease names carry the generation of the storage of a queue, see
+# format_lease
+def add_queue_generations(db):
+    db.execute("alter table queues add column generation integer not null default 0")
+
+MIGRATIONS = [add_missing_columns, drop_redundant_indexes, replace_lease_uuids, add_queue_generations]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+# Statements are executed one by one, executescript would commit the
+# transaction that the operation runs in.
+def create_schema(db):
+    version = schema_version(db)
+    if version == 0 and db.execute("select count(*) from sqlite_master where name = 'messages'").fetchone()[0] == 0:
+        with open(os.path.join(os.path.dirname(__file__), "tqs.sql"), "r") as f:
+            statement = ""
+            for line in f:
+                statement += line
+                if sqlite3.complete_statement(statement):
+                    db.execute(statement)
+                    statement = ""
+    else:
+        for n, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info("Migrating database to version %d: %s", n, migration.__name__)
+            migration(db)
+    db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+class Database:
+
+    def __init__(self, path, readers=0, journal_mode=None, synchronous=None, group_commit=0, queue_directory=None, queue_connections=DEFAULT_QUEUE_CONNECTIONS, tracer=None,
+                 ephemeral_queue_size=DEFAULT_EPHEMERAL_QUEUE_SIZE, mmap_size=DEFAULT_MMAP_SIZE, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.tracer = tracer
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.group_commit = group_commit
+        self.queue_directory = queue_directory
+        self.queue_connections = queue_connections
+        self.ephemeral_queue_size = ephemeral_queue_size
+        self.mmap_size = mmap_size
+        self.checkpoint_interval = checkpoint_interval if journal_mode == "wal" else 0
+        if queue_directory is not None:
+            os.makedirs(queue_directory, exist_ok=True)
+        # Only used by the writer thread
+        self.storage = collections.OrderedDict()
+        self.memory = {}
+        self.removals = []
+        self.commits = 0
+        # Writer statistics, for /metrics
+        self.operation_count = 0
+        self.operation_errors = 0
+        self.operation_wait = Histogram(DATABASE_DURATION_BUCKETS)
+        self.commit_duration = Histogram(DATABASE_DURATION_BUCKETS)
+        self.checkpoints = 0
+        self.checkpoint_duration = Histogram(DATABASE_DURATION_BUCKETS)
+        self.operations = queue.Queue()
+        self.writer = threading.Thread(target=self.run, name="tqs-writer", daemon=True)
+        self.writer.start()
+        # Queue files are not removed while they are checkpointed
+        self.files_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.checkpointer = None
+        if self.checkpoint_interval:
+            self.checkpointer = threading.Thread(target=self.run_checkpoints, name="tqs-checkpointer", daemon=True)
+            self.checkpointer.start()
+        self.local = threading.local()
+        self.readers = None
+        # An in-memory database only exists for the connection that created it
+        if readers and path != ":memory:":
+            self.readers = ThreadPoolExecutor(readers, thread_name_prefix="tqs-reader")
+
+    def connect(self, path=None):
+        db = connect_database(path or self.path, self.journal_mode, self.synchronous, self.tracer, self.mmap_size)
+        if self.checkpoint_interval:
+            db.execute("PRAGMA wal_autocheckpoint = %d" % CHECKPOINT_WAL_PAGES)
+            page_size = db.execute("PRAGMA page_size").fetchone()[0]
+            db.execute("PRAGMA journal_size_limit = %d" % (CHECKPOINT_WAL_PAGES * page_size))
+        return db
+
+    def queue_path(self, queue_id):
+        return os.path.join(self.queue_directory, "%d.sqlite3" % queue_id)
+
+    # Returns the connection that holds the messages of a queue. A queue
+    # file is created when it is first used, as long as the queue exists.
+    def connection(self, db, queue_id):
+        if queue_id is None:
+            return db
+        conn = self.memory.get(queue_id)
+        if conn is not None:
+            return conn
+        if self.queue_directory is None:
+            return db
+        conn = self.storage.get(queue_id)
+        if conn is not None:
+            self.storage.move_to_end(queue_id)
+            return conn
+        path = self.queue_path(queue_id)
+        conn = self.connect(path) if os.path.exists(path) else None
+        # A file that is missing, or whose initialization did not finish, is created from the catalog
+        if conn is None or conn.execute("select count(*) from sqlite_master").fetchone()[0] == 0:
+            queue = db.execute("select id, create_date, name, insert_count, delete_count, expire_count, generation from queues where id = ?", [queue_id]).fetchone()
+            if queue is None:
+                if conn is not None:
+                    conn.close()
+                raise sqlite3.IntegrityError("Queue %d does not exist" % queue_id)
+            if conn is None:
+                conn = self.connect(path)
+            self.initialize_queue(conn, queue)
+        elif schema_version(conn) < SCHEMA_VERSION:
+            self.upgrade_queue(conn)
+        self.storage[queue_id] = conn
+        return conn
+
+    def upgrade_queue(self, conn):
+        conn.execute("begin immediate")
+        try:
+            create_schema(conn)
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            conn.close()
+            raise
+
+    # Creates the schema and the queue record in the database of a queue
+    def initialize_queue(self, conn, queue):
+        conn.execute("begin immediate")
+        try:
+            create_schema(conn)
+            conn.execute("insert into queues (id, create_date, name, insert_count, delete_count, expire_count, generation) values (?, ?, ?, ?, ?, ?, ?)", list(queue))
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            conn.close()
+            raise
+
+    # An operation that opens the in-memory database of a queue that is not
+    # durable, in a new generation so that its message ids can start over
+    def open_ephemeral_queue(self, db, queue_id):
+        if queue_id in self.memory:
+            return
+        db.execute("update queues set generation = generation + 1 where id = ?", [queue_id])
+        queue = db.execute("select id, create_date, name, insert_count, delete_count, expire_count, generation from queues where id = ?", [queue_id]).fetchone()
+        if queue is None:
+            raise sqlite3.IntegrityError("Queue %d does not exist" % queue_id)
+        conn = connect_database(":memory:", tracer=self.tracer)
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        conn.execute("PRAGMA max_page_count = %d" % max(1, self.ephemeral_queue_size // page_size))
+        self.initialize_queue(conn, queue)
+        self.memory[queue_id] = conn
+
+    def run(self):
+        db = self.connect()
+        while True:
+            operation = self.operations.get()
+            if operation is None:
+                break
+            operations = [operation]
+            deadline = time.monotonic() + self.group_commit
+            while len(operations) < GROUP_COMMIT_MAX_OPERATIONS:
+                timeout = deadline - time.monotonic()
+                try:
+                    operation = self.operations.get(timeout=timeout) if timeout > 0 else self.operations.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is None:
+                    # Stop after this batch
+                    self.operations.put(None)
+                    break
+                operations.append(operation)
+            self.commit(db, operations)
+        for conn in list(self.storage.values()) + list(self.memory.values()):
+            conn.close()
+        db.close()
+
+    def commit(self, db, operations):
+        started = time.monotonic()
+        operations = [operation for operation in operations if operation[0].set_running_or_notify_cancel()]
+        for operation in operations:
+            self.operation_wait.observe(started - operation[4])
+        results = []
+        # Connections with an open transaction, in the order they joined the batch
+        connections = []
+        try:
+            if self.queue_directory is None:
+                db.execute("begin immediate")
+                connections.append(db)
+            for future, fn, args, queue_id, submitted, origin, live in operations:
+                try:
+                    if live:
+                        check_live_queue(db, queue_id)
+                    conn = self.connection(db, queue_id)
+                except Exception as e:
+                    results.append((future, None, None, e))
+                    continue
+                # Commits in memory are cheap, and SQLITE_FULL may roll back the whole transaction
+                if queue_id is not None and self.memory.get(queue_id) is conn:
+                    conn.execute("begin immediate")
+                    try:
+                        results.append((future, conn, self.call(origin, fn, conn, args), None))
+                        conn.execute("commit")
+                    except Exception as e:
+                        if conn.in_transaction:
+                            conn.execute("rollback")
+                        results.append((future, conn, None, e))
+                    continue
+                if conn not in connections:
+                    conn.execute("begin immediate")
+                    connections.append(conn)
+                conn.execute("savepoint operation")
+                try:
+                    results.append((future, conn, self.call(origin, fn, conn, args), None))
+                    conn.execute("release operation")
+                except Exception as e:
+                    conn.execute("rollback to operation")
+                    conn.execute("release operation")
+                    results.append((future, conn, None, e))
+            while connections:
+                connections[0].execute("commit")
+                connections.pop(0)
+            self.commits += 1
+        except Exception as e:
+            for conn in connections:
+                if conn.in_transaction:
+                    conn.execute("rollback")
+            # Operations on files that were committed before the failure stand
+            done = {future for future, conn, result, error in results if conn is not None and conn not in connections}
+            results = [r for r in results if r[0] in done] + [(future, None, None, e) for future, fn, args, queue_id, submitted, origin, live in operations if future not in done]
+            self.removals = []
+        for queue_id in self.removals:
+            self.remove_queue_file(queue_id)
+        self.removals = []
+        while len(self.storage) > self.queue_connections:
+            self.storage.popitem(last=False)[1].close()
+        self.commit_duration.observe(time.monotonic() - started)
+        self.operation_count += len(results)
+        self.operation_errors += sum(1 for r in results if r[3] is not None)
+        for future, conn, result, e in results:
+            if e is not None:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def remove_queue_file(self, queue_id):
+        conn = self.memory.pop(queue_id, None)
+        if conn is not None:
+            conn.close()
+            return
+        conn = self.storage.pop(queue_id, None)
+        if conn is not None:
+            conn.close()
+        path = self.queue_path(queue_id)
+        with self.files_lock:
+            for p in (path, path + "-journal", path + "-wal", path + "-shm"):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def run_checkpoints(self):
+        while not self.stopping.wait(self.checkpoint_interval):
+            paths = [self.path]
+            if self.queue_directory is not None:
+                paths += [os.path.join(self.queue_directory, name[:-4]) for name in os.listdir(self.queue_directory) if name.endswith(".sqlite3-wal")]
+            for path in paths:
+                try:
+                    self.checkpoint(path)
+                except Exception as e:
+                    logging.error("Cannot checkpoint %s: %s", path, e)
+
+    # Copies what is in the log of a database back into the database. Logs
+    # that are empty, or gone because the last connection closed, are skipped.
+    def checkpoint(self, path):
+        with self.files_lock:
+            if not os.path.exists(path + "-wal") or os.path.getsize(path + "-wal") == 0:
+                return
+            started = time.monotonic()
+            db = sqlite3.connect(path, isolation_level=None)
+            try:
+                db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            finally:
+                db.close()
+        self.checkpoints += 1
+        self.checkpoint_duration.observe(time.monotonic() - started)
+
+    # An operation that removes the file of a deleted queue after the commit
+    def remove_queue(self, db, queue_id):
+        if self.queue_directory is not None or queue_id in self.memory:
+            self.removals.append(queue_id)
+
+    def submit(self, fn, *args, queue_id=None, live=False):
+        future = concurrent.futures.Future()
+        origin = self.tracer.caller() if self.tracer else None
+        self.operations.put((future, fn, args, queue_id, time.monotonic(), origin, live))
+        return future
+
+    def execute(self, origin, fn, *args):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = self.connect()
+        # A read transaction gives the operation a consistent snapshot
+        db.execute("begin")
+        try:
+            return self.call(origin, fn, db, args)
+        finally:
+            db.execute("rollback")
+
+    # Statements that an operation runs are traced as coming from origin
+    def call(self, origin, fn, db, args):
+        if self.tracer is None:
+            return fn(db, *args)
+        self.tracer.start(origin, fn)
+        try:
+            return fn(db, *args)
+        finally:
+            self.tracer.stop()
+
+    # Operations for a queue are passed its queue_id, so that they run on
+    # the file of that queue. Live operations fail with IntegrityError once
+    # their queue was retired, see check_live_queue.
+    def write(self, fn, *args, queue_id=None, live=False):
+        return asyncio.wrap_future(self.submit(fn, *args, queue_id=queue_id, live=live))
+
+    def read(self, fn, *args):
+        if self.readers is None:
+            return self.write(fn, *args)
+        origin = self.tracer.caller() if self.tracer else None
+        return asyncio.wrap_future(self.readers.submit(self.execute, origin, fn, *args))
+
+    def run_sync(self, fn, *args, queue_id=None):
+        return self.submit(fn, *args, queue_id=queue_id).result()
+
+    # The queues whose messages are stored separately, or None for all
+    # queues when they share the main database
+    def storages(self, queue_ids):
+        if self.queue_directory is None:
+            return [None] + [queue_id for queue_id in queue_ids if queue_id in self.memory]
+        return list(queue_ids)
+
+    def close(self):
+        self.stopping.set()
+        if self.checkpointer is not None:
+            self.checkpointer.join()
+        self.operations.put(None)
+        self.writer.join()
+        if self.readers:
+            self.readers.shutdown()
+
+
+# Delayed messages that become visible close together share one wakeup
+WAKEUP_RESOLUTION = 0.01
+
+
+#
+# Waiters keeps track of long-polling GET requests that are parked on a
+# queue. Instead of polling the database, requests wait until they are
+# notified that messages may have become available. Every notification
+# bumps the generation of the queue, a request that read the generation
+# before looking for messages does not park if it has changed since, so
+# that messages posted while it was looking are not missed.
+#
+
+class Waiters:
+
+    def __init__(self):
+        self.conditions = {}
+        self.wakeups = {}
+        self.generations = {}
+        # Number of parked requests per queue
+        self.waiting = collections.Counter()
+
+    def generation(self, queue_id):
+        return self.generations.get(queue_id, 0)
+
+    def wait(self, queue_id, timeout, generation=None):
+        if generation is not None and generation != self.generation(queue_id):
+            # Notified since the caller looked for messages
+            future = Future()
+            future.set_result(True)
+            return future
+        condition = self.conditions.get(queue_id)
+        if condition is None:
+            condition = self.conditions[queue_id] = Condition()
+        future = condition.wait(timeout=datetime.timedelta(seconds=timeout))
+        self.waiting[queue_id] += 1
+        future.add_done_callback(lambda f: self.done_waiting(queue_id))
+        return future
+
+    def done_waiting(self, queue_id):
+        self.waiting[queue_id] -= 1
+        if self.waiting[queue_id] <= 0:
+            del self.waiting[queue_id]
+
+    def notify(self, queue_id, n=1):
+        self.generations[queue_id] = self.generation(queue_id) + 1
+        condition = self.conditions.get(queue_id)
+        if condition is not None:
+            condition.notify(n)
+
+    def notify_all(self):
+        for queue_id in self.generations:
+            self.generations[queue_id] += 1
+        for condition in self.conditions.values():
+            condition.notify_all()
+
+    def notify_at(self, queue_id, when, n=1):
+        when = math.ceil(when / WAKEUP_RESOLUTION) * WAKEUP_RESOLUTION
+        key = (queue_id, when)
+        if key in self.wakeups:
+            self.wakeups[key] += n
+            return
+        self.wakeups[key] = n
+        IOLoop.current().call_later(max(0, when - time.time()), self.wakeup, key)
+
+    def wakeup(self, key):
+        self.notify(key[0], self.wakeups.pop(key))
+
+    def discard(self, queue_id):
+        # Parked requests find out that their queue is gone
+        self.generations.pop(queue_id, None)
+        condition = self.conditions.pop(queue_id, None)
+        if condition is not None:
+            condition.notify_all()
+
+    def move(self, queue_id, new_queue_id):
+        # Parked requests of a purged queue now wait for its replacement
+        self.generations[queue_id] = self.generation(queue_id) + 1
+        condition = self.conditions.pop(queue_id, None)
+        if condition is not None:
+            self.conditions[new_queue_id] = condition
+
+
+#
+# QueueCounters keeps the message counts of a queue up to date as messages
+# are inserted, leased, deleted and expired, so that statistics never have
+# to count rows. Delayed messages are tracked in a heap of the dates on
+# which they stop being delayed. Expired messages count as visible until
+# ExpireMessagesCallback has deleted them.
+#
+
+class QueueCounters:
+
+    def __init__(self, insert_count=0, delete_count=0, expire_count=0):
+        self.total = 0
+        self.leased = 0
+        self.delayed = 0
+        self.delays = []
+        self.insert_count = insert_count
+        self.delete_count = delete_count
+        self.expire_count = expire_count
+        # Only kept since startup
+        self.receive_count = 0
+        self.lease_expire_count = 0
+
+    # Delays that are over are dropped here too, so that the heap does not
+    # grow when nobody asks for statistics
+    def delay(self, until, n=1):
+        self.end_delays(time.time())
+        heapq.heappush(self.delays, (until, n))
+        self.delayed += n
+
+    def end_delays(self, now):
+        while self.delays and self.delays[0][0] <= now:
+            self.delayed -= heapq.heappop(self.delays)[1]
+
+    def statistics(self, now):
+        self.end_delays(now)
+        return {
+            "visible": max(0, self.total - self.leased - self.delayed),
+            "delayed": self.delayed,
+            "leased": self.leased,
+            "total": self.total,
+            "insert_count": self.insert_count,
+            "delete_count": self.delete_count,
+            "expire_count": self.expire_count,
+        }
+
+def load_queue_counters(db):
+    counters = collections.defaultdict(QueueCounters)
+    for queue in db.execute("select id, insert_count, delete_count, expire_count from queues"):
+        counters[queue["id"]] = QueueCounters(queue["insert_count"], queue["delete_count"], queue["expire_count"])
+    # Both counts come from an index, leased messages are the ones with a lease_expire_date
+    for row in db.execute("select queue_id, count(*) from messages group by queue_id"):
+        counters[row[0]].total = row[1]
+    for row in db.execute("select queue_id, count(*) from messages where lease_expire_date is not null group by queue_id"):
+        counters[row[0]].leased = row[1]
+    # A message that expires before its delay is over is no longer delayed once it expires
+    now = time.time()
+    for row in db.execute("select queue_id, min(visible_date, expire_date), count(*) from messages where lease_date is null and visible_date > ? group by 1, 2", [now]):
+        counters[row[0]].delay(row[1], row[2])
+    return counters
+
+
+#
+# With --ready-index the ids of the messages that are not leased are kept
+# in memory per queue, so that receiving does not have to look for them
+# in the messages table. Visible messages are in a heap by priority,
+# create_date and id, the order in which they are received. Delayed
+# messages are in a heap by the date on which they become visible. The
+# index is loaded at startup and kept up to date, like QueueCounters, as
+# messages are inserted, received, released and returned by the lease
+# reaper.
+#
+# The messages table stays the truth. Receiving only leases the ids that
+# the index hands out if they are still ready. The index knows when its
+# messages expire and drops those itself. Ids of messages that were
+# deleted since are dropped when receiving finds them gone, and a queue
+# whose index collects too many of those is loaded again.
+#
+
+# A queue is loaded again when its index has this many more ids than twice its messages
+READY_INDEX_SLACK = 1000
+
+# Receiving looks at this many times more ids than it needs, so that ids
+# that are gone do not each cost a round trip to the writer
+READY_INDEX_WINDOW = 4
+
+class ReadyMessages:
+
+    def __init__(self, visible=None, delayed=None):
+        self.visible = visible or []
+        self.delayed = delayed or []
+
+    def add(self, message_id, priority, create_date, visible_date, expire_date, now):
+        if visible_date > now:
+            heapq.heappush(self.delayed, (visible_date, priority, create_date, message_id, expire_date))
+        else:
+            heapq.heappush(self.visible, (priority, create_date, message_id, expire_date))
+
+    # Takes the first n visible messages that have not expired out, as
+    # (priority, create_date, id, expire_date)
+    def take(self, n, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            visible_date, priority, create_date, message_id, expire_date = heapq.heappop(self.delayed)
+            heapq.heappush(self.visible, (priority, create_date, message_id, expire_date))
+        messages = []
+        while self.visible and len(messages) < n:
+            message = heapq.heappop(self.visible)
+            if message[3] >= now:
+                messages.append(message)
+        return messages
+
+    # Puts messages back that were taken but not received
+    def put_back(self, messages):
+        for message in messages:
+            heapq.heappush(self.visible, message)
+
+    def __len__(self):
+        return len(self.visible) + len(self.delayed)
+
+def load_ready_messages(db, queue_id=None):
+    now = time.time()
+    sql = "select queue_id, id, priority, create_date, visible_date, expire_date from messages where lease_date is null and expire_date >= ?"
+    params = [now]
+    if queue_id is not None:
+        sql += " and queue_id = ?"
+        params.append(queue_id)
+    index = collections.defaultdict(ReadyMessages)
+    for row in db.execute(sql, params):
+        messages = index[row[0]]
+        if row[4] > now:
+            messages.delayed.append((row[4], row[2], row[3], row[1], row[5]))
+        else:
+            messages.visible.append((row[2], row[3], row[1], row[5]))
+    for messages in index.values():
+        heapq.heapify(messages.visible)
+        heapq.heapify(messages.delayed)
+    return index
+
+
+#
+# QueueCache keeps queue records, including their settings, by name so
+# that requests do not have to look up their queue in the database. The
+# counters are not part of the record, those live in QueueCounters.
+#
+
+QUEUE_COLUMNS = "id, name, create_date, durable"
+
+def find_queue(db, name):
+    row = db.execute("select " + QUEUE_COLUMNS + " from queues where name = ? and drop_date is null", [name]).fetchone()
+    return dict(row) if row is not None else None
+
+class QueueCache:
+
+    def __init__(self, db):
+        self.db = db
+        self.queues = {}
+        self.generation = 0
+
+    @coroutine
+    def get(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            generation = self.generation
+            queue = yield self.db.read(find_queue, name)
+            # Do not cache a queue that was created or deleted while we were looking
+            if queue is not None and generation == self.generation:
+                self.queues[name] = queue
+        return queue
+
+    def invalidate(self, name):
+        self.queues.pop(name, None)
+        self.generation += 1
+
+
+#
+# Cluster describes the workers of a multi-process TQS. Queues are hash
+# partitioned over the workers and every worker owns the queues in its
+# own shard database. Requests for a queue that another worker owns are
+# forwarded to the internal port of that worker, views over all queues
+# are gathered from all workers.
+#
+# Forwarded requests carry a secret that is shared by the workers, so
+# that clients cannot bypass the partitioning.
+#
+
+FORWARDED_HEADER = "X-TQS-Forwarded"
+FORWARDED_SKIP_HEADERS = ["Host", "Content-Length", "Transfer-Encoding", "Connection", FORWARDED_HEADER]
+FORWARD_TIMEOUT = MAX_WAIT_TIME + 30
+# The proxy of a WebSocket makes its own handshake
+FORWARDED_SKIP_WEBSOCKET_HEADERS = FORWARDED_SKIP_HEADERS + ["Upgrade", "Origin", "Sec-WebSocket-Key", "Sec-WebSocket-Version", "Sec-WebSocket-Extensions"]
+
+def shard_database_path(path, worker_id):
+    root, ext = os.path.splitext(path)
+    return "%s-%d%s" % (root, worker_id, ext)
+
+class Cluster:
+
+    def __init__(self, worker_id, ports, secret):
+        self.worker_id = worker_id
+        self.ports = ports
+        self.secret = secret
+
+    def shard(self, queue_name):
+        return zlib.crc32(queue_name.encode()) % len(self.ports)
+
+    def others(self):
+        return [shard for shard in range(len(self.ports)) if shard != self.worker_id]
+
+    def headers(self, request, skip=FORWARDED_SKIP_HEADERS):
+        headers = {name: value for name, value in request.headers.get_all() if name not in skip}
+        headers[FORWARDED_HEADER] = self.secret
+        return headers
+
+    def connect(self, shard, request):
+        return websocket_connect(HTTPRequest("ws://127.0.0.1:%d%s" % (self.ports[shard], request.uri),
+                                             headers=self.headers(request, FORWARDED_SKIP_WEBSOCKET_HEADERS)))
+
+    # A streamed request body is forwarded as it arrives with a body_producer
+    def fetch(self, shard, request, body_producer=None, request_timeout=FORWARD_TIMEOUT):
+        headers = self.headers(request)
+        body = request.body if request.method in ("POST", "PUT", "PATCH") and body_producer is None else None
+        return AsyncHTTPClient().fetch(HTTPRequest("http://127.0.0.1:%d%s" % (self.ports[shard], request.uri), method=request.method,
+                                                   headers=headers, body=body, body_producer=body_producer,
+                                                   request_timeout=request_timeout), raise_error=False)
+
+
 #
 # HomeHandler
 #
@@ -122,63 +1154,482 @@ class BaseHandler(RequestHandler):
         if self.application.api_token and self.request.headers.get("Authentication") != "token " + self.application.api_token:
             self.send_error(401)
 
+    def is_forwarded(self):
+        cluster = self.application.cluster
+        return cluster is not None and self.request.headers.get(FORWARDED_HEADER) == cluster.secret
+
+    # Returns the worker that owns the queue, or None if that is us
+    def remote_shard(self, queue_name):
+        cluster = self.application.cluster
+        if cluster is None or self._finished or self.is_forwarded():
+            return None
+        shard = cluster.shard(queue_name)
+        return shard if shard != cluster.worker_id else None
+
+    @coroutine
+    def forward(self, shard):
+        yield self.relay(shard, self.application.cluster.fetch(shard, self.request))
+
+    # Sends the response of another worker as ours
+    @coroutine
+    def relay(self, shard, fetch):
+        try:
+            response = yield fetch
+        except Exception as e:
+            logging.error("Cannot forward request to worker %d: %s", shard, e)
+            self.send_error(502)
+            return
+        self.set_status(response.code)
+        if "Content-Type" in response.headers:
+            self.set_header("Content-Type", response.headers["Content-Type"])
+        self.finish(response.body)
+
+    # Returns the decoded responses of all other workers to this request
+    @coroutine
+    def gather(self):
+        cluster = self.application.cluster
+        if cluster is None or self.is_forwarded():
+            return []
+        responses = yield multi([cluster.fetch(shard, self.request) for shard in cluster.others()])
+        for response in responses:
+            response.rethrow()
+        return [json_decode(response.body) for response in responses]
+
+#
+# Codecs encode and decode the bodies of the message and lease endpoints,
+# which are a list of items under a key like "messages". JSON is the
+# default. Clients pick another codec with Accept for responses and
+# Content-Type for requests. Newline-delimited JSON has one item per line
+# and no key, MessagePack is only available when the msgpack package is
+# installed. Both carry dates as seconds since the epoch instead of ISO
+# strings.
+#
+
+class JSONCodec:
+
+    content_type = "application/json; charset=UTF-8"
+    numeric_dates = False
+
+    def encode(self, key, items):
+        return json_encode({key: items})
+
+    def decode(self, key, body):
+        data = json_decode(body)
+        if type(data) != dict or key not in data or type(data[key]) != list:
+            raise ValueError("Expected a list of %s" % key)
+        return data[key]
+
+class NDJSONCodec:
+
+    content_type = "application/x-ndjson"
+    numeric_dates = True
+
+    def encode(self, key, items):
+        return "".join(json.dumps(item) + "\n" for item in items)
+
+    def decode(self, key, body):
+        return [json_decode(line) for line in body.split(b"\n") if line.strip()]
+
+class MessagePackCodec(JSONCodec):
+
+    content_type = "application/msgpack"
+    numeric_dates = True
+
+    def encode(self, key, items):
+        return msgpack.packb({key: items}, use_bin_type=True)
+
+    def decode(self, key, body):
+        data = msgpack.unpackb(body, raw=False)
+        if type(data) != dict or key not in data or type(data[key]) != list:
+            raise ValueError("Expected a list of %s" % key)
+        return data[key]
+
+DEFAULT_CODEC = JSONCodec()
+
+CODECS = {"application/json": DEFAULT_CODEC, "application/x-ndjson": NDJSONCodec()}
+if msgpack is not None:
+    CODECS["application/msgpack"] = CODECS["application/x-msgpack"] = MessagePackCodec()
+
+# The codec for an Accept header, in order of preference, or None if none
+# of the accepted types is supported
+def accept_codec(accept):
+    if not accept:
+        return DEFAULT_CODEC
+    ranges = []
+    for n, media_range in enumerate(accept.split(",")):
+        media_type, _, parameters = media_range.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((-quality, n, media_type.strip().lower()))
+    for quality, n, media_type in sorted(ranges):
+        if quality == 0:
+            break
+        if media_type in CODECS:
+            return CODECS[media_type]
+        if media_type in ("*/*", "application/*"):
+            return DEFAULT_CODEC
+    return None
+
+# Requests without a Content-Type that we know are JSON, like they always were
+def content_type_codec(content_type):
+    return CODECS.get(content_type.partition(";")[0].strip().lower(), DEFAULT_CODEC)
+
+def format_numeric_date(ts):
+    return ts
+
+#
+# QueueBaseHandler looks up the queue of requests for /queues/<name>/...
+#
+
+class QueueBaseHandler(BaseHandler):
+
+    @coroutine
+    def prepare(self):
+        super().prepare()
+        shard = self.remote_shard(self.path_args[0])
+        if shard is not None:
+            yield self.forward(shard)
+            return
+        self.queue = yield self.application.queues.get(self.path_args[0])
+        if not self.queue:
+            self.queue_not_found(self.path_args[0])
+
+    def queue_not_found(self, queue_name):
+        self.send_error(404)
+
+    # The codec for the response, sends a 406 if there is none
+    def response_codec(self):
+        codec = accept_codec(self.request.headers.get("Accept"))
+        if codec is None:
+            self.send_error(406)
+        return codec
+
+    def decode_items(self, key):
+        return content_type_codec(self.request.headers.get("Content-Type", "")).decode(key, self.request.body)
+
+    def write_items(self, codec, key, items):
+        self.set_header("Content-Type", codec.content_type)
+        self.write(codec.encode(key, items))
+
+    # Runs an operation on the messages of the queue. It fails with
+    # IntegrityError when the queue was deleted since it was looked up, and
+    # runs again on the new queue when it was purged.
+    @coroutine
+    def write_messages(self, fn, *args):
+        while True:
+            queue_id = self.queue["id"]
+            try:
+                result = yield self.application.db.write(fn, queue_id, *args, queue_id=queue_id, live=True)
+                return result
+            except sqlite3.IntegrityError:
+                queue = yield self.application.queues.get(self.path_args[0])
+                if queue is None or queue["id"] == queue_id:
+                    raise
+                self.queue = queue
+
+    # Receives messages, with the ready index only the messages that it
+    # hands out are considered
+    @coroutine
+    def receive(self, message_count, visibility_timeout, delete):
+        if self.application.ready is None:
+            rows = yield self.write_messages(receive_messages, message_count, visibility_timeout, delete)
+            return rows
+        rows = []
+        waited = False
+        while len(rows) < message_count:
+            queue_id = self.queue["id"]
+            wanted = message_count - len(rows)
+            candidates = self.application.ready[queue_id].take(wanted * READY_INDEX_WINDOW, time.time())
+            if not candidates:
+                # Messages whose leases are being expired right now are not in the index yet
+                pending = self.application.lease_reaper.pending
+                if pending is None or waited:
+                    break
+                waited = True
+                yield pending
+                continue
+            try:
+                received = yield self.write_messages(receive_messages, wanted, visibility_timeout, delete, [candidate[2] for candidate in candidates])
+            except Exception:
+                if queue_id in self.application.ready:
+                    self.application.ready[queue_id].put_back(candidates)
+                raise
+            rows.extend(received)
+            # The ids of a purged queue are of no use to the new one
+            if self.queue["id"] != queue_id:
+                continue
+            # Candidates are received in order, the ones before the last received message are gone
+            if len(received) == wanted:
+                last = max((message["priority"], message["create_date"], message["id"]) for message in received)
+                self.application.ready[queue_id].put_back([candidate for candidate in candidates if candidate[:3] > last])
+        return sorted(rows, key=lambda message: (message["priority"], message["create_date"], message["id"]))
+
+    # Updates leases, with the ready index released messages are added back to it
+    @coroutine
+    def apply_leases(self, leases, now):
+        try:
+            if self.application.ready is None:
+                results = yield self.write_messages(update_leases, leases, now)
+                released = []
+            else:
+                results, released = yield self.write_messages(update_leases_released, leases, now)
+        except sqlite3.IntegrityError:
+            # The leases of a deleted queue are not found
+            return set()
+        queue_id = self.queue["id"]
+        if queue_id not in self.application.counters:
+            return set()
+        for message_id, priority, create_date, visible_date, expire_date in released:
+            self.application.ready[queue_id].add(message_id, priority, create_date, visible_date, expire_date, now)
+        return self.leases_updated(results, now)
+
+    def forget_queue(self, queue_id):
+        self.application.waiters.discard(queue_id)
+        if self.application.ready is not None:
+            self.application.ready.pop(queue_id, None)
+        return self.application.counters.pop(queue_id, None)
+
+    # Counts received messages and schedules the expiry of their leases
+    def messages_received(self, rows, visibility_timeout, delete):
+        # Counters are a defaultdict, those of a queue that is gone are not brought back
+        counters = self.application.counters.get(self.queue["id"])
+        if counters is None:
+            return
+        counters.receive_count += len(rows)
+        if not delete:
+            counters.leased += len(rows)
+            if rows:
+                self.application.lease_reaper.schedule(rows[0]["lease_date"] + visibility_timeout)
+        else:
+            counters.total -= len(rows)
+            counters.delete_count += len(rows)
+
+    # Counts the results of update_leases, returns the leases that were found
+    def leases_updated(self, results, now):
+        counters = self.application.counters[self.queue["id"]]
+        found = set()
+        for (action, value), lease_uuids in results.items():
+            found.update(lease_uuids)
+            if not lease_uuids:
+                continue
+            if action == "delete":
+                counters.total -= len(lease_uuids)
+                counters.leased -= len(lease_uuids)
+                counters.delete_count += len(lease_uuids)
+            elif action == "extend":
+                self.application.lease_reaper.schedule(now + value)
+            else:
+                counters.leased -= len(lease_uuids)
+                if value == 0:
+                    self.application.waiters.notify(self.queue["id"], len(lease_uuids))
+                else:
+                    counters.delay(now + value, len(lease_uuids))
+                    self.application.waiters.notify_at(self.queue["id"], now + value, len(lease_uuids))
+        return found
+
+    # Counts committed messages and wakes up consumers
+    def messages_inserted(self, messages, message_ids, now):
+        counters = self.application.counters.get(self.queue["id"])
+        if counters is None:
+            return
+        counters.total += len(message_ids)
+        counters.insert_count += len(message_ids)
+        if self.application.ready is not None:
+            ready = self.application.ready[self.queue["id"]]
+            for message, message_id in zip(messages, message_ids):
+                ready.add(message_id, message.get("priority", DEFAULT_MESSAGE_PRIORITY), now, now + message.get("delay", DEFAULT_MESSAGE_DELAY),
+                          now + message.get("retention", DEFAULT_MESSAGE_RETENTION), now)
+        delays = {}
+        ends = {}
+        for message in messages:
+            delay = message.get("delay", DEFAULT_MESSAGE_DELAY)
+            delays[delay] = delays.get(delay, 0) + 1
+            if delay:
+                end = min(delay, message.get("retention", DEFAULT_MESSAGE_RETENTION))
+                ends[end] = ends.get(end, 0) + 1
+        for end, count in ends.items():
+            counters.delay(now + end, count)
+        for delay, count in delays.items():
+            if delay == 0:
+                self.application.waiters.notify(self.queue["id"], count)
+            else:
+                self.application.waiters.notify_at(self.queue["id"], now + delay, count)
+
 #
 # StatisticsHandler
 #
 
 
-def queue_statistics(db, queue_id):
-    def count(db, query, params):
-        c = db.cursor()
-        c.execute(query, params)
-        row = c.fetchone()
-        return row[0]
-    now = time.time()
-    return {
-        "visible": count(db, "select count(*) from messages where queue_id = ? and lease_date is null and visible_date <= ? and expire_date >= ?", [queue_id, now, now]),
-        "delayed": count(db, "select count(*) from messages where queue_id = ? and lease_date is null and visible_date > ?", [queue_id, now]),
-        "leased": count(db, "select count(*) from messages where queue_id = ? and lease_date is not null", [queue_id]),
-    }
+def queue_statistics(app, queue):
+    statistics = app.counters[queue["id"]].statistics(time.time())
+    statistics["purging"] = app.reclaimer.remaining(queue["name"]) or 0
+    return statistics
 
 class StatisticsHandler(BaseHandler):
 
+    @coroutine
     def get(self):
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("select id, name from queues")
-            if self.get_argument("format", DEFAULT_DELETE) == "telegraf":
-                statistics = []
-                for queue in c.fetchall():
-                    d = queue_statistics(db, queue["id"])
-                    d["service"] = queue["name"]
-                    statistics.append(d)
-                self.set_header("Content-Type", "application/json")
-                self.write(json.dumps(statistics))
-            else:
-                statistics = {queue["name"]: queue_statistics(db, queue["id"]) for queue in c.fetchall()}
-                self.write(statistics)
+        queues = yield self.application.db.read(list_queues)
+        remote = yield self.gather()
+        if self.get_argument("format", DEFAULT_DELETE) == "telegraf":
+            statistics = []
+            for queue in queues:
+                d = queue_statistics(self.application, queue)
+                d["service"] = queue["name"]
+                statistics.append(d)
+            for r in remote:
+                statistics.extend(r)
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(statistics))
+        else:
+            statistics = {queue["name"]: queue_statistics(self.application, queue) for queue in queues}
+            for r in remote:
+                statistics.update(r)
+            self.write(statistics)
 
 
 #
 # QueueStatisticsHandler
 #
 
-class QueueStatisticsHandler(BaseHandler):
+class QueueStatisticsHandler(QueueBaseHandler):
+
+    # A queue that was dropped in the background shows how far along that is
+    def queue_not_found(self, queue_name):
+        remaining = self.application.reclaimer.remaining(queue_name)
+        if remaining is None:
+            self.send_error(404)
+            return
+        self.finish({"dropped": True, "purging": remaining})
+
+    def get(self, queue_name):
+        statistics = queue_statistics(self.application, self.queue)
+        self.write(statistics)
+
+#
+# MetricsHandler exposes metrics in the Prometheus text format. Everything
+# comes from in-memory counters, so scraping never counts rows. With
+# multiple workers every worker has its own metrics, scrape them on their
+# internal ports.
+#
+
+REQUEST_DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in labels) + "}"
+
+class MetricsWriter:
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        self.lines.append("# HELP %s %s" % (name, help))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            self.lines.append("%s%s %s" % (name, format_labels(labels), repr(float(value)) if type(value) == float else value))
+
+    def histogram(self, name, help, histograms):
+        self.lines.append("# HELP %s %s" % (name, help))
+        self.lines.append("# TYPE %s histogram" % name)
+        for labels, histogram in histograms:
+            buckets, total, count = histogram.snapshot()
+            for bound, cumulative in buckets:
+                self.lines.append("%s_bucket%s %d" % (name, format_labels(labels + [("le", "+Inf" if bound == math.inf else repr(bound))]), cumulative))
+            self.lines.append("%s_sum%s %r" % (name, format_labels(labels), total))
+            self.lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+def render_metrics(app, queues):
+    w = MetricsWriter()
+    w.histogram("tqs_http_request_duration_seconds", "Time spent on HTTP requests.",
+                [([("handler", handler), ("method", method), ("code", code)], histogram)
+                 for (handler, method, code), histogram in sorted(app.request_durations.items())])
+    now = time.time()
+    live = [(queue["name"], app.counters[queue["id"]]) for queue in queues]
+    statistics = [(name, counters.statistics(now)) for name, counters in live]
+    w.metric("tqs_queue_messages", "gauge", "Messages in a queue by state.",
+             [([("queue", name), ("state", state)], s[state]) for name, s in statistics for state in ("visible", "delayed", "leased")])
+    for metric, attribute, help in (("tqs_queue_messages_inserted_total", "insert_count", "Messages posted to a queue."),
+                                    ("tqs_queue_messages_received_total", "receive_count", "Messages received from a queue since startup."),
+                                    ("tqs_queue_messages_deleted_total", "delete_count", "Messages deleted from a queue, by ack or on receive."),
+                                    ("tqs_queue_messages_expired_total", "expire_count", "Messages that expired before they were deleted."),
+                                    ("tqs_queue_leases_expired_total", "lease_expire_count", "Leases that expired since startup.")):
+        w.metric(metric, "counter", help, [([("queue", name)], getattr(counters, attribute)) for name, counters in live])
+    w.metric("tqs_queue_waiters", "gauge", "Long-polling requests that are waiting for messages.",
+             [([("queue", queue["name"])], app.waiters.waiting.get(queue["id"], 0)) for queue in queues])
+    w.metric("tqs_queue_purging_messages", "gauge", "Messages of purged or dropped queues that are still to be deleted.",
+             [([("queue", name)], count) for name, count in sorted(app.reclaimer.counts().items())])
+    db = app.db
+    w.metric("tqs_database_operations_total", "counter", "Database operations run by the writer.", [([], db.operation_count)])
+    w.metric("tqs_database_operation_errors_total", "counter", "Database operations that failed.", [([], db.operation_errors)])
+    w.metric("tqs_database_commits_total", "counter", "Database transactions committed by the writer.", [([], db.commits)])
+    w.histogram("tqs_database_operation_wait_seconds", "Time database operations wait for the writer.", [([], db.operation_wait)])
+    w.histogram("tqs_database_transaction_seconds", "Time the writer spends on a transaction, including the commit.", [([], db.commit_duration)])
+    if db.checkpointer is not None:
+        w.metric("tqs_database_checkpoints_total", "counter", "Checkpoints run by the checkpointer.", [([], db.checkpoints)])
+        w.histogram("tqs_database_checkpoint_seconds", "Time a checkpoint takes.", [([], db.checkpoint_duration)])
+    return w.text()
+
+class MetricsHandler(BaseHandler):
+
+    @coroutine
+    def get(self):
+        queues = yield self.application.db.read(list_queues)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics(self.application, queues))
+
+#
+# SQLHandler shows the statements that took the most time when tracing is
+# enabled, gathered from all workers. Sort by time, max_time, count or
+# rows. DELETE starts over.
+#
+
+class SQLHandler(BaseHandler):
 
     def prepare(self):
         super().prepare()
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("select id, name from queues where name = ?", [self.path_args[0]])
-            self.queue = c.fetchone()
-            if not self.queue:
-                self.send_error(404)
+        if not self._finished and self.application.db.tracer is None:
+            self.send_error(404)
 
-    def get(self, queue_name):
-        now = time.time()
-        with self.application.db as db:
-            statistics = queue_statistics(db, self.queue["id"])
-            self.write(statistics)
+    @coroutine
+    def get(self):
+        try:
+            limit = int(self.get_argument("limit", str(DEFAULT_TRACE_LIMIT)))
+        except ValueError:
+            self.send_error(400) # TODO Explain
+            return
+        sort = self.get_argument("sort", "time")
+        if limit < 1 or sort not in VALID_TRACE_SORTS:
+            self.send_error(400) # TODO Explain
+            return
+        statements = self.application.db.tracer.top(limit, sort)
+        cluster = self.application.cluster
+        if cluster is not None:
+            for statement in statements:
+                statement["worker"] = cluster.worker_id
+        remote = yield self.gather()
+        for r in remote:
+            statements.extend(r["statements"])
+        statements = sorted(statements, key=lambda statement: statement[sort], reverse=True)[:limit]
+        self.write({"statements": statements})
+
+    @coroutine
+    def delete(self):
+        self.application.db.tracer.reset()
+        yield self.gather()
+        self.write("{}")
 
 #
 # QueuesHandler
@@ -188,25 +1639,84 @@ def format_date(ts):
     d = datetime.datetime.utcfromtimestamp(ts)
     return d.isoformat() + "Z"
 
+def list_queues(db):
+    return [dict(row) for row in db.execute("select " + QUEUE_COLUMNS + " from queues where drop_date is null order by create_date")]
+
+def create_queue(db, name, now, durable=True):
+    return db.execute("insert into queues (create_date, name, durable) values (?, ?, ?)", [now, name, durable]).lastrowid
+
+def delete_queue(db, name):
+    return db.execute("delete from queues where name = ? and drop_date is null", [name]).rowcount != 0
+
+#
+# Dropping and purging a queue in the background. The queue is retired
+# right away: it is renamed to <name>#<id>, which is not a valid queue
+# name, and marked as dropped, so that it disappears and its name can be
+# used again. A purge then creates a new queue under the old name that
+# continues the counts of the retired one. ReclaimQueuesCallback deletes
+# the messages of retired queues in batches, and finally the queues.
+#
+
+def retire_queue(db, name, now):
+    queue = db.execute("select id, create_date, durable from queues where name = ? and drop_date is null", [name]).fetchone()
+    if queue is None:
+        return None
+    db.execute("update queues set name = name || '#' || id, drop_date = ? where id = ?", [now, queue["id"]])
+    return dict(queue)
+
+# Operations on the messages of a queue run after it was looked up by
+# name, a purge or drop can retire it in between. The writer checks that
+# the queue is still live right before it runs them, in the same batch as
+# the retirement, so that messages are not inserted into, received from
+# or released back into a queue that is being reclaimed.
+def check_live_queue(db, queue_id):
+    row = db.execute("select drop_date from queues where id = ?", [queue_id]).fetchone()
+    if row is None or row[0] is not None:
+        raise sqlite3.IntegrityError("Queue %d does not exist" % queue_id)
+
+def purge_queue(db, name, counts, now):
+    queue = retire_queue(db, name, now)
+    if queue is None:
+        return None
+    queue_id = db.execute("insert into queues (create_date, name, insert_count, delete_count, expire_count, durable) values (?, ?, ?, ?, ?, ?)",
+                          [queue["create_date"], name] + counts + [queue["durable"]]).lastrowid
+    return queue["id"], queue_id
+
+def list_retired_queues(db):
+    return [dict(row) for row in db.execute("select id, name from queues where drop_date is not null")]
+
+def list_ephemeral_queues(db):
+    return [row[0] for row in db.execute("select id from queues where durable = 0 and drop_date is null")]
+
 class QueuesHandler(BaseHandler):
 
     #
     # Get a list of all available queues
     #
 
+    @coroutine
     def get(self):
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("select name, create_date, insert_count, delete_count, expire_count from queues order by create_date")
-            queues = [{"name": queue["name"],
-                       "create_date": format_date(queue["create_date"])}
-                      for queue in c.fetchall()]
-            self.write({"queues": queues})
+        queues = yield self.application.db.read(list_queues)
+        if self.is_forwarded():
+            # The worker that gathers the queues sorts and formats them
+            self.write({"queues": [{"name": queue["name"], "create_date": queue["create_date"], "durable": queue["durable"]} for queue in queues]})
+            return
+        remote = yield self.gather()
+        if remote:
+            queues = sorted(queues + [queue for r in remote for queue in r["queues"]], key=lambda queue: queue["create_date"])
+        queues = [{"name": queue["name"],
+                   "create_date": format_date(queue["create_date"]),
+                   "durable": bool(queue["durable"])}
+                  for queue in queues]
+        self.write({"queues": queues})
 
     #
-    # Create a new queue
+    # Create a new queue. Queues that are not durable are kept in memory.
+    #
+    # { "name": "telemetry", "durable": false }
     #
 
+    @coroutine
     def post(self):
         try:
             if not self.request.body:
@@ -216,15 +1726,26 @@ class QueuesHandler(BaseHandler):
             if type(data) != dict or "name" not in data or not validate_queue_name(data["name"]):
                 self.send_error(400)
                 return
+            if "durable" in data and not validate_durable(data["durable"]):
+                self.send_error(400) # TODO Explain
+                return
         except Exception as e:
             self.send_error(400)
             return
 
+        shard = self.remote_shard(data["name"])
+        if shard is not None:
+            yield self.forward(shard)
+            return
+
+        durable = data.get("durable", DEFAULT_DURABLE)
         try:
-            with self.application.db:
-                c = self.application.db.cursor()
-                c.execute("insert into queues (create_date, name) values (?, ?)", [time.time(), data["name"]])
-                self.write("{}")
+            queue_id = yield self.application.db.write(create_queue, data["name"], time.time(), durable)
+            if not durable:
+                yield self.application.db.write(self.application.db.open_ephemeral_queue, queue_id)
+            self.application.queues.invalidate(data["name"])
+            self.application.counters[queue_id] = QueueCounters()
+            self.write("{}")
         except sqlite3.IntegrityError as e:
             self.send_error(409)
 
@@ -232,84 +1753,196 @@ class QueuesHandler(BaseHandler):
 # Queue API
 #
 
-class QueueHandler(BaseHandler):
+#
+# Receiving messages claims a batch of ready messages with a single
+# statement. With UPDATE/DELETE ... RETURNING (SQLite 3.35 and newer) the
+# claimed rows come straight back from the update, older versions select
+# the batch first and then lease or delete it in one go.
+#
 
-    def prepare(self):
-        super().prepare()
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("select id, name from queues where name = ?", [self.path_args[0]])
-            self.queue = c.fetchone()
-            if not self.queue:
-                self.send_error(404)
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# A lease is the message id and the number of times the message was
+# leased, packed in an integer, so that finding a lease is a primary key
+# lookup. Leasing a message again makes its earlier leases invalid, and
+# a message that is not leased has no valid lease at all.
+#
+# Message ids are only unique within the storage of a queue: queue files
+# and ephemeral queues start over at 1. Lease names also carry the queue
+# id and the generation of its storage, which goes up every time an
+# ephemeral queue is opened, so that the leases of a queue that was
+# purged, deleted or restarted are not found in the one that replaced it.
+LEASE_COUNT_BITS = 24
+LEASE_COUNT_MASK = (1 << LEASE_COUNT_BITS) - 1
+LEASE_SQL = "(id << %d | (lease_count & %d))" % (LEASE_COUNT_BITS, LEASE_COUNT_MASK)
+LEASE_BITS = 64
+LEASE_GENERATION_BITS = 32
+
+def format_lease(queue_id, generation, lease):
+    return "%x" % (((queue_id << LEASE_GENERATION_BITS | generation) << LEASE_BITS) | lease)
+
+# Returns (queue_id, generation, lease), or None for a lease that cannot
+# be found, like an old uuid
+def parse_lease(lease_name):
+    if not validate_lease_name(lease_name) or "-" in lease_name:
+        return None
+    lease = int(lease_name, 16)
+    storage = lease >> LEASE_BITS
+    return storage >> LEASE_GENERATION_BITS, storage & ((1 << LEASE_GENERATION_BITS) - 1), lease & ((1 << LEASE_BITS) - 1)
+
+def queue_generation(db, queue_id):
+    row = db.execute("select generation from queues where id = ?", [queue_id]).fetchone()
+    return row[0] if row is not None else 0
+
+# Returns a where clause for the leases of a queue, its parameters, and
+# the lease names by lease
+def leases_where(queue_id, generation, lease_names):
+    leases = {}
+    for lease_name in lease_names:
+        lease = parse_lease(lease_name)
+        if lease is not None and lease[:2] == (queue_id, generation):
+            leases[lease[2]] = lease_name
+    ids = [lease >> LEASE_COUNT_BITS for lease in leases]
+    where = " where id in (%s) and queue_id = ? and lease_date is not null and %s in (%s)" % (",".join("?" * len(ids)), LEASE_SQL, ",".join("?" * len(leases)))
+    return where, ids + [queue_id] + list(leases), leases
+
+READY_MESSAGES_SQL = "select id from messages where queue_id = ? and lease_date is null and visible_date <= ? and expire_date >= ? order by priority, create_date, id limit ?"
+
+# Messages picked by the ready index that are still ready
+READY_IDS_SQL = "select id from messages where id in (%s) and queue_id = ? and lease_date is null and visible_date <= ? and expire_date >= ? order by priority, create_date, id limit ?"
+
+def receive_messages(db, queue_id, message_count, visibility_timeout, delete, ids=None):
+    now = time.time()
+    if ids is None:
+        ready_sql, ready_params = READY_MESSAGES_SQL, [queue_id, now, now, message_count]
+    else:
+        ready_sql, ready_params = READY_IDS_SQL % ",".join("?" * len(ids)), list(ids) + [queue_id, now, now, message_count]
+    if SQLITE_RETURNING:
+        if not delete:
+            c = db.execute("update messages set lease_date = ?, lease_count = lease_count + 1, lease_timeout = ?, lease_expire_date = ? where id in (" + ready_sql + ")"
+                           " returning id, create_date, body, type, priority, lease_date, expire_date, " + LEASE_SQL + " as lease_uuid, lease_timeout",
+                           [now, visibility_timeout, now + visibility_timeout] + ready_params)
+        else:
+            c = db.execute("delete from messages where id in (" + ready_sql + ") returning id, create_date, body, type, priority, expire_date",
+                           ready_params)
+        # RETURNING does not preserve the order of the subquery
+        messages = sorted((dict(row) for row in c.fetchall()), key=lambda message: (message["priority"], message["create_date"], message["id"]))
+        if not delete:
+            generation = queue_generation(db, queue_id)
+            for message in messages:
+                message["lease_uuid"] = format_lease(queue_id, generation, message["lease_uuid"])
+        if delete and messages:
+            db.execute("update queues set delete_count = delete_count + ? where id = ?", [len(messages), queue_id])
+        return messages
+
+    if ids is None:
+        c = db.execute("select id, create_date, body, type, priority, expire_date, lease_count from messages where queue_id = ? and lease_date is null and visible_date <= ? and expire_date >= ? order by priority, create_date, id limit ?",
+                       [queue_id, now, now, message_count])
+    else:
+        c = db.execute("select id, create_date, body, type, priority, expire_date, lease_count from messages where id in (" + ready_sql + ") order by priority, create_date, id", ready_params)
+    messages = [dict(row) for row in c.fetchall()]
+    if not messages:
+        return messages
+    if not delete:
+        generation = queue_generation(db, queue_id)
+        for message in messages:
+            message["lease_count"] += 1
+            lease = message["id"] << LEASE_COUNT_BITS | (message["lease_count"] & LEASE_COUNT_MASK)
+            message.update(lease_date=now, lease_uuid=format_lease(queue_id, generation, lease), lease_timeout=visibility_timeout)
+        db.executemany("update messages set lease_date = ?, lease_count = ?, lease_timeout = ?, lease_expire_date = ? where id = ?",
+                       [(message["lease_date"], message["lease_count"], message["lease_timeout"], now + visibility_timeout, message["id"]) for message in messages])
+    else:
+        db.execute("delete from messages where id in (%s)" % ",".join("?" * len(messages)), [message["id"] for message in messages])
+        db.execute("update queues set delete_count = delete_count + ? where id = ?", [len(messages), queue_id])
+    return messages
+
+
+#
+# Inserting messages adds a whole batch with one executemany. All messages
+# in a batch share the same create_date, the message id breaks the tie.
+# An ephemeral queue that is full, or a full disk, fails with SQLITE_FULL.
+#
+
+def is_database_full(e):
+    return str(e) == "database or disk is full"
+
+def insert_messages(db, queue_id, messages, now):
+    db.executemany("insert into messages (create_date, visible_date, expire_date, queue_id, body, type, priority) values (?, ?, ?, ?, ?, ?, ?)",
+                   [(now, now + message.get("delay", DEFAULT_MESSAGE_DELAY), now + message.get("retention", DEFAULT_MESSAGE_RETENTION), queue_id,
+                     message["body"], message.get("type", DEFAULT_BODY_TYPE), message.get("priority", DEFAULT_MESSAGE_PRIORITY))
+                    for message in messages])
+    # Rows inserted by one writer in one transaction get consecutive ids
+    last_id = db.execute("select last_insert_rowid()").fetchone()[0]
+    db.execute("update queues set insert_count = insert_count + ? where id = ?", [len(messages), queue_id])
+    return list(range(last_id - len(messages) + 1, last_id + 1))
+
+
+def format_messages(rows, delete, date=format_date):
+    if not delete:
+        return [{"id": message["id"],
+                 "create_date": date(message["create_date"]),
+                 "visible_date": date(message["create_date"]),
+                 "expire_date": date(message["expire_date"]),
+                 "body": message["body"],
+                 "type": message["type"],
+                 "priority": message["priority"],
+                 "lease_date": date(message["lease_date"]),
+                 "lease_uuid": message["lease_uuid"],
+                 "lease_timeout": message["lease_timeout"]}
+                for message in rows]
+    return [{"id": message["id"],
+             "create_date": date(message["create_date"]),
+             "visible_date": date(message["create_date"]),
+             "expire_date": date(message["expire_date"]),
+             "body": message["body"],
+             "type": message["type"],
+             "priority": message["priority"]}
+            for message in rows]
+
+class QueueHandler(QueueBaseHandler):
 
     @coroutine
     def get(self, queue_name):
-        with self.application.db:
-            c = self.application.db.cursor()
+        codec = self.response_codec()
+        if codec is None:
+            return
 
-            # Parse parameters (message_count, visibility_timeout)
-            delete = self.get_argument("delete", DEFAULT_DELETE) # TODO Why do we have validate_delete?
-            message_count = min(int(self.get_argument("message_count", DEFAULT_MESSAGE_COUNT)), MAX_MESSAGE_COUNT)
-            visibility_timeout = min(int(self.get_argument("visibilty_timeout", DEFAULT_VISIBILITY_TIMEOUT)), MAX_VISIBILITY_TIMEOUT)
-            wait_time = min(int(self.get_argument("wait_time", DEFAULT_WAIT_TIME)), MAX_WAIT_TIME)
+        # Parse parameters (message_count, visibility_timeout)
+        delete = self.get_argument("delete", DEFAULT_DELETE) # TODO Why do we have validate_delete?
+        message_count = min(int(self.get_argument("message_count", DEFAULT_MESSAGE_COUNT)), MAX_MESSAGE_COUNT)
+        visibility_timeout = min(int(self.get_argument("visibilty_timeout", DEFAULT_VISIBILITY_TIMEOUT)), MAX_VISIBILITY_TIMEOUT)
+        wait_time = min(int(self.get_argument("wait_time", DEFAULT_WAIT_TIME)), MAX_WAIT_TIME)
 
-            # Select messages that we can return
+        # Claim messages that we can return
 
-            rows = []
-            deadline = time.time() + wait_time
+        rows = []
+        deadline = time.time() + wait_time
 
-            while True:
-                now = time.time()
-                c.execute("select id from messages where queue_id = ? and lease_date is null and visible_date <= ? and expire_date >= ? order by priority, create_date limit ?",
-                          (self.queue["id"], now, now, message_count))
-                rows = c.fetchall() # TODO Another case of this api being too smart
+        while True:
+            generation = self.application.waiters.generation(self.queue["id"])
+            try:
+                rows = yield self.receive(message_count, visibility_timeout, delete)
+            except sqlite3.IntegrityError:
+                self.send_error(404)
+                return
 
-                if now > deadline or rows:
-                    break
-                if wait_time != 0:
-                    yield sleep(0.25)
+            now = time.time()
+            if rows or now >= deadline:
+                break
 
-            if not rows:
-                self.write({"messages": []})
+            # Park until a producer, the lease reaper or a maturing delay wakes us up
+            yield self.application.waiters.wait(self.queue["id"], deadline - now, generation)
+
+            # The queue may have been purged or deleted in the meantime
+            self.queue = yield self.application.queues.get(queue_name)
+            if not self.queue:
+                self.send_error(404)
                 return
 
-            message_ids = [row["id"] for row in rows]
-
-            # Update the lease for these messages
-            if not delete:
-                for message_id in message_ids:
-                    lease_uuid = str(uuid.uuid4())
-                    c.execute("update messages set lease_date = ?, lease_uuid = ?, lease_timeout = ? where id = ?",
-                              [time.time(), lease_uuid, visibility_timeout, message_id])
-
-            # Return messages
-            if not delete:
-                c.execute("select id, create_date, body, type, priority, lease_date, expire_date, lease_uuid, lease_timeout from messages where id in (%s)" % ",".join("?" * len(message_ids)), message_ids)
-                messages = [{"id": message["id"],
-                             "create_date": format_date(message["create_date"]),
-                             "visible_date": format_date(message["create_date"]),
-                             "expire_date": format_date(message["expire_date"]),
-                             "body": message["body"],
-                             "type": message["type"],
-                             "priority": message["priority"],
-                             "lease_date": format_date(message["lease_date"]),
-                             "lease_uuid": message["lease_uuid"],
-                             "lease_timeout": message["lease_timeout"]}
-                            for message in c.fetchall()]
-            else:
-                c.execute("select id, create_date, body, type, priority, expire_date from messages where id in (%s)" % ",".join("?" * len(message_ids)), message_ids)
-                messages = [{"id": message["id"],
-                             "create_date": format_date(message["create_date"]),
-                             "visible_date": format_date(message["create_date"]),
-                             "expire_date": format_date(message["expire_date"]),
-                             "body": message["body"],
-                             "type": message["type"],
-                             "priority": message["priority"]}
-                            for message in c.fetchall()]
-                c.execute("delete from messages where id in (%s)" % ",".join("?" * len(message_ids)), message_ids)
-
-            self.write({"messages": messages})
+        self.messages_received(rows, visibility_timeout, delete)
+
+        # Return messages
+        self.write_items(codec, "messages", format_messages(rows, delete, format_numeric_date if codec.numeric_dates else format_date))
 
     #
     # Add messages to a queue
@@ -317,103 +1950,596 @@ class QueueHandler(BaseHandler):
     # { "messages": [{"body": "", "delay": 5}, ...] }
     #
 
+    @coroutine
     def post(self, queue_name):
-        with self.application.db as db:
-            # Verify incoming data
-            try:
-                data = json_decode(self.request.body)
-                if type(data) != dict or "messages" not in data or type(data["messages"]) != list:
+        codec = self.response_codec()
+        if codec is None:
+            return
+
+        # Verify incoming data
+        try:
+            messages = self.decode_items("messages")
+            for message in messages:
+                if not validate_message(message):
                     self.send_error(400) # TODO Explain
                     return
-                for message in data["messages"]:
-                    if type(message) != dict:
-                        self.send_error(400) # TODO Explain
-                        return
-                    if "body" not in message or type(message["body"]) != str or not validate_message_body(message["body"]):
-                        self.send_error(400) # TODO Explain
-                        return
-                    if "type" in message and not validate_message_type(message["type"]):
-                        self.send_error(400) # TODO Explain
-                        return
-                    if "delay" in message and not validate_message_delay(message["delay"]):
-                        self.send_error(400) # TODO Explain
-                        return
-                    if "retention" in message and not validate_message_retention(message["retention"]):
-                        self.send_error(400) # TODO Explain
-                        return
-                    if "priority" in message and not validate_message_priority(message["priority"]):
-                        self.send_error(400) # TODO Explain
-                        return
-            except Exception as e:
-                self.send_error(400) # TODO Explain
-                return
+        except Exception as e:
+            self.send_error(400) # TODO Explain
+            return
 
-            # No messages is not considered an error
-            if len(data["messages"]) == 0:
-                self.write({})
-                return
+        # No messages is not considered an error
+        if len(messages) == 0:
+            self.write_items(codec, "messages", [])
+            return
 
-            # Push all messages into the queue
-            for message in data["messages"]:
-                now = time.time()
-                delay = message.get("delay", DEFAULT_MESSAGE_DELAY)
-                retention = message.get("retention", DEFAULT_MESSAGE_RETENTION)
-                priority = message.get("priority", DEFAULT_MESSAGE_PRIORITY)
-                db.execute("insert into messages (create_date, visible_date, expire_date, queue_id, body, type, priority) values (?, ?, ?, ?, ?, ?, ?)",
-                           [now, now + delay, now + retention, self.queue["id"], message["body"], message.get("type", DEFAULT_BODY_TYPE), priority])
+        # Push all messages into the queue
+        now = time.time()
+        try:
+            message_ids = yield self.write_messages(insert_messages, messages, now)
+        except sqlite3.IntegrityError as e:
+            # The queue was deleted while we were waiting for the database
+            self.send_error(404)
+            return
+        except sqlite3.OperationalError as e:
+            if not is_database_full(e):
+                raise
+            self.send_error(507)
+            return
 
-            self.write({}) # TODO What is useful to return here?
+        self.messages_inserted(messages, message_ids, now)
+        self.write_items(codec, "messages", [{"id": message_id} for message_id in message_ids])
 
     #
     # Delete a queue and all its messages. We depend on cascading
-    # deletes so deleting just the queue is enough here.
+    # deletes so deleting just the queue is enough here, unless the
+    # queue has a file of its own. With ?async=true the queue is only
+    # retired and its messages are deleted in the background.
     #
 
+    @coroutine
     def delete(self, queue_name):
-        with self.application.db:
-            cursor = self.application.db.cursor()
-            cursor.execute("delete from queues where name = ?", (queue_name,))
-            if cursor.rowcount == 0:
+        if validate_delete(self.get_argument("async", "")):
+            queue = yield self.application.db.write(retire_queue, queue_name, time.time())
+            self.application.queues.invalidate(queue_name)
+            if queue is None:
                 self.send_error(404)
                 return
+            counters = self.forget_queue(queue["id"]) or QueueCounters()
+            self.application.reclaimer.add(queue["id"], queue_name, counters.total)
+            self.set_status(202)
             self.write("{}")
+            return
+        deleted = yield self.application.db.write(delete_queue, queue_name)
+        self.application.queues.invalidate(queue_name)
+        if not deleted:
+            self.send_error(404)
+            return
+        yield self.application.db.write(self.application.db.remove_queue, self.queue["id"])
+        self.forget_queue(self.queue["id"])
+        self.write("{}")
+
+
+def delete_lease(db, queue_id, lease_uuid):
+    where, params, leases = leases_where(queue_id, queue_generation(db, queue_id), [lease_uuid])
+    if not leases or db.execute("delete from messages" + where, params).rowcount == 0:
+        return False
+    db.execute("update queues set delete_count = delete_count + 1 where id = ?", [queue_id])
+    return True
+
+#
+# Leases can also be updated in batches. Leases are grouped by action and
+# parameter, and each group is handled by a single statement that reports
+# back which of its leases were found.
+#
+
+def update_lease_group(db, queue_id, generation, lease_uuids, sql, params):
+    where, where_params, leases = leases_where(queue_id, generation, lease_uuids)
+    if not leases:
+        return []
+    if SQLITE_RETURNING:
+        return [leases[row[0]] for row in db.execute(sql + where + " returning " + LEASE_SQL, params + where_params).fetchall()]
+    found = [leases[row[0]] for row in db.execute("select " + LEASE_SQL + " from messages" + where, where_params).fetchall()]
+    if found:
+        db.execute(sql + where, params + where_params)
+    return found
+
+def update_leases(db, queue_id, leases, now):
+    groups = collections.defaultdict(list)
+    for lease in leases:
+        action = lease.get("action", DEFAULT_LEASE_ACTION)
+        if action == "extend":
+            groups[(action, lease.get("visibility_timeout", DEFAULT_VISIBILITY_TIMEOUT))].append(lease["lease_uuid"])
+        elif action == "release":
+            groups[(action, lease.get("delay", DEFAULT_MESSAGE_DELAY))].append(lease["lease_uuid"])
+        else:
+            groups[(action, None)].append(lease["lease_uuid"])
+    generation = queue_generation(db, queue_id)
+    results = {}
+    for (action, value), lease_uuids in groups.items():
+        if action == "delete":
+            found = update_lease_group(db, queue_id, generation, lease_uuids, "delete from messages", [])
+            if found:
+                db.execute("update queues set delete_count = delete_count + ? where id = ?", [len(found), queue_id])
+        elif action == "extend":
+            found = update_lease_group(db, queue_id, generation, lease_uuids, "update messages set lease_timeout = ?, lease_expire_date = ?", [value, now + value])
+        else:
+            found = update_lease_group(db, queue_id, generation, lease_uuids, "update messages set visible_date = ?, lease_date = null, lease_timeout = null, lease_expire_date = null", [now + value])
+        results[(action, value)] = found
+    return results
+
+# Updates leases like update_leases, and also returns the released messages
+# as (id, priority, create_date, visible_date, expire_date) for the ready index
+def update_leases_released(db, queue_id, leases, now):
+    delays = {lease["lease_uuid"]: lease.get("delay", DEFAULT_MESSAGE_DELAY) for lease in leases if lease.get("action") == "release"}
+    released = []
+    if delays:
+        where, params, names = leases_where(queue_id, queue_generation(db, queue_id), delays)
+        if names:
+            rows = db.execute("select " + LEASE_SQL + ", id, priority, create_date, expire_date from messages" + where, params).fetchall()
+            released = [(row[1], row[2], row[3], now + delays[names[row[0]]], row[4]) for row in rows]
+    return update_leases(db, queue_id, leases, now), released
+
+class LeasesHandler(QueueBaseHandler):
+
+    @coroutine
+    def delete(self, queue_name, lease_uuid):
+        try:
+            deleted = yield self.write_messages(delete_lease, lease_uuid)
+        except sqlite3.IntegrityError:
+            deleted = False
+        if not deleted:
+            self.send_error(404)
+            return
+        counters = self.application.counters.get(self.queue["id"])
+        if counters is not None:
+            counters.total -= 1
+            counters.leased -= 1
+            counters.delete_count += 1
+        self.write("{}")
 
+    #
+    # Delete, extend or release a batch of leases
+    #
+    # { "leases": [{"lease_uuid": "...", "action": "extend", "visibility_timeout": 60}, ...] }
+    #
+
+    @coroutine
+    def post(self, queue_name):
+        codec = self.response_codec()
+        if codec is None:
+            return
 
-class LeasesHandler(BaseHandler):
+        # Verify incoming data
+        try:
+            leases = self.decode_items("leases")
+            if len(leases) > MAX_MESSAGE_COUNT:
+                self.send_error(400) # TODO Explain
+                return
+            for lease in leases:
+                if not validate_lease(lease):
+                    self.send_error(400) # TODO Explain
+                    return
+            if len(set(lease["lease_uuid"] for lease in leases)) != len(leases):
+                self.send_error(400) # TODO Explain
+                return
+        except Exception as e:
+            self.send_error(400) # TODO Explain
+            return
+
+        now = time.time()
+        found = yield self.apply_leases(leases, now)
+
+        self.write_items(codec, "leases", [{"lease_uuid": lease["lease_uuid"], "status": 200 if lease["lease_uuid"] in found else 404}
+                                           for lease in leases])
+
+
+#
+# PurgeHandler
+#
+
+class PurgeHandler(QueueBaseHandler):
+
+    #
+    # Delete all messages from a queue. The messages disappear right away
+    # and are deleted in the background.
+    #
 
+    @coroutine
+    def post(self, queue_name):
+        counters = self.application.counters[self.queue["id"]]
+        counts = [counters.insert_count, counters.delete_count, counters.expire_count]
+        result = yield self.application.db.write(purge_queue, queue_name, counts, time.time())
+        self.application.queues.invalidate(queue_name)
+        if result is None:
+            self.send_error(404)
+            return
+        queue_id, new_queue_id = result
+        if not self.queue["durable"]:
+            yield self.application.db.write(self.application.db.open_ephemeral_queue, new_queue_id)
+        counters = self.application.counters.pop(queue_id, counters)
+        self.application.counters[new_queue_id] = QueueCounters(counters.insert_count, counters.delete_count, counters.expire_count)
+        if self.application.ready is not None:
+            self.application.ready.pop(queue_id, None)
+        self.application.waiters.move(queue_id, new_queue_id)
+        self.application.reclaimer.add(queue_id, queue_name, counters.total)
+        self.set_status(202)
+        self.write("{}")
+
+
+#
+# IngestHandler takes a stream of messages, one JSON message per line, as
+# for a backfill. Lines are parsed as they arrive and inserted in batches
+# of INGEST_BATCH_SIZE, each in a transaction of its own. Reading the body
+# waits for a batch to be committed, so the memory a stream takes does not
+# depend on its size. Invalid lines are skipped, the response counts the
+# accepted and rejected lines and lists the first MAX_INGEST_ERRORS
+# rejected lines. Messages that were committed stay when the stream fails
+# half way.
+#
+# On a cluster the stream is forwarded chunk by chunk to the worker that
+# owns the queue.
+#
+
+INGEST_BATCH_SIZE = 1000
+MAX_INGEST_LINE_LEN = 64 * 1024
+MAX_INGEST_ERRORS = 100
+MAX_INGEST_BODY_SIZE = 64 * 1024 * 1024 * 1024
+INGEST_FORWARD_TIMEOUT = 24 * 60 * 60
+
+@stream_request_body
+class IngestHandler(QueueBaseHandler):
+
+    @coroutine
     def prepare(self):
-        super().prepare()
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("select id, name from queues where name = ?", (self.path_args[0],))
-            self.queue = c.fetchone()
+        self.buffer = b""
+        self.skipping = False
+        self.line = 0
+        self.messages = []
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+        self.chunks = None
+        BaseHandler.prepare(self)
+        if self._finished:
+            return
+        self.request.connection.set_max_body_size(MAX_INGEST_BODY_SIZE)
+        shard = self.remote_shard(self.path_args[0])
+        if shard is not None:
+            self.chunks = Queue(1)
+            self.forwarded = self.application.cluster.fetch(shard, self.request, body_producer=self.produce_body, request_timeout=INGEST_FORWARD_TIMEOUT)
+            return
+        self.queue = yield self.application.queues.get(self.path_args[0])
+        if not self.queue:
+            self.queue_not_found(self.path_args[0])
+
+    @coroutine
+    def produce_body(self, write):
+        while True:
+            chunk = yield self.chunks.get()
+            if chunk is None:
+                return
+            yield write(chunk)
+
+    @coroutine
+    def data_received(self, chunk):
+        if self._finished:
+            return
+        if self.chunks is not None:
+            # Chunks are dropped once the other worker has given up
+            while not self.forwarded.done():
+                try:
+                    yield self.chunks.put(chunk, timeout=datetime.timedelta(seconds=1))
+                    break
+                except TimeoutError:
+                    pass
+            return
+        lines = (self.buffer + chunk).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if self.skipping:
+                # The end of a line that was too long
+                self.skipping = False
+                continue
+            self.parse_line(line)
+        if len(self.buffer) > MAX_INGEST_LINE_LEN:
+            if not self.skipping:
+                self.line += 1
+                self.reject("Line too long")
+                self.skipping = True
+            self.buffer = b""
+        if len(self.messages) >= INGEST_BATCH_SIZE:
+            yield self.insert_batch()
+
+    def parse_line(self, line):
+        self.line += 1
+        if not line.strip():
+            return
+        try:
+            message = json_decode(line)
+        except ValueError:
+            self.reject("Invalid JSON")
+            return
+        if not validate_message(message):
+            self.reject("Invalid message")
+            return
+        self.messages.append(message)
+
+    def reject(self, error):
+        self.rejected += 1
+        if len(self.errors) < MAX_INGEST_ERRORS:
+            self.errors.append({"line": self.line, "error": error})
+
+    @coroutine
+    def insert_batch(self):
+        messages, self.messages = self.messages, []
+        if not messages or self._finished:
+            return
+        # The queue may have been purged or deleted in the meantime
+        self.queue = yield self.application.queues.get(self.path_args[0])
+        now = time.time()
+        try:
             if not self.queue:
-                self.send_error(404)
+                raise sqlite3.IntegrityError("Queue %s does not exist" % self.path_args[0])
+            message_ids = yield self.write_messages(insert_messages, messages, now)
+        except sqlite3.IntegrityError as e:
+            self.send_error(404)
+            return
+        except sqlite3.OperationalError as e:
+            if not is_database_full(e):
+                raise
+            self.send_error(507)
+            return
+        self.messages_inserted(messages, message_ids, now)
+        self.accepted += len(message_ids)
 
-    def delete(self, queue_name, lease_uuid):
-        with self.application.db as db:
-            c = db.cursor()
-            c.execute("delete from messages where queue_id = ? and lease_uuid = ?", [self.queue["id"], lease_uuid])
-            if c.rowcount == 0:
-                self.send_error(404)
+    @coroutine
+    def post(self, queue_name):
+        if self.chunks is not None:
+            yield self.chunks.put(None)
+            yield self.relay(self.application.cluster.shard(queue_name), self.forwarded)
+            return
+        if self.buffer and not self.skipping:
+            self.parse_line(self.buffer)
+        yield self.insert_batch()
+        if self._finished:
+            return
+        self.write({"accepted": self.accepted, "rejected": self.rejected, "errors": self.errors})
+
+
+#
+# ConsumerHandler pushes messages to a consumer over a WebSocket, instead
+# of the consumer polling with GET. The consumer picks a credit, the
+# number of messages it can have in flight, and a visibility timeout:
+#
+#   ws://host/queues/<name>/consume?credit=10&visibility_timeout=30
+#
+# Messages are leased like with GET and sent as {"messages": [...]} as
+# soon as they are ready, as long as there is credit left. The consumer
+# deletes, extends or releases them by sending {"leases": [...]} like it
+# would POST to /queues/<name>/leases, and gets the same response. A
+# message is in flight until its lease is deleted or released, or until
+# it expires. {"credit": n} changes the credit. Leases that are still in
+# flight when the socket closes are released.
+#
+# On a cluster the socket is proxied to the worker that owns the queue.
+#
+
+DEFAULT_CONSUMER_CREDIT = 10
+MIN_CONSUMER_CREDIT = 1
+MAX_CONSUMER_CREDIT = 1000
+
+def validate_consumer_credit(v):
+    return type(v) == int and v >= MIN_CONSUMER_CREDIT and v <= MAX_CONSUMER_CREDIT
+
+# Close codes
+CONSUMER_QUEUE_NOT_FOUND = 4404
+
+class ConsumerHandler(QueueBaseHandler, WebSocketHandler):
+
+    @coroutine
+    def prepare(self):
+        self.shard = None
+        try:
+            self.credit = int(self.get_argument("credit", str(DEFAULT_CONSUMER_CREDIT)))
+            self.visibility_timeout = int(self.get_argument("visibility_timeout", str(DEFAULT_VISIBILITY_TIMEOUT)))
+        except ValueError:
+            self.send_error(400) # TODO Explain
+            return
+        if not validate_consumer_credit(self.credit) or not validate_visibility_timeout(self.visibility_timeout):
+            self.send_error(400) # TODO Explain
+            return
+        BaseHandler.prepare(self)
+        self.shard = self.remote_shard(self.path_args[0])
+        if self.shard is not None:
+            return
+        if not self._finished:
+            self.queue = yield self.application.queues.get(self.path_args[0])
+            if not self.queue:
+                self.queue_not_found(self.path_args[0])
+
+    @coroutine
+    def open(self, queue_name):
+        self.closed = False
+        if self.shard is not None:
+            try:
+                self.upstream = yield self.application.cluster.connect(self.shard, self.request)
+            except Exception as e:
+                logging.error("Cannot forward consumer to worker %d: %s", self.shard, e)
+                self.close(1011, "Cannot reach worker")
                 return
-            self.write("{}")
+            IOLoop.current().spawn_callback(self.relay_upstream)
+            return
+        # Leases in flight and when they expire
+        self.inflight = {}
+        self.credit_changed = Event()
+        self.waiting = None
+        IOLoop.current().spawn_callback(self.push)
+
+    @coroutine
+    def relay_upstream(self):
+        while True:
+            message = yield self.upstream.read_message()
+            if message is None:
+                self.close(self.upstream.close_code, self.upstream.close_reason)
+                return
+            try:
+                yield self.write_message(message, binary=type(message) == bytes)
+            except WebSocketClosedError:
+                return
+
+    @coroutine
+    def push(self):
+        while not self.closed:
+            now = time.time()
+            for lease_uuid, expire_date in list(self.inflight.items()):
+                if expire_date <= now:
+                    del self.inflight[lease_uuid]
+            available = self.credit - len(self.inflight)
+            if available <= 0:
+                # Wait for an ack, a new credit or the first lease to expire
+                self.credit_changed.clear()
+                try:
+                    yield self.credit_changed.wait(timeout=datetime.timedelta(seconds=min(self.inflight.values()) - now))
+                except TimeoutError:
+                    pass
+                continue
+            # The queue may have been purged or deleted in the meantime
+            self.queue = yield self.application.queues.get(self.path_args[0])
+            if not self.queue:
+                self.close(CONSUMER_QUEUE_NOT_FOUND, "Queue not found")
+                return
+            generation = self.application.waiters.generation(self.queue["id"])
+            try:
+                rows = yield self.receive(min(available, MAX_MESSAGE_COUNT), self.visibility_timeout, False)
+            except sqlite3.IntegrityError:
+                self.close(CONSUMER_QUEUE_NOT_FOUND, "Queue not found")
+                return
+            if rows:
+                self.messages_received(rows, self.visibility_timeout, False)
+                for row in rows:
+                    self.inflight[row["lease_uuid"]] = row["lease_date"] + self.visibility_timeout
+                if self.closed:
+                    break
+                try:
+                    # Waits until the messages are written, a slow consumer slows us down
+                    yield self.write_message(json_encode({"messages": format_messages(rows, False)}))
+                except WebSocketClosedError:
+                    break
+                continue
+            self.waiting = self.application.waiters.wait(self.queue["id"], MAX_WAIT_TIME, generation)
+            yield self.waiting
+            self.waiting = None
+        yield self.release_inflight()
+
+    @coroutine
+    def on_message(self, message):
+        if self.shard is not None:
+            yield self.upstream.write_message(message, binary=type(message) == bytes)
+            return
+        try:
+            data = json_decode(message)
+            if type(data) != dict:
+                raise ValueError("Not an object")
+            if "credit" in data:
+                if not validate_consumer_credit(data["credit"]):
+                    raise ValueError("Invalid credit")
+                self.credit = data["credit"]
+            if "leases" in data:
+                leases = data["leases"]
+                if type(leases) != list or len(leases) > MAX_MESSAGE_COUNT or not all(validate_lease(lease) for lease in leases):
+                    raise ValueError("Invalid leases")
+                if len(set(lease["lease_uuid"] for lease in leases)) != len(leases):
+                    raise ValueError("Invalid leases")
+        except ValueError as e:
+            yield self.write_message(json_encode({"error": str(e)}))
+            return
+        if "leases" in data:
+            now = time.time()
+            found = yield self.apply_leases(leases, now)
+            for lease in leases:
+                if lease["lease_uuid"] not in found:
+                    continue
+                if lease.get("action", DEFAULT_LEASE_ACTION) == "extend":
+                    if lease["lease_uuid"] in self.inflight:
+                        self.inflight[lease["lease_uuid"]] = now + lease.get("visibility_timeout", DEFAULT_VISIBILITY_TIMEOUT)
+                else:
+                    self.inflight.pop(lease["lease_uuid"], None)
+            try:
+                yield self.write_message(json_encode({"leases": [{"lease_uuid": lease["lease_uuid"], "status": 200 if lease["lease_uuid"] in found else 404}
+                                                                 for lease in leases]}))
+            except WebSocketClosedError:
+                return
+        if "credit" in data or "leases" in data:
+            self.credit_changed.set()
+
+    def on_close(self):
+        self.closed = True
+        if self.shard is not None:
+            if getattr(self, "upstream", None) is not None:
+                self.upstream.close()
+            return
+        self.credit_changed.set()
+        # Stop waiting for messages, without taking a wakeup from another consumer
+        if self.waiting is not None and not self.waiting.done():
+            self.waiting.set_result(False)
+
+    @coroutine
+    def release_inflight(self):
+        if not self.inflight or not self.queue:
+            return
+        leases = [{"lease_uuid": lease_uuid, "action": "release"} for lease_uuid in self.inflight]
+        self.inflight = {}
+        try:
+            yield self.apply_leases(leases, time.time())
+        except sqlite3.IntegrityError:
+            return
 
 
 class TinyQueueServiceApplication(Application):
 
-    def __init__(self, db, api_token):
+    def __init__(self, db, api_token, cluster=None, ready_index=False):
         self.db = db
         self.api_token = api_token
+        self.cluster = cluster
+        self.queues = QueueCache(db)
+        self.waiters = Waiters()
+        self.counters = db.run_sync(load_queue_counters)
+        self.ready = db.run_sync(load_ready_messages) if ready_index else None
+        if db.queue_directory is not None:
+            for queue_id in list(self.counters):
+                if os.path.exists(db.queue_path(queue_id)):
+                    self.counters.update(db.run_sync(load_queue_counters, queue_id=queue_id))
+                    if ready_index:
+                        self.ready.update(db.run_sync(load_ready_messages, queue_id=queue_id))
+        # Ephemeral queues start out empty, unless another application opened them already
+        for queue_id in db.run_sync(list_ephemeral_queues):
+            db.run_sync(db.open_ephemeral_queue, queue_id)
+            self.counters.update(db.run_sync(load_queue_counters, queue_id=queue_id))
+            if ready_index:
+                self.ready.update(db.run_sync(load_ready_messages, queue_id=queue_id))
+        self.lease_reaper = ExpireLeasesCallback(self)
+        self.reclaimer = ReclaimQueuesCallback(self)
+        self.request_durations = collections.defaultdict(lambda: Histogram(REQUEST_DURATION_BUCKETS))
+        for queue in db.run_sync(list_retired_queues):
+            counters = self.counters.pop(queue["id"], QueueCounters())
+            if ready_index:
+                self.ready.pop(queue["id"], None)
+            self.reclaimer.add(queue["id"], queue["name"].rsplit("#", 1)[0], counters.total)
         handlers = [
             # TODO Make regexps below more strict
             URLSpec(r"/", HomeHandler),
             URLSpec(r"/version", VersionHandler),
             URLSpec(r"/statistics", StatisticsHandler),
+            URLSpec(r"/metrics", MetricsHandler),
+            URLSpec(r"/admin/sql", SQLHandler),
             URLSpec(r"/queues", QueuesHandler),
+            URLSpec(r"/queues/([^/]+)/leases", LeasesHandler),
             URLSpec(r"/queues/([^/]+)/leases/([^/]+)", LeasesHandler),
             URLSpec(r"/queues/([^/]+)", QueueHandler),
             URLSpec(r"/queues/([^/]+)/statistics", QueueStatisticsHandler),
+            URLSpec(r"/queues/([^/]+)/purge", PurgeHandler),
+            URLSpec(r"/queues/([^/]+)/ingest", IngestHandler),
+            URLSpec(r"/queues/([^/]+)/consume", ConsumerHandler),
         ]
         settings = {
             "template_path": os.path.join(os.path.dirname(__file__), "templates"),
@@ -421,59 +2547,294 @@ class TinyQueueServiceApplication(Application):
         }
         Application.__init__(self, handlers, **settings)
 
+    def log_request(self, handler):
+        key = (type(handler).__name__, handler.request.method, str(handler.get_status()))
+        self.request_durations[key].observe(handler.request.request_time())
+        super().log_request(handler)
+
 
 #
 # ExpireLeasesCallback
 #
 
+# Leases that expire close together are returned by one run
+LEASE_EXPIRY_RESOLUTION = 0.1
+
+def expire_leases(db, now):
+    if SQLITE_RETURNING:
+        c = db.execute("update messages set lease_date = null, lease_timeout = null, lease_expire_date = null where lease_expire_date < ? returning queue_id", [now])
+        counts = collections.Counter(row[0] for row in c.fetchall())
+    else:
+        # The unary plus keeps the planner on the lease_expire_date index
+        counts = collections.Counter(dict(db.execute("select queue_id, count(*) from messages where lease_expire_date < ? group by +queue_id", [now]).fetchall()))
+        if counts:
+            db.execute("update messages set lease_date = null, lease_timeout = null, lease_expire_date = null where lease_expire_date < ?", [now])
+    next_expire_date = db.execute("select min(lease_expire_date) from messages where lease_expire_date is not null").fetchone()[0]
+    return counts, next_expire_date
+
+# Expires leases like expire_leases, and also returns the released messages
+# as (queue_id, id, priority, create_date, visible_date) for the ready index
+def expire_leases_released(db, now):
+    released = [tuple(row) for row in db.execute("select queue_id, id, priority, create_date, visible_date, expire_date from messages where lease_expire_date < ?", [now])]
+    counts, next_expire_date = expire_leases(db, now)
+    return counts, next_expire_date, released
+
+#
+# Besides running periodically, the lease reaper schedules itself for the
+# earliest lease that is due, so that expired leases are returned to their
+# queue promptly. Handlers call schedule() when they hand out leases.
+#
+
 class ExpireLeasesCallback:
 
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, app):
+        self.app = app
+        self.running = False
+        self.pending = None
+        self.timeout = None
+        self.timeout_date = None
+
+    def schedule(self, when):
+        when = math.ceil(when / LEASE_EXPIRY_RESOLUTION) * LEASE_EXPIRY_RESOLUTION
+        if self.timeout is not None:
+            if self.timeout_date <= when:
+                return
+            IOLoop.current().remove_timeout(self.timeout)
+        self.timeout_date = when
+        self.timeout = IOLoop.current().call_later(max(0, when - time.time()), self.expire)
 
+    def expire(self):
+        self.timeout = None
+        self.timeout_date = None
+        self()
+
+    @coroutine
     def __call__(self):
-        with self.db:
-            self.db.execute("update messages set lease_date = null, lease_uuid = null, lease_timeout = null where (lease_date + lease_timeout) < ?", [time.time()])
+        if self.running:
+            return
+        self.running = True
+        try:
+            now = time.time()
+            storages = self.app.db.storages(queue_id for queue_id, counters in self.app.counters.items() if counters.leased)
+            if self.app.ready is None:
+                results = yield multi([self.app.db.write(expire_leases, now, queue_id=queue_id) for queue_id in storages])
+            else:
+                self.pending = multi([self.app.db.write(expire_leases_released, now, queue_id=queue_id) for queue_id in storages])
+                results = yield self.pending
+        finally:
+            self.running = False
+            self.pending = None
+        for result in results:
+            counts, next_expire_date = result[:2]
+            if self.app.ready is not None:
+                for queue_id, message_id, priority, create_date, visible_date, expire_date in result[2]:
+                    if queue_id in self.app.counters:
+                        self.app.ready[queue_id].add(message_id, priority, create_date, visible_date, expire_date, now)
+            for queue_id, count in counts.items():
+                if queue_id in self.app.counters:
+                    self.app.counters[queue_id].leased -= count
+                    self.app.counters[queue_id].lease_expire_count += count
+                    self.app.waiters.notify(queue_id, count)
+            if next_expire_date is not None:
+                self.schedule(next_expire_date)
 
 
 #
-# ExpireMessagesCallback runs periodically to delete expired messages.
+# ExpireMessagesCallback runs periodically to delete expired messages. It
+# deletes them in batches, oldest first, and each batch is a separate
+# database operation so that other requests get their turn in between.
+# A run stops when its time budget is used up and continues shortly
+# after, so that a large backlog is worked off without blocking traffic.
 #
 
+EXPIRE_MESSAGES_BATCH_SIZE = 1000
+EXPIRE_MESSAGES_TIME_BUDGET = 0.25
+EXPIRE_MESSAGES_PAUSE = 1.0
+
+# The unary plus keeps the planner on the expire_date index, which also
+# gives us the expired messages in order
+EXPIRED_MESSAGES_SQL = "select id from messages where +lease_date is null and expire_date < ? order by expire_date limit ?"
+
+def expire_messages(db, now, limit):
+    if SQLITE_RETURNING:
+        c = db.execute("delete from messages where id in (" + EXPIRED_MESSAGES_SQL + ") returning queue_id", [now, limit])
+        rows = c.fetchall()
+    else:
+        rows = db.execute(EXPIRED_MESSAGES_SQL.replace("select id", "select id, queue_id", 1), [now, limit]).fetchall()
+        if rows:
+            db.execute("delete from messages where id in (%s)" % ",".join("?" * len(rows)), [row["id"] for row in rows])
+    counts = collections.Counter(row["queue_id"] for row in rows)
+    db.executemany("update queues set expire_count = expire_count + ? where id = ?", [(count, queue_id) for queue_id, count in counts.items()])
+    return counts
+
 class ExpireMessagesCallback:
 
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, app, batch_size=EXPIRE_MESSAGES_BATCH_SIZE, time_budget=EXPIRE_MESSAGES_TIME_BUDGET):
+        self.app = app
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.running = False
+
+    @coroutine
+    def __call__(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            deadline = time.time() + self.time_budget
+            storages = self.app.db.storages(queue_id for queue_id, counters in self.app.counters.items() if counters.total)
+            expired = set()
+            while storages:
+                now = time.time()
+                results = yield multi([self.app.db.write(expire_messages, now, self.batch_size, queue_id=queue_id) for queue_id in storages])
+                for counts in results:
+                    for queue_id, count in counts.items():
+                        if queue_id in self.app.counters:
+                            self.app.counters[queue_id].total -= count
+                            self.app.counters[queue_id].expire_count += count
+                            expired.add(queue_id)
+                # Storages with a full batch may have more expired messages
+                storages = [storage for storage, counts in zip(storages, results) if sum(counts.values()) >= self.batch_size]
+                if storages and time.time() >= deadline:
+                    IOLoop.current().call_later(EXPIRE_MESSAGES_PAUSE, self)
+                    break
+            if self.app.ready is not None:
+                yield self.reload_ready_messages(expired)
+        finally:
+            self.running = False
+
+    # The ready index still has the ids of expired messages
+    @coroutine
+    def reload_ready_messages(self, queue_ids):
+        for queue_id in queue_ids:
+            counters = self.app.counters.get(queue_id)
+            if counters is not None and len(self.app.ready[queue_id]) > 2 * (counters.total - counters.leased) + READY_INDEX_SLACK:
+                index = yield self.app.db.write(load_ready_messages, queue_id, queue_id=queue_id)
+                if queue_id in self.app.counters:
+                    self.app.ready[queue_id] = index.get(queue_id, ReadyMessages())
+
 
+#
+# ReclaimQueuesCallback deletes the messages of retired queues in batches,
+# with a time budget like ExpireMessagesCallback, and deletes a queue
+# once it is empty. A queue with a file of its own is reclaimed at once
+# by removing its file.
+#
+
+RECLAIM_BATCH_SIZE = 1000
+RECLAIM_TIME_BUDGET = 0.25
+RECLAIM_PAUSE = 1.0
+
+def reclaim_queue(db, queue_id, limit):
+    count = db.execute("delete from messages where id in (select id from messages where queue_id = ? limit ?)", [queue_id, limit]).rowcount
+    if count < limit:
+        db.execute("delete from queues where id = ?", [queue_id])
+    return count
+
+class ReclaimQueuesCallback:
+
+    def __init__(self, app, batch_size=RECLAIM_BATCH_SIZE, time_budget=RECLAIM_TIME_BUDGET):
+        self.app = app
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.running = False
+        # Retired queue id -> [queue name, estimate of the messages left]
+        self.queues = {}
+
+    def add(self, queue_id, queue_name, count):
+        self.queues[queue_id] = [queue_name, count]
+        IOLoop.current().add_callback(self)
+
+    # Returns the number of messages of a queue name that are still to be
+    # deleted, or None if there is nothing left to reclaim
+    def remaining(self, queue_name):
+        return self.counts().get(queue_name)
+
+    def counts(self):
+        counts = collections.Counter()
+        for name, count in self.queues.values():
+            counts[name] += count
+        return counts
+
+    @coroutine
     def __call__(self):
-        with self.db:
-            self.db.execute("delete from messages where lease_date is null and expire_date < ?", [time.time()])
+        if self.running:
+            return
+        self.running = True
+        try:
+            deadline = time.time() + self.time_budget
+            while self.queues:
+                queue_id = next(iter(self.queues))
+                count = yield self.app.db.write(reclaim_queue, queue_id, self.batch_size)
+                if count < self.batch_size:
+                    yield self.app.db.write(self.app.db.remove_queue, queue_id)
+                    del self.queues[queue_id]
+                else:
+                    self.queues[queue_id][1] = max(0, self.queues[queue_id][1] - count)
+                if self.queues and time.time() >= deadline:
+                    IOLoop.current().call_later(RECLAIM_PAUSE, self)
+                    break
+        finally:
+            self.running = False
 
 
 define("port", default=os.getenv("TQS_PORT", "8080"), help="run on the given port", type=int)
 define("database", default=os.getenv("TQS_DATABASE", "/data/tqs.sqlite3"), help="database path", type=str)
+define("database-readers", default=int(os.getenv("TQS_DATABASE_READERS", "0")), help="number of database reader threads", type=int)
+define("journal-mode", default=os.getenv("TQS_JOURNAL_MODE", "delete"), help="sqlite journal mode (%s)" % ", ".join(VALID_JOURNAL_MODES), type=str)
+define("synchronous", default=os.getenv("TQS_SYNCHRONOUS", "full"), help="sqlite synchronous level (%s)" % ", ".join(VALID_SYNCHRONOUS), type=str)
+define("group-commit", default=int(os.getenv("TQS_GROUP_COMMIT", "0")), help="milliseconds to wait for more writes to share a commit", type=int)
+define("queue-directory", default=os.getenv("TQS_QUEUE_DIRECTORY", None), help="store the messages of every queue in a database file of its own in this directory", type=str)
+define("queue-connections", default=int(os.getenv("TQS_QUEUE_CONNECTIONS", str(DEFAULT_QUEUE_CONNECTIONS))), help="maximum number of queue files that are kept open", type=int)
+define("trace-sql", default=os.getenv("TQS_TRACE_SQL", "") in ("1", "true", "yes"), help="record the time spent on every SQL statement, see /admin/sql", type=bool)
+define("slow-query-time", default=int(os.getenv("TQS_SLOW_QUERY_TIME", str(DEFAULT_SLOW_QUERY_TIME))), help="log traced statements that take more milliseconds than this, 0 to disable", type=int)
+define("mmap-size", default=int(os.getenv("TQS_MMAP_SIZE", str(DEFAULT_MMAP_SIZE))), help="megabytes of every database file that are read through memory mapping", type=int)
+define("checkpoint-interval", default=int(os.getenv("TQS_CHECKPOINT_INTERVAL", str(DEFAULT_CHECKPOINT_INTERVAL))), help="milliseconds between checkpoints in a background thread, in wal mode, 0 to checkpoint in the writer", type=int)
+define("ephemeral-queue-size", default=int(os.getenv("TQS_EPHEMERAL_QUEUE_SIZE", str(DEFAULT_EPHEMERAL_QUEUE_SIZE // (1024 * 1024)))), help="megabytes of memory that a queue that is not durable may use", type=int)
+define("ready-index", default=os.getenv("TQS_READY_INDEX", "") in ("1", "true", "yes"), help="keep the ids of ready messages in memory", type=bool)
 define("api-token", default=os.getenv("TQS_API_TOKEN", None), help="api token", type=str)
+define("access-log", default=os.getenv("TQS_ACCESS_LOG", "") in ("1", "true", "yes"), help="log every request", type=bool)
+define("workers", default=int(os.getenv("TQS_WORKERS", "1")), help="number of worker processes, each with its own shard database", type=int)
+define("internal-port", default=int(os.getenv("TQS_INTERNAL_PORT", "9080")), help="first of the localhost ports on which workers forward requests to each other", type=int)
 
 
 if __name__ == "__main__":
     parse_command_line()
 
-    # TODO Make this configurable
-    logging.getLogger('tornado.access').disabled = True
+    logging.getLogger('tornado.access').disabled = not options.access_log
 
-    db = sqlite3.connect(options.database)
-    db.row_factory = sqlite3.Row
-    with open("tqs.sql", "r") as f:
-        sql = f.read()
-        db.executescript(sql)
+    cluster = None
+    database = options.database
+    queue_directory = options.queue_directory
+    if options.workers > 1:
+        # All workers bind the public port with SO_REUSEPORT, so the
+        # kernel spreads connections over them
+        secret = uuid.uuid4().hex
+        worker_id = fork_processes(options.workers)
+        cluster = Cluster(worker_id, [options.internal_port + n for n in range(options.workers)], secret)
+        database = shard_database_path(options.database, worker_id)
+        if queue_directory:
+            queue_directory = shard_database_path(queue_directory, worker_id)
+
+    tracer = None
+    if options.trace_sql:
+        tracer = Tracer(options.slow_query_time / 1000.0 if options.slow_query_time > 0 else None)
+
+    db = Database(database, options.database_readers, options.journal_mode, options.synchronous, options.group_commit / 1000.0,
+                  queue_directory or None, options.queue_connections, tracer, options.ephemeral_queue_size * 1024 * 1024,
+                  options.mmap_size * 1024 * 1024, options.checkpoint_interval / 1000.0)
+    db.run_sync(create_schema)
 
-    app = TinyQueueServiceApplication(db, options.api_token)
+    app = TinyQueueServiceApplication(db, options.api_token, cluster, options.ready_index)
 
     server = HTTPServer(app)
-    server.listen(options.port)
+    server.add_sockets(bind_sockets(options.port, reuse_port=cluster is not None))
+    if cluster is not None:
+        server.listen(cluster.ports[cluster.worker_id], address="127.0.0.1")
 
     # These do not have to be super accurate
-    PeriodicCallback(ExpireLeasesCallback(db), 2500).start()
-    PeriodicCallback(ExpireMessagesCallback(db), 15000).start()
+    PeriodicCallback(app.lease_reaper, 2500).start()
+    PeriodicCallback(ExpireMessagesCallback(app), 15000).start()
+    PeriodicCallback(app.reclaimer, 15000).start()
 
     IOLoop.current().start()
@@ -2,6 +2,8 @@
 -- License, v. 2.0. If a copy of the MPL was not distributed with this
 -- file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+-- The current schema, for new databases. Existing databases are
+-- upgraded by the migrations in tqs.py, change both together.
 
 PRAGMA foreign_keys = ON;
 
@@ -12,12 +14,12 @@ CREATE TABLE IF NOT EXISTS queues (
   name TEXT NOT NULL UNIQUE,
   insert_count integer default 0,
   delete_count integer default 0,
-  expire_count integer default 0
+  expire_count integer default 0,
+  drop_date REAL,
+  durable integer not null default 1,
+  generation integer not null default 0
 );
 
-CREATE UNIQUE INDEX IF NOT EXISTS queues_id ON queues (id);
-CREATE UNIQUE INDEX IF NOT EXISTS queues_name ON queues (name);
-
 
 CREATE TABLE IF NOT EXISTS messages (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,17 +30,13 @@ CREATE TABLE IF NOT EXISTS messages (
   type TEXT not null,
   priority int NOT NULL,
   lease_date REAL,
-  lease_uuid TEXT UNIQUE,
+  lease_count INTEGER NOT NULL DEFAULT 0,
   lease_timeout INTEGER,
+  lease_expire_date REAL,
   queue_id INTEGER REFERENCES queues (id) ON DELETE CASCADE
 );
 
-CREATE UNIQUE INDEX IF NOT EXISTS messages_id ON messages (id);
 CREATE INDEX IF NOT EXISTS messages_queue_id ON messages (queue_id);
-CREATE INDEX IF NOT EXISTS messages_create_date ON messages (create_date);
-CREATE INDEX IF NOT EXISTS messages_lease_date ON messages (lease_date);
-CREATE UNIQUE INDEX IF NOT EXISTS messages_lease_uuid ON messages (lease_uuid);
-CREATE INDEX IF NOT EXISTS messages_queue_id_lease_date_create_date ON messages (queue_id, lease_date, create_date); -- TODO Still needed?
-CREATE INDEX IF NOT EXISTS messages_queue_id_lease_date_priority_create_date ON messages (queue_id, lease_date, priority, create_date);
-CREATE INDEX IF NOT EXISTS messages_queue_id_lease_uuid ON messages (queue_id, lease_uuid);
-
+CREATE INDEX IF NOT EXISTS messages_ready ON messages (queue_id, priority, create_date) WHERE lease_date IS NULL;
+CREATE INDEX IF NOT EXISTS messages_lease_expire_date ON messages (lease_expire_date) WHERE lease_expire_date IS NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_expire_date ON messages (expire_date);
@@ -0,0 +1,348 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+#
+# tqs-bench starts TQS against a temporary database, drives it with a mix
+# of producers, long-polling consumers and ackers, and reports throughput
+# and latency percentiles per endpoint as JSON. A report can be compared
+# against an earlier one to catch regressions:
+#
+#   python tqs_bench.py --duration=30 --output=baseline.json
+#   python tqs_bench.py --duration=30 --baseline=baseline.json
+#
+# The server runs in a child process so that the load generator does not
+# compete with it for the IOLoop.
+#
+
+
+import argparse, collections, datetime, json, logging, multiprocessing, os, platform, random, subprocess, sys, tempfile, time
+
+from tornado.gen import TimeoutError, multi, sleep
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.queues import Queue
+from tornado.testing import bind_unused_port
+
+import tqs
+
+
+REPORT_VERSION = 1
+PERCENTILES = [("p50", 50), ("p95", 95), ("p99", 99), ("p999", 99.9)]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Tiny Queue Service load generator and latency benchmark")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to measure")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds to run before measuring")
+    parser.add_argument("--queues", type=int, default=4, help="number of queues")
+    parser.add_argument("--producers", type=int, default=8, help="number of concurrent producers")
+    parser.add_argument("--consumers", type=int, default=8, help="number of concurrent long-polling consumers")
+    parser.add_argument("--ackers", type=int, default=4, help="number of concurrent ackers")
+    parser.add_argument("--ack", choices=["single", "batch", "receive"], default="single",
+                        help="delete leases one by one, in batches, or delete messages when they are received")
+    parser.add_argument("--batch-size", type=int, default=10, help="messages per post and per receive")
+    parser.add_argument("--message-size", type=int, default=256, help="message body size in bytes")
+    parser.add_argument("--wait-time", type=int, default=5, help="long-poll wait time of consumers")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--url", type=str, default=None, help="benchmark a running server instead of starting one")
+    parser.add_argument("--database-readers", type=int, default=0)
+    parser.add_argument("--journal-mode", type=str, default="delete", choices=tqs.VALID_JOURNAL_MODES)
+    parser.add_argument("--synchronous", type=str, default="full", choices=tqs.VALID_SYNCHRONOUS)
+    parser.add_argument("--group-commit", type=int, default=0, help="milliseconds")
+    parser.add_argument("--mmap-size", type=int, default=0, help="megabytes")
+    parser.add_argument("--checkpoint-interval", type=int, default=0, help="milliseconds")
+    parser.add_argument("--queue-files", action="store_true", help="store every queue in a database file of its own")
+    parser.add_argument("--ready-index", action="store_true", help="keep the ids of ready messages in memory")
+    parser.add_argument("--ephemeral", action="store_true", help="benchmark queues that are kept in memory")
+    parser.add_argument("--output", type=str, default=None, help="write the report to this file instead of stdout")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against this report, exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=10, help="percentage that throughput and p99 latency may get worse")
+    return parser.parse_args(argv)
+
+
+#
+# Server
+#
+
+def serve(sock, directory, args):
+    logging.getLogger("tornado.access").disabled = True
+    db = tqs.Database(os.path.join(directory, "bench.sqlite3"), args.database_readers, args.journal_mode, args.synchronous,
+                      args.group_commit / 1000.0, os.path.join(directory, "queues") if args.queue_files else None,
+                      mmap_size=args.mmap_size * 1024 * 1024, checkpoint_interval=args.checkpoint_interval / 1000.0)
+    db.run_sync(tqs.create_schema)
+    app = tqs.TinyQueueServiceApplication(db, None, ready_index=args.ready_index)
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    PeriodicCallback(app.lease_reaper, 2500).start()
+    PeriodicCallback(tqs.ExpireMessagesCallback(app), 15000).start()
+    PeriodicCallback(app.reclaimer, 15000).start()
+    IOLoop.current().start()
+
+def start_server(directory, args):
+    sock, port = bind_unused_port()
+    process = multiprocessing.get_context("fork").Process(target=serve, args=(sock, directory, args), daemon=True)
+    process.start()
+    sock.close()
+    return process, "http://127.0.0.1:%d" % port
+
+
+#
+# Statistics
+#
+
+def percentile(values, p):
+    # Nearest rank, values must be sorted
+    if not values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(values) + 0.4999)))
+    return values[min(rank, len(values)) - 1]
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies), "rps": round(len(latencies) / duration, 1)}
+    for name, p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    summary["max"] = round(latencies[-1] * 1000, 3) if latencies else None
+    return summary
+
+class Recorder:
+
+    def __init__(self):
+        self.recording = False
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.messages = collections.Counter()
+
+    def record(self, endpoint, latency, error=False):
+        if self.recording:
+            self.latencies[endpoint].append(latency)
+            if error:
+                self.errors[endpoint] += 1
+
+    def count(self, what, n):
+        if self.recording:
+            self.messages[what] += n
+
+    def report(self, duration):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            endpoints[endpoint] = summarize(latencies, duration)
+            endpoints[endpoint]["errors"] = self.errors[endpoint]
+        return {
+            "throughput": {what: round(self.messages[what] / duration, 1) for what in ("produced", "consumed", "acked")},
+            "endpoints": endpoints,
+        }
+
+
+#
+# Load
+#
+
+class Benchmark:
+
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.recorder = Recorder()
+        self.client = AsyncHTTPClient(max_clients=args.producers + args.consumers + args.ackers + 1)
+        self.queue_names = ["bench-%d" % n for n in range(args.queues)]
+        self.acks = Queue(maxsize=10000)
+        self.stopped = False
+
+    async def fetch(self, endpoint, path, method="GET", body=None, timeout=None):
+        request = HTTPRequest(self.url + path, method=method, body=body, request_timeout=timeout or 30)
+        start = time.perf_counter()
+        try:
+            response = await self.client.fetch(request, raise_error=False)
+        except Exception:
+            self.recorder.record(endpoint, time.perf_counter() - start, True)
+            return None
+        self.recorder.record(endpoint, time.perf_counter() - start, response.code >= 400)
+        return response if response.code < 400 else None
+
+    async def setup(self):
+        for name in self.queue_names:
+            await self.fetch("DELETE /queues/{name}", "/queues/" + name, method="DELETE")
+            response = await self.fetch("POST /queues", "/queues", method="POST", body=json.dumps({"name": name, "durable": not self.args.ephemeral}))
+            if response is None:
+                raise Exception("Cannot create queue %s" % name)
+
+    async def teardown(self):
+        for name in self.queue_names:
+            await self.fetch("DELETE /queues/{name}", "/queues/" + name + "?async=true", method="DELETE")
+
+    # The body carries the time it was sent at, for the end-to-end latency
+    def message_body(self):
+        stamp = "%.6f " % time.time()
+        return stamp + "x" * max(0, self.args.message_size - len(stamp))
+
+    async def produce(self):
+        while not self.stopped:
+            name = self.random.choice(self.queue_names)
+            messages = [{"body": self.message_body()} for n in range(self.args.batch_size)]
+            response = await self.fetch("POST /queues/{name}", "/queues/" + name, method="POST", body=json.dumps({"messages": messages}))
+            if response is not None:
+                self.recorder.count("produced", len(messages))
+
+    async def consume(self):
+        path = "?message_count=%d&wait_time=%d" % (self.args.batch_size, self.args.wait_time)
+        if self.args.ack == "receive":
+            path += "&delete=true"
+        while not self.stopped:
+            name = self.random.choice(self.queue_names)
+            start = time.perf_counter()
+            try:
+                response = await self.client.fetch(HTTPRequest(self.url + "/queues/" + name + path, request_timeout=self.args.wait_time + 30), raise_error=False)
+            except Exception:
+                response = None
+            latency = time.perf_counter() - start
+            if response is None or response.code >= 400:
+                self.recorder.record("GET /queues/{name}", latency, True)
+                continue
+            messages = json.loads(response.body.decode())["messages"]
+            # A long poll that comes back empty mostly measures the wait time
+            self.recorder.record("GET /queues/{name}" if messages else "GET /queues/{name} (empty)", latency)
+            self.recorder.count("consumed", len(messages))
+            now = time.time()
+            for message in messages:
+                self.recorder.record("end-to-end", now - float(message["body"].split(" ", 1)[0]))
+            if self.args.ack == "receive":
+                self.recorder.count("acked", len(messages))
+            elif messages:
+                await self.acks.put((name, [message["lease_uuid"] for message in messages]))
+
+    # Leases that are not acked before the end simply expire
+    async def ack(self):
+        while not self.stopped:
+            try:
+                name, lease_uuids = await self.acks.get(timeout=datetime.timedelta(seconds=0.1))
+            except TimeoutError:
+                continue
+            if self.args.ack == "batch":
+                body = json.dumps({"leases": [{"lease_uuid": lease_uuid} for lease_uuid in lease_uuids]})
+                response = await self.fetch("POST /queues/{name}/leases", "/queues/%s/leases" % name, method="POST", body=body)
+                if response is not None:
+                    self.recorder.count("acked", len(lease_uuids))
+            else:
+                for lease_uuid in lease_uuids:
+                    response = await self.fetch("DELETE /queues/{name}/leases/{uuid}", "/queues/%s/leases/%s" % (name, lease_uuid), method="DELETE")
+                    if response is not None:
+                        self.recorder.count("acked", 1)
+
+    async def run(self):
+        await self.setup()
+        workers = [self.produce() for n in range(self.args.producers)] + [self.consume() for n in range(self.args.consumers)]
+        if self.args.ack != "receive":
+            workers += [self.ack() for n in range(self.args.ackers)]
+        workers = multi(workers)
+        await sleep(self.args.warmup)
+        self.recorder.recording = True
+        start = time.perf_counter()
+        await sleep(self.args.duration)
+        self.recorder.recording = False
+        duration = time.perf_counter() - start
+        self.stopped = True
+        await workers
+        await self.teardown()
+        return self.recorder.report(duration)
+
+
+#
+# Reports
+#
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def configuration(args):
+    return {name: value for name, value in sorted(vars(args).items()) if name not in ("output", "baseline", "tolerance", "url")}
+
+# Returns a list of regressions, throughput that went down or p99 latency
+# that went up by more than the tolerance
+def compare(report, baseline, tolerance):
+    regressions = []
+    factor = tolerance / 100.0
+    for what, value in baseline["throughput"].items():
+        current = report["throughput"].get(what, 0)
+        if value and current < value * (1 - factor):
+            regressions.append("%s throughput %.1f/s, was %.1f/s" % (what, current, value))
+    for endpoint, summary in baseline["endpoints"].items():
+        # Empty long polls only measure the wait time
+        if endpoint not in report["endpoints"] or endpoint.endswith("(empty)") or summary["p99"] is None:
+            continue
+        current = report["endpoints"][endpoint]["p99"]
+        if current is not None and current > summary["p99"] * (1 + factor):
+            regressions.append("%s p99 %.3fms, was %.3fms" % (endpoint, current, summary["p99"]))
+    return regressions
+
+def benchmark(args):
+    directory = None
+    process = None
+    url = args.url
+    if url is None:
+        directory = tempfile.TemporaryDirectory(prefix="tqs-bench-")
+        process, url = start_server(directory.name, args)
+    try:
+        io_loop = IOLoop.current()
+        io_loop.run_sync(lambda: wait_for_server(url))
+        result = io_loop.run_sync(Benchmark(url, args).run)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+        if directory is not None:
+            directory.cleanup()
+    report = {
+        "version": REPORT_VERSION,
+        "date": time.time(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": tqs.sqlite3.sqlite_version,
+        "config": configuration(args),
+    }
+    report.update(result)
+    return report
+
+async def wait_for_server(url, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            await AsyncHTTPClient().fetch(url + "/version")
+            return
+        except Exception:
+            if time.time() >= deadline:
+                raise
+            await sleep(0.1)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    report = benchmark(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("Warning: the baseline was run with a different configuration", file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())